@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 
+import hashlib
 import json
 import os
+import tarfile
 from glob import glob
 from pathlib import Path
 from time import sleep
@@ -130,19 +132,148 @@ def projects(token, include_public):
 @click.argument("local_file", type=click.File("rb"))
 @click.argument("remote_file")
 @click.argument("token", envvar="QFIELDCLOUD_TOKEN", type=str)
-def upload_file(token, project_id, local_file, remote_file):
+@click.option(
+    "--direct/--no-direct",
+    default=False,
+    help="Upload the file directly to the storage using presigned URLs",
+)
+@click.option(
+    "--delta/--no-delta",
+    default=False,
+    help="Upload only the blocks that changed since the latest version of the file",
+)
+def upload_file(token, project_id, local_file, remote_file, direct, delta):
     """Upload file"""
 
+    if delta and upload_file_delta(token, project_id, local_file, remote_file):
+        print(f'File uploaded "{remote_file}"')
+        return
+
+    if direct:
+        upload_file_direct(token, project_id, local_file, remote_file)
+    else:
+        _ = cloud_request(
+            "POST",
+            f"files/{project_id}/{remote_file}",
+            token=token,
+            files={
+                "file": local_file,
+            },
+        )
+
+    print(f'File uploaded "{remote_file}"')
+
+
+def upload_file_direct(token, project_id, local_file, remote_file):
+    """Upload file directly to the storage, without passing through the app server"""
+
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: local_file.read(1024 * 1024), b""):
+        hasher.update(chunk)
+
+    size = local_file.tell()
+    local_file.seek(0)
+
+    resp = cloud_request(
+        "POST",
+        f"file-uploads/{project_id}",
+        token=token,
+        data={
+            "filename": str(remote_file),
+            "size": size,
+            "sha256": hasher.hexdigest(),
+        },
+    )
+    upload = resp.json()
+    complete_data = {"upload_token": upload["upload_token"]}
+    parts = []
+
+    if upload["method"] == "NONE":
+        # the file is unchanged on the server
+        return
+    elif upload["method"] == "PUT":
+        # NOTE an empty body would be sent with "Transfer-Encoding: chunked", which S3 does not support
+        data = local_file if size else b""
+        put_resp = requests.put(upload["url"], data=data, headers=upload["headers"])
+        put_resp.raise_for_status()
+        # the server verifies exactly the version that has been uploaded
+        complete_data["version_id"] = put_resp.headers["x-amz-version-id"]
+    else:
+        for part in upload["parts"]:
+            part_resp = requests.put(
+                part["url"], data=local_file.read(upload["part_size"])
+            )
+            part_resp.raise_for_status()
+            parts.append(
+                {"part_number": part["part_number"], "etag": part_resp.headers["ETag"]}
+            )
+
+        complete_data["parts"] = parts
+
     _ = cloud_request(
         "POST",
-        f"files/{project_id}/{remote_file}",
+        f"file-uploads/{project_id}/complete",
         token=token,
-        files={
-            "file": local_file,
+        data=json.dumps(complete_data),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def upload_file_delta(token, project_id, local_file, remote_file) -> bool:
+    """Upload only the blocks of the file that changed since its latest version.
+    Returns False if the file does not exist yet and must be uploaded as a whole."""
+
+    resp = cloud_request(
+        "GET",
+        f"file-blocks/{project_id}/{remote_file}",
+        token=token,
+        exit_on_error=False,
+    )
+
+    if not resp.ok:
+        return False
+
+    latest = resp.json()
+    block_size = latest["block_size"]
+    hasher = hashlib.sha256()
+    changed_blocks = {}
+    index = 0
+
+    for block in iter(lambda: local_file.read(block_size), b""):
+        hasher.update(block)
+
+        if (
+            index >= len(latest["blocks"])
+            or hashlib.sha256(block).hexdigest() != latest["blocks"][index]
+        ):
+            changed_blocks[f"block_{index}"] = block
+
+        index += 1
+
+    size = local_file.tell()
+
+    if size == latest["size"] and hasher.hexdigest() == latest["sha256"]:
+        # the file is unchanged on the server
+        return True
+
+    resp = cloud_request(
+        "POST",
+        f"file-blocks/{project_id}/{remote_file}",
+        token=token,
+        data={
+            "version_id": latest["version_id"],
+            "size": size,
+            "sha256": hasher.hexdigest(),
         },
+        files=changed_blocks,
     )
+    payload = resp.json()
 
-    print(f'File uploaded "{remote_file}"')
+    print(
+        f'Uploaded {payload["uploaded_blocks"]} changed block(s), {payload["copied_blocks"]} block(s) unchanged'
+    )
+
+    return True
 
 
 @cli.command()
@@ -239,9 +370,18 @@ def download_file(token, project_id, remote_file, local_file, version=None):
 @click.argument("project_id")
 @click.argument("local_dir")
 @click.argument("token", envvar="QFIELDCLOUD_TOKEN", type=str)
-def download_files(token, project_id, local_dir):
+@click.option(
+    "--archive/--no-archive",
+    default=False,
+    help="Download all the files as a single archive, resuming interrupted downloads",
+)
+def download_files(token, project_id, local_dir, archive):
     """Pull file"""
 
+    if archive:
+        download_archive(token, f"file-archives/{project_id}", local_dir)
+        return
+
     resp = cloud_request("GET", f"files/{project_id}", token=token)
     files = resp.json()
     files_count = 0
@@ -273,6 +413,76 @@ def download_files(token, project_id, local_dir):
     print(f"Done! Downloaded {files_count}/{len(files)} files.")
 
 
+def download_archive(token, path, local_dir, retries=5):
+    """Downloads a tar archive and extracts it in `local_dir`.
+
+    The archive is first downloaded next to `local_dir`. If the connection drops, the download continues
+    from the last received byte, unless the archive has changed on the server meanwhile."""
+    local_dir = Path(local_dir)
+    local_dir.mkdir(parents=True, exist_ok=True)
+    archive_file = local_dir.with_name(f"{local_dir.name}.tar.part")
+    etag = None
+
+    # the archive of a previous run may be outdated, without its ETag it cannot be resumed safely
+    if archive_file.exists():
+        archive_file.unlink()
+
+    for attempt in range(retries + 1):
+        headers = {}
+        offset = archive_file.stat().st_size if archive_file.exists() else 0
+
+        if offset and etag:
+            headers = {"Range": f"bytes={offset}-", "If-Range": etag}
+
+        try:
+            resp = cloud_request("GET", path, token=token, headers=headers, stream=True)
+            etag = resp.headers.get("ETag")
+
+            # the server sends the whole archive again if it changed since the first attempt
+            mode = "ab" if resp.status_code == 206 else "wb"
+
+            if resp.status_code == 206:
+                archive_size = int(resp.headers["Content-Range"].rpartition("/")[2])
+            else:
+                archive_size = int(resp.headers["Content-Length"])
+
+            with open(archive_file, mode) as f:
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+
+            # the response is cut short if the server times out or the archived files are deleted meanwhile
+            if archive_file.stat().st_size != archive_size:
+                raise requests.ConnectionError("Incomplete archive")
+
+            break
+        except (
+            requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+        ) as err:
+            if attempt == retries:
+                raise
+
+            print(f"Download interrupted ({err}), resuming...")
+            sleep(1)
+
+    with tarfile.open(archive_file) as tar:
+        names = tar.getnames()
+
+        for name in names:
+            if Path(name).is_absolute() or ".." in Path(name).parts:
+                raise ValueError(f'Unsafe filename in the archive "{name}"')
+
+        tar.extractall(local_dir)
+
+    archive_file.unlink()
+
+    for name in names:
+        print(f'File downloaded at "{local_dir / name}"')
+
+    print(f"Done! Downloaded {len(names)} files.")
+
+
 @cli.command()
 @click.argument("project_id")
 @click.argument("token", envvar="QFIELDCLOUD_TOKEN", type=str)
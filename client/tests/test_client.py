@@ -0,0 +1,89 @@
+import hashlib
+import io
+import json
+import unittest
+from unittest import mock
+
+import client
+
+
+class UploadFileDirectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cloud_requests = []
+
+    def cloud_request(self, method, path, **kwargs):
+        self.cloud_requests.append((method, path, kwargs))
+        response = mock.Mock()
+
+        if path.startswith("file-uploads/") and not path.endswith("/complete"):
+            response.json.return_value = self.upload
+
+        return response
+
+    def test_put_upload_sends_version_id(self):
+        content = b"Hello direct upload!"
+        self.upload = {
+            "method": "PUT",
+            "url": "http://storage/bucket/file.txt",
+            "headers": {"x-amz-meta-sha256sum": hashlib.sha256(content).hexdigest()},
+            "upload_token": "token1",
+        }
+        put_response = mock.Mock(headers={"x-amz-version-id": "version1"})
+
+        with mock.patch.object(
+            client, "cloud_request", side_effect=self.cloud_request
+        ), mock.patch.object(client.requests, "put", return_value=put_response) as put:
+            client.upload_file_direct(
+                "token", "project1", io.BytesIO(content), "file.txt"
+            )
+
+        self.assertEqual(put.call_args.args, (self.upload["url"],))
+        self.assertEqual(put.call_args.kwargs["headers"], self.upload["headers"])
+        put_response.raise_for_status.assert_called_once()
+
+        _method, path, kwargs = self.cloud_requests[-1]
+        self.assertEqual(path, "file-uploads/project1/complete")
+        self.assertEqual(
+            json.loads(kwargs["data"]),
+            {"upload_token": "token1", "version_id": "version1"},
+        )
+
+    def test_multipart_upload_sends_parts(self):
+        content = b"x" * 10
+        self.upload = {
+            "method": "MULTIPART",
+            "part_size": 4,
+            "parts": [
+                {"part_number": i, "url": f"http://storage/part{i}"}
+                for i in range(1, 4)
+            ],
+            "upload_token": "token1",
+        }
+
+        with mock.patch.object(
+            client, "cloud_request", side_effect=self.cloud_request
+        ), mock.patch.object(
+            client.requests,
+            "put",
+            side_effect=lambda url, data: mock.Mock(headers={"ETag": f'"{data}"'}),
+        ):
+            client.upload_file_direct(
+                "token", "project1", io.BytesIO(content), "file.txt"
+            )
+
+        _method, _path, kwargs = self.cloud_requests[-1]
+        self.assertEqual(
+            json.loads(kwargs["data"]),
+            {
+                "upload_token": "token1",
+                "parts": [
+                    {"part_number": 1, "etag": "\"b'xxxx'\""},
+                    {"part_number": 2, "etag": "\"b'xxxx'\""},
+                    {"part_number": 3, "etag": "\"b'xx'\""},
+                ],
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
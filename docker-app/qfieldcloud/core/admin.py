@@ -23,6 +23,7 @@ from qfieldcloud.core.models import (
     ProcessProjectfileJob,
     Project,
     ProjectCollaborator,
+    StorageCleanup,
     Team,
     TeamMember,
     User,
@@ -143,6 +144,7 @@ class MemberTeamInline(admin.TabularInline):
 class UserAccountInline(admin.StackedInline):
     model = UserAccount
     extra = 1
+    readonly_fields = ("storage_size", "storage_objects")
 
     def has_add_permission(self, request, obj):
         if obj is None:
@@ -274,7 +276,15 @@ class ProjectAdmin(admin.ModelAdmin):
         "created_at",
         "updated_at",
     )
-    fields = ("name", "description", "is_public", "owner", "storage_size")
+    fields = (
+        "name",
+        "description",
+        "is_public",
+        "owner",
+        "storage_size",
+        "file_versions_to_keep",
+        "file_versions_max_age",
+    )
     readonly_fields = ("storage_size",)
     inlines = (ProjectCollaboratorInline,)
     search_fields = (
@@ -646,6 +656,56 @@ class GeodbAdmin(admin.ModelAdmin):
         super().save_model(request, obj, form, change)
 
 
+class StorageCleanupAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "key",
+        "is_prefix",
+        "status",
+        "deleted_count",
+        "created_at",
+        "updated_at",
+    )
+    list_filter = ("status", "updated_at")
+    actions = ("retry",)
+    exclude = ("output",)
+
+    readonly_fields = (
+        "key",
+        "is_prefix",
+        "status",
+        "deleted_count",
+        "created_at",
+        "updated_at",
+        "started_at",
+        "finished_at",
+        "output__pre",
+    )
+
+    search_fields = ("id", "key__startswith")
+
+    ordering = ("-updated_at",)
+
+    def output__pre(self, instance):
+        return format_pre(instance.output)
+
+    def retry(self, request, queryset):
+        count = queryset.filter(status=StorageCleanup.Status.FAILED).update(
+            status=StorageCleanup.Status.PENDING
+        )
+
+        self.message_user(request, f"{count} failed cleanup(s) will be retried.")
+
+    retry.short_description = "Retry the selected failed cleanups"
+
+    # This will disable add functionality
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 class OrganizationMemberInline(admin.TabularInline):
     model = OrganizationMember
     fk_name = "organization"
@@ -741,6 +801,7 @@ admin.site.register(ApplyJob, ApplyJobAdmin)
 admin.site.register(PackageJob, PackageJobAdmin)
 admin.site.register(ProcessProjectfileJob, ProcessProjectfileJobAdmin)
 admin.site.register(Geodb, GeodbAdmin)
+admin.site.register(StorageCleanup, StorageCleanupAdmin)
 
 admin.site.unregister(Group)
 admin.site.unregister(SocialAccount)
@@ -1,7 +1,13 @@
 import logging
+from datetime import timedelta
 
+from django.db.models import OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django_cron import CronJobBase, Schedule
 from invitations.utils import get_invitation_model
+from qfieldcloud.core.models import Project, StorageCleanup, UserAccount
+from qfieldcloud.core.utils2 import storage
 
 from .invitations_utils import send_invitation
 
@@ -35,3 +41,127 @@ class ResendFailedInvitationsJob(CronJobBase):
         logger.info(
             f'Resend {len(invitation_emails)} previously failed invitation(s) to: {", ".join(invitation_emails)}'
         )
+
+
+class ReconcileStorageUsageJob(CronJobBase):
+    schedule = Schedule(run_every_mins=60 * 24)
+    code = "qfieldcloud.reconcile_storage_usage"
+
+    def do(self):
+        for project in Project.objects.all():
+            try:
+                storage.reconcile_storage_usage(project)
+            except Exception as err:
+                logger.error(err)
+
+        # the owner counters are the sum of their projects' counters
+        owner_projects = (
+            Project.objects.filter(owner=OuterRef("user_id")).order_by().values("owner")
+        )
+        UserAccount.objects.update(
+            storage_bytes=Coalesce(
+                Subquery(owner_projects.annotate(s=Sum("storage_bytes")).values("s")),
+                0,
+            ),
+            storage_objects=Coalesce(
+                Subquery(owner_projects.annotate(s=Sum("storage_objects")).values("s")),
+                0,
+            ),
+        )
+
+
+class PruneFileVersionsJob(CronJobBase):
+    schedule = Schedule(run_every_mins=60 * 24)
+    code = "qfieldcloud.prune_file_versions"
+
+    def do(self):
+        projects = Project.objects.filter(
+            Q(file_versions_to_keep__isnull=False)
+            | Q(file_versions_max_age__isnull=False)
+            | Q(owner__useraccount__file_versions_to_keep__isnull=False)
+            | Q(owner__useraccount__file_versions_max_age__isnull=False)
+        ).select_related("owner__useraccount")
+
+        deleted_count = 0
+        for project in projects:
+            try:
+                deleted_count += storage.prune_file_versions(project)
+            except Exception as err:
+                logger.error(err)
+
+        logger.info(f"Pruned {deleted_count} old project file version(s)")
+
+
+class CollectFileBlobsJob(CronJobBase):
+    schedule = Schedule(run_every_mins=60 * 24)
+    code = "qfieldcloud.collect_file_blobs"
+
+    def do(self):
+        deleted_count = storage.collect_file_blobs()
+
+        logger.info(f"Deleted {deleted_count} unreferenced file blob(s)")
+
+
+class StorageCleanupJob(CronJobBase):
+    schedule = Schedule(run_every_mins=1)
+    code = "qfieldcloud.storage_cleanup"
+
+    # a started cleanup that made no progress for that long is considered interrupted
+    STALLED_AFTER = timedelta(hours=1)
+
+    def do(self):
+        cleanups = StorageCleanup.objects.filter(
+            Q(status=StorageCleanup.Status.PENDING)
+            | Q(
+                status=StorageCleanup.Status.STARTED,
+                updated_at__lt=timezone.now() - self.STALLED_AFTER,
+            )
+        ).order_by("created_at")
+
+        for cleanup in cleanups:
+            # claim the cleanup, another run may have claimed it in the meantime
+            claimed = StorageCleanup.objects.filter(
+                pk=cleanup.pk, status=cleanup.status, updated_at=cleanup.updated_at
+            ).update(
+                status=StorageCleanup.Status.STARTED,
+                started_at=timezone.now(),
+                updated_at=timezone.now(),
+            )
+
+            if not claimed:
+                continue
+
+            try:
+                deleted_count = storage.run_storage_cleanup(cleanup)
+
+                StorageCleanup.objects.filter(pk=cleanup.pk).update(
+                    status=StorageCleanup.Status.FINISHED,
+                    finished_at=timezone.now(),
+                    updated_at=timezone.now(),
+                )
+
+                logger.info(
+                    f'Deleted {deleted_count} object version(s) from "{cleanup.key}"'
+                )
+            except Exception as err:
+                logger.error(err)
+
+                StorageCleanup.objects.filter(pk=cleanup.pk).update(
+                    status=StorageCleanup.Status.FAILED,
+                    output=str(err),
+                    finished_at=timezone.now(),
+                    updated_at=timezone.now(),
+                )
+
+
+class VerifyFileVersionsJob(CronJobBase):
+    schedule = Schedule(run_every_mins=1)
+    code = "qfieldcloud.verify_file_versions"
+
+    def do(self):
+        valid_count, removed_count = storage.verify_file_versions()
+
+        if valid_count or removed_count:
+            logger.info(
+                f"Verified {valid_count} file version(s), removed {removed_count} invalid one(s)"
+            )
@@ -134,6 +134,22 @@ class InvalidJobError(QFieldCloudException):
     status_code = status.HTTP_400_BAD_REQUEST
 
 
+class FileVersionConflictError(QFieldCloudException):
+    """Raised when a file upload is based on a version of the file that is no longer the latest"""
+
+    code = "file_version_conflict"
+    message = "The file has been modified in the meantime"
+    status_code = status.HTTP_409_CONFLICT
+
+
+class StorageOperationNotSupportedError(QFieldCloudException):
+    """Raised when the operation is not supported by the configured storage backend, e.g. presigned uploads with the local backend"""
+
+    code = "storage_operation_not_supported"
+    message = "The operation is not supported by the storage"
+    status_code = status.HTTP_501_NOT_IMPLEMENTED
+
+
 class QGISPackageError(QFieldCloudException):
     """Raised when the QGIS package of a project fails"""
 
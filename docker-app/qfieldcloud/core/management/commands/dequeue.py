@@ -1,19 +1,26 @@
 import logging
 import signal
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
 from django.db.models import Count, Q
 from qfieldcloud.core.models import Job
-from qfieldcloud.core.utils2.db import use_test_db_if_exists
+from qfieldcloud.core.utils2.db import JobsListener, use_test_db_if_exists
+from worker_wrapper.pool import POOL_SIZE, close_pool, get_pool
 from worker_wrapper.wrapper import (
     DeltaApplyJobRun,
     PackageJobRun,
     ProcessProjectfileJobRun,
 )
 
-SECONDS = 5
+# the workers are woken up by the notification sent when a job is created or finished,
+# polling is only a fallback in case a notification is missed, e.g. while reconnecting
+SECONDS = 60
+# NOTE with DEBUG the jobs might be created in a test database that appears at any time, see `use_test_db_if_exists`
+DEBUG_SECONDS = 5
 
 
 class GracefulKiller:
@@ -34,67 +41,127 @@ class Command(BaseCommand):
         parser.add_argument(
             "--single-shot", action="store_true", help="Don't run infinite loop."
         )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Maximum number of jobs run at the same time. Still only one job per project is run at a time.",
+        )
 
     def handle(self, *args, **options):
         logging.info("Dequeue QFieldCloud Jobs from the DB")
+        seconds = DEBUG_SECONDS if settings.DEBUG else SECONDS
+        concurrency = options["concurrency"]
+
+        if concurrency < 1:
+            raise CommandError("The concurrency must be at least 1.")
+
+        # NOTE the QGIS containers read and write the project files with their own S3 client
+        if settings.STORAGE_BACKEND != "s3":
+            raise CommandError(
+                f'The QGIS jobs cannot be run with the "{settings.STORAGE_BACKEND}" storage backend, only with "s3".'
+            )
+
+        # NOTE `use_test_db_if_exists` switches the database of the whole process, which would mix up the running jobs
+        if settings.DEBUG and concurrency > 1:
+            raise CommandError("The concurrency must be 1 with DEBUG.")
+
+        # otherwise the jobs exceeding the pool size would wait for an idle container and eventually fail
+        if 0 < POOL_SIZE < concurrency:
+            raise CommandError(
+                f"The QGIS containers pool size {POOL_SIZE} must be at least the concurrency {concurrency}."
+            )
+
         killer = GracefulKiller()
+        listener = JobsListener()
+        running = set()
+
+        # start the pooled QGIS containers, if enabled, before the first job
+        get_pool()
 
-        while killer.alive:
-            with use_test_db_if_exists():
+        # NOTE leaving the executor waits for the running jobs to finish, also when killed
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while killer.alive:
+                running = {f for f in running if not f.done()}
                 queued_job = None
 
-                with transaction.atomic():
-
-                    busy_projects_ids_qs = (
-                        Job.objects.filter(
-                            status=Job.Status.PENDING,
-                        )
-                        .annotate(
-                            active_jobs_count=Count(
-                                "project__jobs",
-                                filter=Q(
-                                    project__jobs__status__in=[
-                                        Job.Status.QUEUED,
-                                        Job.Status.STARTED,
-                                    ]
-                                ),
-                            )
-                        )
-                        .filter(active_jobs_count__gt=0)
-                        .values("active_jobs_count", "project_id")
-                    )
+                if len(running) < concurrency:
+                    with use_test_db_if_exists():
+                        queued_job = self._dequeue()
+
+                if queued_job:
+                    running.add(executor.submit(self._run_in_thread, queued_job))
 
-                    busy_project_ids = [j["project_id"] for j in busy_projects_ids_qs]
+                    if not options["single_shot"] or len(running) < concurrency:
+                        continue
 
-                    # select all the pending jobs, that their project has no other active job
-                    jobs_qs = (
-                        Job.objects.select_for_update(skip_locked=True)
-                        .filter(status=Job.Status.PENDING)
-                        .exclude(project_id__in=busy_project_ids)
+                if options["single_shot"]:
+                    break
+
+                # NOTE wait in 1 second steps to stop quickly when killed
+                for _i in range(seconds):
+                    if (
+                        not killer.alive
+                        or listener.wait(1)
+                        or any(f.done() for f in running)
+                    ):
+                        break
+
+        listener.close()
+        close_pool()
+
+    def _dequeue(self) -> Optional[Job]:
+        """Marks as queued the first pending job whose project has no other active job and returns it."""
+        with transaction.atomic():
+
+            busy_projects_ids_qs = (
+                Job.objects.filter(
+                    status=Job.Status.PENDING,
+                )
+                .annotate(
+                    active_jobs_count=Count(
+                        "project__jobs",
+                        filter=Q(
+                            project__jobs__status__in=[
+                                Job.Status.QUEUED,
+                                Job.Status.STARTED,
+                            ]
+                        ),
                     )
+                )
+                .filter(active_jobs_count__gt=0)
+                .values("active_jobs_count", "project_id")
+            )
 
-                    for job in jobs_qs:
-                        queued_job = job
+            busy_project_ids = [j["project_id"] for j in busy_projects_ids_qs]
 
-                        logging.info(f"Dequeued job {job.id}, run!")
+            # select all the pending jobs, that their project has no other active job
+            jobs_qs = (
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(status=Job.Status.PENDING)
+                .exclude(project_id__in=busy_project_ids)
+                .order_by("created_at")
+            )
 
-                        job.status = Job.Status.QUEUED
-                        job.save()
-                        break
+            for job in jobs_qs:
+                logging.info(f"Dequeued job {job.id}, run!")
 
-                if queued_job:
-                    self._run(queued_job)
-                    queued_job = None
-                else:
-                    if options["single_shot"]:
-                        break
+                # the project is busy from now on, so its other jobs are not dequeued meanwhile
+                job.status = Job.Status.QUEUED
+                job.save()
+
+                return job
 
-                    for _i in range(SECONDS):
-                        if killer.alive:
-                            sleep(1)
+        return None
 
-            if options["single_shot"]:
-                break
+    def _run_in_thread(self, job: Job) -> None:
+        try:
+            self._run(job)
+        except Exception:
+            logging.exception(f"Failed to run job {job.id}")
+        finally:
+            # each thread has its own database connections
+            connections.close_all()
 
     def run(self, job_id, *args, **options):
         try:
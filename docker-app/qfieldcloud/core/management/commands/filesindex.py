@@ -0,0 +1,86 @@
+from pathlib import PurePath
+
+from django.core.management.base import BaseCommand
+from qfieldcloud.core.models import ProcessProjectfileJob, Project
+from qfieldcloud.core.utils2 import storage
+
+
+class Command(BaseCommand):
+    help = """
+        Verify or rebuild the project files index against the storage,
+        including the QGIS project file of each project.
+        Usage: python manage.py filesindex verify --project-id=<uuid>
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["verify", "rebuild"])
+        parser.add_argument(
+            "--project-id",
+            type=str,
+            help="Only check the given project. By default all projects are checked.",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["action"] == "verify"
+        projects = Project.objects.all()
+
+        if options.get("project_id"):
+            projects = projects.filter(id=options["project_id"])
+
+        out_of_sync_count = 0
+        for project in projects:
+            missing, extra = storage.sync_file_versions(project, dry_run=dry_run)
+
+            # NOTE when verifying, the project file is looked up in the index as it is now, not as it would be once rebuilt
+            project_filename = storage.get_project_filename(project)
+            is_project_filename_in_sync = self._is_same_filename(
+                project.project_filename, project_filename
+            )
+
+            if not missing and not extra and is_project_filename_in_sync:
+                continue
+
+            out_of_sync_count += 1
+            self.stdout.write(f"Project {project.id} ({project.name}):")
+
+            for name, version_id in missing:
+                self.stdout.write(f"  missing in the index: {name} ({version_id})")
+
+            for name, version_id in extra:
+                self.stdout.write(f"  missing on the storage: {name} ({version_id})")
+
+            if not is_project_filename_in_sync:
+                self.stdout.write(
+                    f"  project file is {project.project_filename}, expected {project_filename}"
+                )
+
+                if not dry_run:
+                    project.project_filename = project_filename
+                    project.save(update_fields=["project_filename"])
+
+                    # the project details are outdated too
+                    if project_filename:
+                        ProcessProjectfileJob.objects.create(
+                            project=project, created_by=project.owner
+                        )
+
+        if out_of_sync_count == 0:
+            self.stdout.write(self.style.SUCCESS("The files index is in sync."))
+        elif dry_run:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"The files index of {out_of_sync_count} project(s) is out of sync, run `filesindex rebuild` to fix it."
+                )
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"The files index of {out_of_sync_count} project(s) has been rebuilt."
+                )
+            )
+
+    def _is_same_filename(self, filename1, filename2) -> bool:
+        if filename1 is None or filename2 is None:
+            return filename1 == filename2
+
+        return PurePath(filename1) == PurePath(filename2)
@@ -1,6 +1,6 @@
-from django.conf import settings
 from django.core.management.base import BaseCommand
 from qfieldcloud.core import geodb_utils, utils
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 
 
 class Command(BaseCommand):
@@ -20,11 +20,8 @@ class Command(BaseCommand):
             results["geodb"] = "error"
 
         results["storage"] = "ok"
-        # Check if bucket exists (i.e. the connection works)
-        try:
-            s3_client = utils.get_s3_client()
-            s3_client.head_bucket(Bucket=settings.STORAGE_BUCKET_NAME)
-        except Exception:
+        # Check if the storage can be reached (e.g. the bucket exists)
+        if not get_storage_backend().is_available():
             results["storage"] = "error"
 
         self.stdout.write(
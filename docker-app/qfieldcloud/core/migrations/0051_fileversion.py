@@ -0,0 +1,97 @@
+# Generated by Django 3.2.25 on 2026-10-17 23:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+from qfieldcloud.core import utils
+
+
+def fill_in_file_versions(apps, schema_editor):
+    Project = apps.get_model("core", "Project")
+    FileVersion = apps.get_model("core", "FileVersion")
+
+    bucket = utils.get_s3_bucket()
+
+    for project in Project.objects.all():
+        prefix = f"projects/{project.id}/files/"
+        versions = [
+            v for v in utils.list_versions(bucket, prefix) if not v.is_delete_marker
+        ]
+        sha256sums = utils.get_sha256sums((v.key, v.id) for v in versions)
+
+        file_versions = []
+        for version in versions:
+            file_versions.append(
+                FileVersion(
+                    project=project,
+                    name=version.name,
+                    version_id=version.id,
+                    size=version.size,
+                    sha256=sha256sums[(version.key, version.id)],
+                    last_modified=version.last_modified,
+                    is_latest=version.is_latest,
+                )
+            )
+
+        FileVersion.objects.bulk_create(file_versions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0050_auto_20211118_1150"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="packagejob",
+            options={
+                "verbose_name": "Job: package",
+                "verbose_name_plural": "Jobs: package",
+            },
+        ),
+        migrations.CreateModel(
+            name="FileVersion",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.TextField()),
+                ("version_id", models.CharField(max_length=255)),
+                ("size", models.BigIntegerField()),
+                ("sha256", models.CharField(max_length=64, null=True)),
+                ("last_modified", models.DateTimeField()),
+                ("is_latest", models.BooleanField(default=False)),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="file_versions",
+                        to="core.project",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["project", "name", "-last_modified"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="fileversion",
+            index=models.Index(
+                fields=["project", "is_latest"], name="core_fileve_project_0a918a_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="fileversion",
+            constraint=models.UniqueConstraint(
+                fields=("project", "name", "version_id"),
+                name="fileversion_project_name_version_uniq",
+            ),
+        ),
+        migrations.RunPython(fill_in_file_versions, migrations.RunPython.noop),
+    ]
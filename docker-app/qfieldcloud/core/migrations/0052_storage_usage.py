@@ -0,0 +1,71 @@
+# Generated by Django 3.2.25 on 2026-10-17 23:16
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from qfieldcloud.core import utils
+
+
+def fill_in_storage_usage(apps, schema_editor):
+    Project = apps.get_model("core", "Project")
+    UserAccount = apps.get_model("core", "UserAccount")
+
+    bucket = utils.get_s3_bucket()
+
+    for project in Project.objects.all():
+        storage_bytes = 0
+        storage_objects = 0
+
+        for version in utils.list_versions(bucket, f"projects/{project.id}/"):
+            if version.is_delete_marker:
+                continue
+
+            storage_bytes += version.size
+            storage_objects += 1
+
+        Project.objects.filter(pk=project.pk).update(
+            storage_bytes=storage_bytes, storage_objects=storage_objects
+        )
+
+    owner_projects = (
+        Project.objects.filter(owner=OuterRef("user_id")).order_by().values("owner")
+    )
+    UserAccount.objects.update(
+        storage_bytes=Coalesce(
+            Subquery(owner_projects.annotate(s=Sum("storage_bytes")).values("s")), 0
+        ),
+        storage_objects=Coalesce(
+            Subquery(owner_projects.annotate(s=Sum("storage_objects")).values("s")), 0
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0051_fileversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="storage_bytes",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="project",
+            name="storage_objects",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="useraccount",
+            name="storage_bytes",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="useraccount",
+            name="storage_objects",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_in_storage_usage, migrations.RunPython.noop),
+    ]
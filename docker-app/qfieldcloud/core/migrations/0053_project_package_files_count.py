@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-17 23:48
+
+from django.db import migrations, models
+from qfieldcloud.core import utils
+
+
+def fill_in_package_files_count(apps, schema_editor):
+    Project = apps.get_model("core", "Project")
+
+    bucket = utils.get_s3_bucket()
+
+    for project in Project.objects.all():
+        package_files_count = len(
+            list(bucket.objects.filter(Prefix=f"projects/{project.id}/export/"))
+        )
+
+        Project.objects.filter(pk=project.pk).update(
+            package_files_count=package_files_count
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0052_storage_usage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="package_files_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_in_package_files_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 23:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0055_fileblob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fileversion",
+            name="block_sha256s",
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="fileversion",
+            name="block_size",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
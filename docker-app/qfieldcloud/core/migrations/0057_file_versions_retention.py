@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-17 23:31
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0056_fileversion_block_sha256s"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="file_versions_max_age",
+            field=models.DurationField(
+                blank=True,
+                help_text="Older versions of the project files are deleted, except the latest. Use the owner's setting if empty.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="project",
+            name="file_versions_to_keep",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Maximum number of versions kept for each project file, including the latest. Use the owner's setting if empty.",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="useraccount",
+            name="file_versions_max_age",
+            field=models.DurationField(
+                blank=True,
+                help_text="Older versions of the project files are deleted, except the latest. Keep all versions if empty.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="useraccount",
+            name="file_versions_to_keep",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Maximum number of versions kept for each project file, including the latest. Keep all versions if empty.",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+    ]
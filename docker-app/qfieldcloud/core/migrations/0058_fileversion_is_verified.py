@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0057_file_versions_retention"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fileversion",
+            name="is_verified",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name="fileversion",
+            index=models.Index(
+                condition=models.Q(("is_verified", False)),
+                fields=["is_verified"],
+                name="fileversion_unverified_idx",
+            ),
+        ),
+    ]
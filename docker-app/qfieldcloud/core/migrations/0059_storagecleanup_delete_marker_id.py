@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0058_fileversion_is_verified"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="storagecleanup",
+            name="delete_marker_id",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
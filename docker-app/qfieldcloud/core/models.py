@@ -2,16 +2,16 @@ import os
 import secrets
 import string
 import uuid
-from datetime import timedelta
+from datetime import datetime, timedelta
 from enum import Enum
-from typing import Any, Iterable, Type
+from typing import Any, Iterable, List, NamedTuple, Optional, Tuple, Type
 
 import qfieldcloud.core.utils2.storage
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.core.exceptions import ValidationError
-from django.core.validators import RegexValidator
+from django.core.validators import MinValueValidator, RegexValidator
 from django.db import models
-from django.db.models import Case, Exists, OuterRef, Q
+from django.db.models import Case, Exists, F, OuterRef, Q
 from django.db.models import Value as V
 from django.db.models import When
 from django.db.models.aggregates import Count
@@ -22,7 +22,9 @@ from django.urls import reverse_lazy
 from django.utils.translation import gettext as _
 from model_utils.managers import InheritanceManager
 from qfieldcloud.core import geodb_utils, utils, validators
-from qfieldcloud.core.utils import get_s3_object_url
+from qfieldcloud.core.utils2.caching import invalidate_project_cache
+from qfieldcloud.core.utils2.db import notify_jobs_changed
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 from timezone_field import TimeZoneField
 
 # http://springmeblog.com/2018/how-to-implement-multiple-user-types-with-django/
@@ -360,6 +362,41 @@ class User(AbstractUser):
         return hasattr(self, "geodb")
 
 
+class StorageUsageModel(models.Model):
+    """Abstract model with counters of the objects stored on the storage and their size, including all the versions.
+
+    The counters are only changed atomically using `F()` expressions, see `utils2.storage.update_storage_usage`,
+    therefore `save()` never writes them from the possibly stale values of the instance.
+    """
+
+    STORAGE_USAGE_FIELDS = ("storage_bytes", "storage_objects")
+
+    storage_bytes = models.BigIntegerField(default=0, editable=False)
+    storage_objects = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if (
+            not self._state.adding
+            and not kwargs.get("force_insert")
+            and kwargs.get("update_fields") is None
+        ):
+            kwargs["update_fields"] = [
+                f.name
+                for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.STORAGE_USAGE_FIELDS
+            ]
+
+        super().save(*args, **kwargs)
+
+    @property
+    def storage_size(self) -> float:
+        """Returns the storage usage in MiB"""
+        return round(self.storage_bytes / (1024 * 1024), 3)
+
+
 # Automatically create a UserAccount instance when a user is created.
 @receiver(post_save, sender=User)
 def create_account_for_user(sender, instance, created, **kwargs):
@@ -367,7 +404,7 @@ def create_account_for_user(sender, instance, created, **kwargs):
         UserAccount.objects.create(user=instance)
 
 
-class UserAccount(models.Model):
+class UserAccount(StorageUsageModel):
     TYPE_COMMUNITY = 1
     TYPE_PRO = 2
 
@@ -415,11 +452,27 @@ class UserAccount(models.Model):
         null=True,
         blank=True,
     )
+    # the default retention of the old versions of the project files, see `Project.file_versions_retention`
+    file_versions_to_keep = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text=_(
+            "Maximum number of versions kept for each project file, including the latest. Keep all versions if empty."
+        ),
+    )
+    file_versions_max_age = models.DurationField(
+        null=True,
+        blank=True,
+        help_text=_(
+            "Older versions of the project files are deleted, except the latest. Keep all versions if empty."
+        ),
+    )
 
     @property
     def avatar_url(self):
         if self.avatar_uri:
-            return get_s3_object_url(self.avatar_uri)
+            return get_storage_backend().get_public_url(self.avatar_uri)
         else:
             return None
 
@@ -813,13 +866,17 @@ class ProjectQueryset(models.QuerySet):
         return qs
 
 
-class Project(models.Model):
+class Project(StorageUsageModel):
     """Represent a QFieldcloud project.
     It corresponds to a directory on the file system.
 
     The owner of a project is an Organization.
     """
 
+    STORAGE_USAGE_FIELDS = StorageUsageModel.STORAGE_USAGE_FIELDS + (
+        "package_files_count",
+    )
+
     objects = ProjectQueryset.as_manager()
     _cache_files_count = None
 
@@ -871,6 +928,8 @@ class Project(models.Model):
     # NOTE we can track only the file based layers, WFS, WMS, PostGIS etc are impossible to track
     data_last_updated_at = models.DateTimeField(blank=True, null=True)
     data_last_packaged_at = models.DateTimeField(blank=True, null=True)
+    # NOTE recounted from the storage with the storage usage counters, which is done after each package job
+    package_files_count = models.IntegerField(default=0, editable=False)
 
     overwrite_conflicts = models.BooleanField(
         default=True,
@@ -881,11 +940,26 @@ class Project(models.Model):
     thumbnail_uri = models.CharField(
         _("Thumbnail Picture URI"), max_length=255, blank=True
     )
+    file_versions_to_keep = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text=_(
+            "Maximum number of versions kept for each project file, including the latest. Use the owner's setting if empty."
+        ),
+    )
+    file_versions_max_age = models.DurationField(
+        null=True,
+        blank=True,
+        help_text=_(
+            "Older versions of the project files are deleted, except the latest. Use the owner's setting if empty."
+        ),
+    )
 
     @property
     def thumbnail_url(self):
         if self.thumbnail_uri:
-            return get_s3_object_url(self.thumbnail_uri)
+            return get_storage_backend().get_public_url(self.thumbnail_uri)
         else:
             return None
 
@@ -898,25 +972,56 @@ class Project(models.Model):
     def __str__(self):
         return self.name + " (" + str(self.id) + ")" + " owner: " + self.owner.username
 
-    def storage_size(self):
-        return utils.get_s3_project_size(self.id)
-
     @property
     def private(self):
         # still used in the project serializer
         return not self.is_public
 
     @property
-    def files(self) -> Iterable[utils.S3ObjectWithVersions]:
-        return utils.get_project_files_with_versions(self.id)
+    def files(self) -> Iterable["FileWithVersions"]:
+        """Returns the project files with their versions, as stored in the files index."""
+        latest = None
+        versions = []
+
+        for version in self.file_versions.order_by("name", "-last_modified"):
+            if versions and versions[0].name != version.name:
+                if latest:
+                    yield FileWithVersions(latest, versions)
+
+                latest = None
+                versions = []
+
+            versions.append(version)
+
+            if version.is_latest:
+                latest = version
+
+        if latest:
+            yield FileWithVersions(latest, versions)
 
     @property
     def files_count(self):
         if self._cache_files_count is None:
-            self._cache_files_count = utils.get_project_files_count(self.id)
+            self._cache_files_count = self.file_versions.filter(is_latest=True).count()
 
         return self._cache_files_count
 
+    @property
+    def file_versions_retention(self) -> Tuple[Optional[int], Optional[timedelta]]:
+        """Returns the maximum number of versions kept for each file and their maximum age,
+        either set on the project or inherited from the owner's account. `None` means no limit."""
+        account = self.owner.useraccount
+        to_keep = self.file_versions_to_keep
+        max_age = self.file_versions_max_age
+
+        if to_keep is None:
+            to_keep = account.file_versions_to_keep
+
+        if max_age is None:
+            max_age = account.file_versions_max_age
+
+        return to_keep, max_age
+
     @property
     def users(self):
         return User.objects.for_project(self)
@@ -958,8 +1063,181 @@ class Project(models.Model):
 
 @receiver(pre_delete, sender=Project)
 def delete_project(sender: Type[Project], instance: Project, **kwargs: Any) -> None:
-    if instance.thumbnail_uri:
-        qfieldcloud.core.utils2.storage.remove_project_thumbail(instance)
+    # all the project objects on the storage, including the thumbnail, are deleted in the background
+    StorageCleanup.objects.create(key=f"projects/{instance.id}/", is_prefix=True)
+
+    # the storage usage of the project no longer counts for the owner
+    storage_bytes, storage_objects = Project.objects.filter(pk=instance.pk).values_list(
+        "storage_bytes", "storage_objects"
+    )[0]
+    UserAccount.objects.filter(user_id=instance.owner_id).update(
+        storage_bytes=F("storage_bytes") - storage_bytes,
+        storage_objects=F("storage_objects") - storage_objects,
+    )
+
+
+class FileBlob(models.Model):
+    """File contents stored once under `blobs/<sha256>` when `STORAGE_DEDUPLICATE_FILES` is enabled.
+
+    Blobs are only created from contents hashed by the server, never from a client declared hashcode.
+    The blobs no longer referenced by any file version are deleted by `cron.CollectFileBlobsJob`.
+    """
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def key(self) -> str:
+        return f"blobs/{self.sha256}"
+
+    def __str__(self):
+        return self.sha256
+
+
+class FileVersion(models.Model):
+    """Index of the project file versions stored under `projects/<projectid>/files/`.
+
+    The index is kept in sync on file upload and delete and after the jobs that upload files,
+    so listing the project files does not require listing the object versions on the storage.
+    Use the `filesindex` management command to verify or rebuild the index.
+
+    When the version references a `blob`, its contents are stored in the blob instead
+    and the `version_id` is generated by QFieldCloud.
+    """
+
+    class Meta:
+        ordering = ["project", "name", "-last_modified"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["project", "name", "version_id"],
+                name="fileversion_project_name_version_uniq",
+            )
+        ]
+        indexes = [
+            models.Index(fields=["project", "is_latest"]),
+            # only the few versions waiting to be verified are indexed
+            models.Index(
+                fields=["is_verified"],
+                condition=Q(is_verified=False),
+                name="fileversion_unverified_idx",
+            ),
+        ]
+
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name="file_versions",
+    )
+    # the filename relative to the project files directory, e.g. `foo/bar/project.qgs`
+    name = models.TextField()
+    version_id = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, null=True)
+    last_modified = models.DateTimeField()
+    is_latest = models.BooleanField(default=False)
+    blob = models.ForeignKey(
+        FileBlob,
+        on_delete=models.PROTECT,
+        related_name="file_versions",
+        null=True,
+        blank=True,
+    )
+    # the sha256 hashcodes of the consecutive blocks of `block_size` bytes, computed when first needed
+    block_size = models.IntegerField(null=True, blank=True)
+    block_sha256s = JSONField(null=True, blank=True)
+    # whether `sha256` has been checked against the stored contents, otherwise it is the one declared by the client,
+    # see `storage.verify_file_versions`
+    is_verified = models.BooleanField(default=True)
+
+    @property
+    def key(self) -> str:
+        """Returns the storage key of the version contents."""
+        if self.blob_id:
+            return f"blobs/{self.blob_id}"
+
+        return utils.safe_join(f"projects/{self.project_id}/files/", self.name)
+
+    def __str__(self):
+        return f"{self.name} ({self.version_id}), project: {self.project_id}"
+
+
+class FileWithVersions(NamedTuple):
+    latest: FileVersion
+    versions: List[FileVersion]
+
+
+class StorageCleanup(models.Model):
+    """Object versions to be deleted from the storage in the background, see `cron.StorageCleanupJob`.
+
+    Deleting all the versions of a large project takes too long for the request/response cycle,
+    therefore the database records are deleted right away and the storage objects later.
+    The cleanup of a single object deletes only its `delete_marker_id` version and the versions modified before it,
+    so a file uploaded again in the meantime is kept. The cleanup of a prefix deletes all the versions under it.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        STARTED = "started", _("Started")
+        FINISHED = "finished", _("Finished")
+        FAILED = "failed", _("Failed")
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # either a single object key or a prefix, e.g. `projects/<projectid>/`
+    key = models.TextField()
+    is_prefix = models.BooleanField(default=False)
+    # the version id of the delete marker that hid the object, see `StorageBackend.delete_object`
+    delete_marker_id = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(
+        max_length=32, choices=Status.choices, default=Status.PENDING
+    )
+    deleted_count = models.IntegerField(default=0)
+    output = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(blank=True, null=True, editable=False)
+    finished_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    def covers(
+        self,
+        key: str,
+        version_id: str,
+        last_modified: datetime,
+        delete_marker_last_modified: Optional[datetime] = None,
+    ) -> bool:
+        """Returns whether the object version is to be deleted.
+
+        NOTE the app and the storage clocks are not comparable, so the versions of a single object are compared
+        with the modification time of the delete marker. The versions modified at the same time are kept,
+        as they could have been uploaded right after the delete.
+
+        Args:
+            key (str): the object key
+            version_id (str): the version id
+            last_modified (datetime): the modification time of the version
+            delete_marker_last_modified (datetime, optional): the modification time of the `delete_marker_id` version,
+                None if it is not stored anymore. Defaults to None.
+        """
+        if self.is_prefix:
+            return key.startswith(self.key)
+
+        if key != self.key:
+            return False
+
+        if self.delete_marker_id:
+            if version_id == self.delete_marker_id:
+                return True
+
+            return (
+                delete_marker_last_modified is not None
+                and last_modified < delete_marker_last_modified
+            )
+
+        # the cleanups created before the delete marker ids were stored
+        return last_modified < self.created_at
+
+    def __str__(self):
+        return f"{self.key}{'*' if self.is_prefix else ''} ({self.status})"
 
 
 class ProjectCollaborator(models.Model):
@@ -1178,6 +1456,38 @@ class ApplyJob(Job):
         verbose_name_plural = "Jobs: apply"
 
 
+@receiver(post_save, sender=Project)
+@receiver(post_save, sender=PackageJob)
+@receiver(post_save, sender=ProcessProjectfileJob)
+@receiver(post_save, sender=ApplyJob)
+@receiver(post_delete, sender=PackageJob)
+@receiver(post_delete, sender=ProcessProjectfileJob)
+@receiver(post_delete, sender=ApplyJob)
+def invalidate_project_responses(
+    sender: Type[models.Model], instance: models.Model, **kwargs: Any
+) -> None:
+    # the cached responses show the project and its jobs, see `qfieldcloud.core.utils2.caching`
+    if isinstance(instance, Project):
+        invalidate_project_cache(instance.id)
+    else:
+        invalidate_project_cache(instance.project_id)
+
+
+@receiver(post_save, sender=PackageJob)
+@receiver(post_save, sender=ProcessProjectfileJob)
+@receiver(post_save, sender=ApplyJob)
+def notify_workers(
+    sender: Type[Job], instance: Job, created: bool, **kwargs: Any
+) -> None:
+    # a new job is pending, or a finished job lets the other jobs of its project run, see the `dequeue` command
+    if created or instance.status in (
+        Job.Status.FINISHED,
+        Job.Status.STOPPED,
+        Job.Status.FAILED,
+    ):
+        notify_jobs_changed()
+
+
 class ApplyJobDelta(models.Model):
     apply_job = models.ForeignKey(ApplyJob, on_delete=models.CASCADE)
     delta = models.ForeignKey(Delta, on_delete=models.CASCADE)
@@ -0,0 +1,102 @@
+import logging
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
+from qfieldcloud.core.management.commands import dequeue
+from qfieldcloud.core.models import Job, PackageJob, Project, User
+
+logging.disable(logging.CRITICAL)
+
+
+class DequeueStartupTestCase(SimpleTestCase):
+    @override_settings(STORAGE_BACKEND="local")
+    def test_refuses_local_storage_backend(self):
+        with self.assertRaisesRegex(CommandError, "storage backend"):
+            call_command("dequeue", "--single-shot")
+
+    def test_refuses_invalid_concurrency(self):
+        with self.assertRaisesRegex(CommandError, "at least 1"):
+            call_command("dequeue", "--single-shot", "--concurrency", "0")
+
+    @override_settings(DEBUG=True)
+    def test_refuses_concurrency_with_debug(self):
+        with self.assertRaisesRegex(CommandError, "DEBUG"):
+            call_command("dequeue", "--single-shot", "--concurrency", "2")
+
+    @mock.patch.object(dequeue, "POOL_SIZE", 2)
+    def test_refuses_pool_smaller_than_concurrency(self):
+        with self.assertRaisesRegex(CommandError, "pool size 2"):
+            call_command("dequeue", "--single-shot", "--concurrency", "3")
+
+
+@mock.patch.object(dequeue, "POOL_SIZE", 0)
+@mock.patch.object(dequeue, "get_pool", mock.Mock())
+@mock.patch.object(dequeue, "close_pool", mock.Mock())
+@mock.patch.object(dequeue, "GracefulKiller", mock.Mock())
+class DequeueTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="abc123")
+        self.project1 = Project.objects.create(name="project1", owner=self.user1)
+        self.project2 = Project.objects.create(name="project2", owner=self.user1)
+        self.project3 = Project.objects.create(name="project3", owner=self.user1)
+
+    def create_job(self, project: Project) -> Job:
+        return PackageJob.objects.create(project=project, created_by=self.user1)
+
+    def call_dequeue(self, *args) -> list:
+        """Calls the command and returns the ids of the run jobs, which are not actually run."""
+        run_job_ids = []
+
+        with mock.patch.object(
+            dequeue.Command, "_run", lambda _self, job: run_job_ids.append(job.id)
+        ):
+            call_command("dequeue", "--single-shot", *args)
+
+        return run_job_ids
+
+    def test_one_active_job_per_project(self):
+        job1 = self.create_job(self.project1)
+        job2 = self.create_job(self.project1)
+        job3 = self.create_job(self.project2)
+
+        command = dequeue.Command()
+
+        self.assertEqual(command._dequeue().id, job1.id)
+        # the other job of the project waits for the first one to finish
+        self.assertEqual(command._dequeue().id, job3.id)
+        self.assertIsNone(command._dequeue())
+
+        job2.refresh_from_db()
+        self.assertEqual(job2.status, Job.Status.PENDING)
+
+        Job.objects.filter(pk=job1.pk).update(status=Job.Status.FINISHED)
+        self.assertEqual(command._dequeue().id, job2.id)
+
+    def test_single_shot_runs_up_to_the_concurrency(self):
+        job1 = self.create_job(self.project1)
+        job2 = self.create_job(self.project2)
+        job3 = self.create_job(self.project3)
+
+        # the oldest jobs are run first
+        self.assertCountEqual(
+            self.call_dequeue("--concurrency", "2"), [job1.id, job2.id]
+        )
+
+        job3.refresh_from_db()
+        self.assertEqual(job3.status, Job.Status.PENDING)
+
+        # the remaining job is run by the next call
+        self.assertEqual(self.call_dequeue("--concurrency", "2"), [job3.id])
+        self.assertEqual(self.call_dequeue("--concurrency", "2"), [])
+
+    def test_single_shot_skips_busy_projects(self):
+        job1 = self.create_job(self.project1)
+        self.create_job(self.project1)
+        job3 = self.create_job(self.project2)
+
+        # the second job of the first project is not run meanwhile, even though the concurrency allows it
+        self.assertCountEqual(
+            self.call_dequeue("--concurrency", "3"), [job1.id, job3.id]
+        )
@@ -0,0 +1,175 @@
+import logging
+import uuid
+
+from django.test import SimpleTestCase
+from django_redis import get_redis_connection
+from qfieldcloud.authentication.models import AuthToken
+from qfieldcloud.core.models import Job, PackageJob, Project, User
+from qfieldcloud.core.utils2 import job_logs
+from qfieldcloud.core.utils2.job_logs import JobLogWriter, read_job_logs
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+logging.disable(logging.CRITICAL)
+
+
+class JobLogsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.job_id = uuid.uuid4()
+
+    def tearDown(self):
+        get_redis_connection("default").delete(
+            job_logs._get_output_key(self.job_id),
+            job_logs._get_state_key(self.job_id),
+        )
+
+    def test_read_logs_incrementally(self):
+        self.assertIsNone(read_job_logs(self.job_id))
+
+        writer = JobLogWriter(self.job_id)
+        writer.write(b"starting\n::<<<::abc Download Pro")
+        writer.write(b"ject Directory\n")
+
+        logs = read_job_logs(self.job_id)
+        self.assertEqual(
+            logs["output"], "starting\n::<<<::abc Download Project Directory\n"
+        )
+        self.assertEqual(
+            logs["steps"],
+            [
+                {
+                    "id": "abc",
+                    "name": "Download Project Directory",
+                    "stage": 1,
+                    "is_running": True,
+                }
+            ],
+        )
+        self.assertFalse(logs["is_finished"])
+
+        # the multibyte characters might be split between the writes
+        writer.write("café\n".encode()[:4])
+        writer.write("café\n".encode()[4:] + b"::>>>::abc 2\n")
+        writer.close()
+
+        logs = read_job_logs(self.job_id, logs["cursor"])
+        self.assertEqual(logs["output"], "café\n::>>>::abc 2\n")
+        self.assertEqual(logs["steps"][0]["stage"], 2)
+        self.assertFalse(logs["steps"][0]["is_running"])
+        self.assertTrue(logs["is_finished"])
+
+        logs = read_job_logs(self.job_id, logs["cursor"])
+        self.assertEqual(logs["output"], "")
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            read_job_logs(self.job_id, "abc")
+
+
+class JobLogsApiTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="abc123")
+        self.token1 = AuthToken.objects.get_or_create(user=self.user1)[0]
+        self.user2 = User.objects.create_user(username="user2", password="abc123")
+        self.token2 = AuthToken.objects.get_or_create(user=self.user2)[0]
+
+        self.project1 = Project.objects.create(
+            name="project1", is_public=False, owner=self.user1
+        )
+        self.job = PackageJob.objects.create(
+            project=self.project1, created_by=self.user1
+        )
+
+    def tearDown(self):
+        get_redis_connection("default").delete(
+            job_logs._get_output_key(self.job.id),
+            job_logs._get_state_key(self.job.id),
+        )
+
+    def get_logs(self, token, cursor=None):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+        return self.client.get(
+            f"/api/v1/jobs/{self.job.id}/logs/",
+            {"cursor": cursor} if cursor else {},
+        )
+
+    def test_running_job(self):
+        writer = JobLogWriter(self.job.id)
+        # the started steps are stored right away
+        writer.write(b"starting\n::<<<::abc Download Project Directory\n")
+
+        response = self.get_logs(self.token1)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()["output"],
+            "starting\n::<<<::abc Download Project Directory\n",
+        )
+        self.assertEqual(response.json()["steps"][0]["id"], "abc")
+        self.assertTrue(response.json()["steps"][0]["is_running"])
+        self.assertFalse(response.json()["is_finished"])
+
+        writer.write(b"done\n")
+        writer.close()
+
+        response = self.get_logs(self.token1, response.json()["cursor"])
+
+        self.assertEqual(response.json()["output"], "done\n")
+        self.assertTrue(response.json()["is_finished"])
+
+    def test_not_a_collaborator(self):
+        response = self.get_logs(self.token2)
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalid_cursor(self):
+        response = self.get_logs(self.token1, "abc")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pending_job(self):
+        response = self.get_logs(self.token1)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {"output": "", "cursor": None, "steps": [], "is_finished": False},
+        )
+
+    def test_finished_job_without_stored_logs(self):
+        self.job.status = Job.Status.FINISHED
+        self.job.output = "the whole output\n"
+        self.job.feedback = {
+            "steps": [
+                {"id": "abc", "name": "Download Project Directory", "stage": 2},
+            ]
+        }
+        self.job.save()
+
+        # the logs are read from the job once not stored in Redis anymore
+        response = self.get_logs(self.token1)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "output": "the whole output\n",
+                "cursor": None,
+                "steps": [
+                    {
+                        "id": "abc",
+                        "name": "Download Project Directory",
+                        "stage": 2,
+                        "is_running": False,
+                    }
+                ],
+                "is_finished": True,
+            },
+        )
+
+        # the output has already been read by the client which has a cursor
+        response = self.get_logs(self.token1, "1-0")
+
+        self.assertEqual(response.json()["output"], "")
+        self.assertEqual(response.json()["cursor"], "1-0")
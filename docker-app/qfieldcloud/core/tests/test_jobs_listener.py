@@ -0,0 +1,104 @@
+import logging
+from unittest import mock
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from qfieldcloud.core import models
+from qfieldcloud.core.models import Job, PackageJob, Project, User
+from qfieldcloud.core.utils2 import db
+from qfieldcloud.core.utils2.db import JobsListener, notify_jobs_changed
+
+logging.disable(logging.CRITICAL)
+
+
+class NotifyWorkersTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create_user(username="user1", password="abc123")
+        self.project1 = Project.objects.create(name="project1", owner=self.user1)
+
+    def test_notified_when_a_job_is_created_or_finished(self):
+        with mock.patch.object(models, "notify_jobs_changed") as notify:
+            job = PackageJob.objects.create(
+                project=self.project1, created_by=self.user1
+            )
+            self.assertEqual(notify.call_count, 1)
+
+            # the running jobs do not change what can be dequeued
+            for status in (Job.Status.QUEUED, Job.Status.STARTED):
+                job.status = status
+                job.save()
+
+            self.assertEqual(notify.call_count, 1)
+
+            for status in (Job.Status.FINISHED, Job.Status.FAILED):
+                job.status = status
+                job.save()
+
+            self.assertEqual(notify.call_count, 3)
+
+
+class JobsListenerTestCase(TransactionTestCase):
+    def setUp(self):
+        self.listener = JobsListener()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_notified_on_commit(self):
+        # the notifications sent before listening are lost, so the jobs are checked right away
+        self.assertTrue(self.listener.wait(1))
+        self.assertFalse(self.listener.wait(0.1))
+
+        with transaction.atomic():
+            notify_jobs_changed()
+
+            self.assertFalse(self.listener.wait(0.1))
+
+        self.assertTrue(self.listener.wait(1))
+        self.assertFalse(self.listener.wait(0.1))
+
+    def test_not_notified_on_rollback(self):
+        self.assertTrue(self.listener.wait(1))
+
+        try:
+            with transaction.atomic():
+                notify_jobs_changed()
+
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertFalse(self.listener.wait(0.1))
+
+    def test_multiple_notifications_are_handled_at_once(self):
+        self.assertTrue(self.listener.wait(1))
+
+        notify_jobs_changed()
+        notify_jobs_changed()
+
+        self.assertTrue(self.listener.wait(1))
+        self.assertFalse(self.listener.wait(0.1))
+
+    def test_reconnects_after_the_connection_is_lost(self):
+        self.assertTrue(self.listener.wait(1))
+
+        self.listener._connection.close()
+
+        # the notifications might have been missed meanwhile
+        self.assertTrue(self.listener.wait(1))
+        self.assertFalse(self.listener.wait(0.1))
+
+        notify_jobs_changed()
+        self.assertTrue(self.listener.wait(1))
+
+    @mock.patch.object(db.time, "sleep")
+    def test_reconnects_after_an_error(self, sleep):
+        self.assertTrue(self.listener.wait(1))
+
+        with mock.patch.object(db.select, "select", side_effect=OSError()):
+            self.assertFalse(self.listener.wait(1))
+
+        sleep.assert_called_once_with(1)
+        self.assertIsNone(self.listener._connection)
+
+        self.assertTrue(self.listener.wait(1))
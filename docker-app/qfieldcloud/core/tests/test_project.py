@@ -1,7 +1,7 @@
 import logging
 
 from qfieldcloud.authentication.models import AuthToken
-from qfieldcloud.core.models import Project, ProjectCollaborator, User
+from qfieldcloud.core.models import Project, ProjectCollaborator, StorageCleanup, User
 from rest_framework import status
 from rest_framework.test import APITestCase
 
@@ -275,6 +275,11 @@ class QfcTestCase(APITestCase):
         # The project should not exist anymore
         self.assertFalse(Project.objects.filter(id=project1.id).exists())
 
+        # The project objects are deleted from the storage in the background
+        cleanup = StorageCleanup.objects.get(key=f"projects/{project1.id}/")
+        self.assertTrue(cleanup.is_prefix)
+        self.assertEqual(cleanup.status, StorageCleanup.Status.PENDING)
+
     def test_error_responses(self):
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
 
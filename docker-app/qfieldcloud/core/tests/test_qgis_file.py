@@ -1,13 +1,29 @@
 import filecmp
+import hashlib
+import io
 import logging
+import os
+import tarfile
 import tempfile
 import time
+from datetime import timedelta
 
 import requests
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.http.response import HttpResponseRedirect
+from django.test import override_settings
 from qfieldcloud.authentication.models import AuthToken
 from qfieldcloud.core import utils
-from qfieldcloud.core.models import Project, User
+from qfieldcloud.core.cron import (
+    CollectFileBlobsJob,
+    PruneFileVersionsJob,
+    StorageCleanupJob,
+    VerifyFileVersionsJob,
+)
+from qfieldcloud.core.models import FileBlob, Project, StorageCleanup, User, UserAccount
+from qfieldcloud.core.utils2 import storage
+from qfieldcloud.core.utils2.caching import invalidate_project_cache
 from rest_framework import status
 from rest_framework.test import APITransactionTestCase
 
@@ -102,6 +118,39 @@ class QfcTestCase(APITransactionTestCase):
 
         self.assertTrue(filecmp.cmp(temp_file.name, testdata_path("file.txt")))
 
+    def test_download_file_reuses_presigned_url(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        contents = [os.urandom(100), os.urandom(100)]
+
+        for content in contents:
+            response = self.client.post(
+                "/api/v1/files/{}/file.txt/".format(self.project1.id),
+                {"file": SimpleUploadedFile("file.txt", content)},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        versions = self.project1.file_versions.order_by("last_modified")
+        self.assertEqual(versions.count(), 2)
+
+        # The same presigned URL is reused for the same file and version
+        url = f"/api/v1/files/{self.project1.id}/file.txt/"
+        latest_url = self.client.get(url).url
+        self.assertEqual(self.client.get(url).url, latest_url)
+
+        version_url = self.client.get(url, {"version": versions[0].version_id}).url
+        self.assertNotEqual(version_url, latest_url)
+        self.assertEqual(
+            self.client.get(url, {"version": versions[0].version_id}).url,
+            version_url,
+        )
+
+        # The presigned URL is still valid
+        response = requests.get(version_url)
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(response.content, contents[0])
+
     def test_push_download_file_with_path(self):
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
 
@@ -189,6 +238,42 @@ class QfcTestCase(APITransactionTestCase):
             "fcc85fb502bd772aa675a0263b5fa665bccd5d8d93349d1dbc9f0f6394dd37b9",
         )
 
+    def test_list_files_is_cached_until_invalidated(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        response = self.client.post(
+            f"/api/v1/files/{self.project1.id}/file.txt/",
+            {"file": open(testdata_path("file.txt"), "rb")},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        response = self.client.get(f"/api/v1/files/{self.project1.id}/")
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(response.json()[0]["size"], 13)
+
+        # change the files index behind the back of the cache
+        self.project1.file_versions.update(size=42)
+
+        response = self.client.get(f"/api/v1/files/{self.project1.id}/")
+        self.assertEqual(response.json()[0]["size"], 13)
+
+        invalidate_project_cache(self.project1.id)
+
+        response = self.client.get(f"/api/v1/files/{self.project1.id}/")
+        self.assertEqual(response.json()[0]["size"], 42)
+
+        # uploading a new version invalidates the cache
+        response = self.client.post(
+            f"/api/v1/files/{self.project1.id}/file.txt/",
+            {"file": open(testdata_path("file2.txt"), "rb")},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        response = self.client.get(f"/api/v1/files/{self.project1.id}/")
+        self.assertEqual(len(response.json()[0]["versions"]), 2)
+
     def test_push_list_file_with_space_in_name(self):
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
 
@@ -423,6 +508,670 @@ class QfcTestCase(APITransactionTestCase):
         self.assertTrue(status.is_success(response.status_code))
         self.assertEqual(len(response.json()), 1)
 
+    def test_files_index_in_sync_with_storage(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        # Push a file twice and another file once
+        for filename, local_filename in [
+            ("aaa/file.txt", "file.txt"),
+            ("aaa/file.txt", "file2.txt"),
+            ("file2.txt", "file2.txt"),
+        ]:
+            response = self.client.post(
+                "/api/v1/files/{}/{}/".format(self.project1.id, filename),
+                {"file": open(testdata_path(local_filename), "rb")},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.file_versions.count(), 3)
+        self.assertEqual(
+            sorted(
+                project.file_versions.filter(is_latest=True).values_list(
+                    "name", flat=True
+                )
+            ),
+            ["aaa/file.txt", "file2.txt"],
+        )
+        self.assertEqual(storage.sync_file_versions(project, dry_run=True), ([], []))
+
+        # Delete a file
+        response = self.client.delete(
+            "/api/v1/files/{}/aaa/file.txt/".format(self.project1.id)
+        )
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(project.file_versions.count(), 1)
+        self.assertEqual(storage.sync_file_versions(project, dry_run=True), ([], []))
+
+        # Remove the index and rebuild it from the storage
+        project.file_versions.all().delete()
+        missing, extra = storage.sync_file_versions(project)
+        self.assertEqual(len(missing), 1)
+        self.assertEqual(extra, [])
+        self.assertEqual(
+            list(project.file_versions.values_list("name", "is_latest")),
+            [("file2.txt", True)],
+        )
+
+    def test_filesindex_repairs_project_filename(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        response = self.client.post(
+            "/api/v1/files/{}/foo/project.qgs/".format(self.project1.id),
+            {"file": open(testdata_path("file.txt"), "rb")},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.project_filename, "foo/project.qgs")
+        self.assertEqual(storage.get_project_filename(project), "foo/project.qgs")
+
+        # The project file is found in the files index after it drifted
+        Project.objects.filter(pk=project.pk).update(project_filename=None)
+
+        out = io.StringIO()
+        call_command("filesindex", "verify", project_id=project.id, stdout=out)
+        self.assertIn("expected foo/project.qgs", out.getvalue())
+        self.assertEqual(Project.objects.get(pk=project.pk).project_filename, None)
+
+        call_command("filesindex", "rebuild", project_id=project.id, stdout=out)
+        project = Project.objects.get(pk=project.pk)
+        self.assertEqual(project.project_filename, "foo/project.qgs")
+
+        out = io.StringIO()
+        call_command("filesindex", "verify", project_id=project.id, stdout=out)
+        self.assertIn("in sync", out.getvalue())
+
+        # Deleting the project file clears it
+        response = self.client.delete(
+            "/api/v1/files/{}/foo/project.qgs/".format(self.project1.id)
+        )
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(Project.objects.get(pk=project.pk).project_filename, None)
+
+    def test_storage_usage(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        file_size = os.path.getsize(testdata_path("file.txt"))
+
+        # Push a file twice, both versions are counted
+        for _i in range(2):
+            response = self.client.post(
+                "/api/v1/files/{}/file.txt/".format(self.project1.id),
+                {"file": open(testdata_path("file.txt"), "rb")},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.storage_bytes, 2 * file_size)
+        self.assertEqual(project.storage_objects, 2)
+        self.assertEqual(
+            UserAccount.objects.get(pk=self.user1.pk).storage_bytes, 2 * file_size
+        )
+
+        # Saving a stale instance does not overwrite the counters
+        self.project1.description = "updated"
+        self.project1.save()
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.storage_bytes, 2 * file_size)
+        self.assertEqual(storage.reconcile_storage_usage(project), (2 * file_size, 2))
+
+        # Delete the file
+        response = self.client.delete(
+            "/api/v1/files/{}/file.txt/".format(self.project1.id)
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.storage_bytes, 0)
+        self.assertEqual(project.storage_objects, 0)
+        self.assertEqual(UserAccount.objects.get(pk=self.user1.pk).storage_objects, 0)
+
+    def test_prune_file_versions(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        bucket = utils.get_s3_bucket()
+        prefix = f"projects/{self.project1.id}/files/"
+        contents = [os.urandom(100) for _i in range(4)]
+
+        # Push a file 4 times and another file once
+        for content in contents:
+            response = self.client.post(
+                "/api/v1/files/{}/file.txt/".format(self.project1.id),
+                {"file": SimpleUploadedFile("file.txt", content)},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        response = self.client.post(
+            "/api/v1/files/{}/other.txt/".format(self.project1.id),
+            {"file": SimpleUploadedFile("other.txt", contents[0])},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        # Nothing is pruned without a retention policy
+        PruneFileVersionsJob().do()
+        self.assertEqual(self.project1.file_versions.count(), 5)
+
+        # Keep the last 2 versions of each file
+        self.project1.file_versions_to_keep = 2
+        self.project1.save()
+        PruneFileVersionsJob().do()
+
+        file_versions = self.project1.file_versions.filter(name="file.txt")
+        self.assertEqual(file_versions.count(), 2)
+        self.assertEqual(
+            self.project1.file_versions.filter(name="other.txt").count(), 1
+        )
+        self.assertEqual(
+            {v.id for v in utils.list_versions(bucket, prefix)},
+            set(self.project1.file_versions.values_list("version_id", flat=True)),
+        )
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.storage_bytes, 300)
+        self.assertEqual(project.storage_objects, 3)
+        self.assertEqual(UserAccount.objects.get(pk=self.user1.pk).storage_objects, 3)
+
+        # The owner's retention applies to old versions, the latest versions are always kept
+        self.project1.file_versions_to_keep = None
+        self.project1.save()
+        UserAccount.objects.filter(pk=self.user1.pk).update(
+            file_versions_max_age=timedelta(seconds=0)
+        )
+        PruneFileVersionsJob().do()
+
+        self.assertEqual(self.project1.file_versions.count(), 2)
+        self.assertEqual(self.project1.file_versions.filter(is_latest=True).count(), 2)
+
+        response = self.client.get(
+            "/api/v1/files/{}/file.txt/".format(self.project1.id)
+        )
+        response = requests.get(response.url)
+        self.assertEqual(response.content, contents[-1])
+
+    def test_delete_file_cleans_up_storage_in_background(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        for _i in range(2):
+            response = self.client.post(
+                "/api/v1/files/{}/file.txt/".format(self.project1.id),
+                {"file": open(testdata_path("file.txt"), "rb")},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        response = self.client.delete(
+            "/api/v1/files/{}/file.txt/".format(self.project1.id)
+        )
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(Project.objects.get(pk=self.project1.pk).files_count, 0)
+
+        # The versions and the delete marker stay on the storage until the cleanup runs
+        bucket = utils.get_s3_bucket()
+        prefix = f"projects/{self.project1.id}/files/"
+        self.assertEqual(len(list(utils.list_versions(bucket, prefix))), 3)
+        self.assertEqual(len(list(utils.list_files(bucket, prefix))), 0)
+
+        cleanup = StorageCleanup.objects.get(key=f"{prefix}file.txt")
+        self.assertEqual(cleanup.status, StorageCleanup.Status.PENDING)
+
+        # A file uploaded again right after the delete is kept
+        response = self.client.post(
+            "/api/v1/files/{}/file.txt/".format(self.project1.id),
+            {"file": open(testdata_path("file.txt"), "rb")},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        StorageCleanupJob().do()
+
+        cleanup.refresh_from_db()
+        self.assertEqual(cleanup.status, StorageCleanup.Status.FINISHED)
+        self.assertEqual(cleanup.deleted_count, 3)
+        self.assertEqual(len(list(utils.list_versions(bucket, prefix))), 1)
+        self.assertEqual(Project.objects.get(pk=self.project1.pk).files_count, 1)
+
+    @override_settings(STORAGE_DEDUPLICATE_FILES=True)
+    def test_deduplicated_files(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        project2 = Project.objects.create(
+            name="project2", is_public=False, owner=self.user1
+        )
+        bucket = utils.get_s3_bucket()
+
+        # Push the same file twice to project1 and once to project2
+        for project in (self.project1, self.project1, project2):
+            response = self.client.post(
+                "/api/v1/files/{}/file.txt/".format(project.id),
+                {"file": open(testdata_path("file.txt"), "rb")},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        # The unchanged re-upload is a no-op and the contents are stored once
+        self.assertEqual(self.project1.file_versions.count(), 1)
+        self.assertEqual(project2.file_versions.count(), 1)
+        self.assertEqual(FileBlob.objects.count(), 1)
+
+        blob = FileBlob.objects.get()
+        with open(testdata_path("file.txt"), "rb") as f:
+            self.assertEqual(blob.sha256, hashlib.sha256(f.read()).hexdigest())
+        self.assertEqual(len(list(utils.list_versions(bucket, blob.key))), 1)
+        self.assertEqual(
+            len(list(utils.list_versions(bucket, f"projects/{project2.id}/files/"))),
+            0,
+        )
+
+        # The file is downloaded from the blob
+        response = self.client.get(
+            "/api/v1/files/{}/file.txt/".format(project2.id),
+        )
+        self.assertIsInstance(response, HttpResponseRedirect)
+        response = requests.get(response.url)
+        self.assertTrue(status.is_success(response.status_code))
+        with open(testdata_path("file.txt"), "rb") as f:
+            self.assertEqual(response.content, f.read())
+
+        # The blob is deleted once it is no longer referenced
+        for project in (self.project1, project2):
+            response = self.client.delete(
+                "/api/v1/files/{}/file.txt/".format(project.id)
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        CollectFileBlobsJob().do()
+
+        self.assertEqual(FileBlob.objects.count(), 0)
+        self.assertEqual(len(list(utils.list_versions(bucket, blob.key))), 0)
+
+    @override_settings(STORAGE_FILE_BLOCK_SIZE=5 * 1024 * 1024)
+    def test_upload_file_blocks(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        block_size = 5 * 1024 * 1024
+        content = os.urandom(2 * block_size + 1024)
+
+        response = self.client.post(
+            "/api/v1/files/{}/data.gpkg/".format(self.project1.id),
+            {"file": SimpleUploadedFile("data.gpkg", content)},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        response = self.client.get(
+            "/api/v1/file-blocks/{}/data.gpkg/".format(self.project1.id)
+        )
+        self.assertTrue(status.is_success(response.status_code))
+        latest = response.json()
+        self.assertEqual(latest["block_size"], block_size)
+        self.assertEqual(len(latest["blocks"]), 3)
+
+        # Change a few bytes in the middle block and send only that block
+        start = block_size + 10
+        end = start + 10
+        new_content = bytearray(content)
+        new_content[start:end] = b"x" * 10
+        new_content = bytes(new_content)
+        new_content_file = io.BytesIO(new_content)
+        new_content_file.seek(block_size)
+        middle_block = SimpleUploadedFile("block_1", new_content_file.read(block_size))
+
+        data = {
+            "version_id": latest["version_id"],
+            "size": len(new_content),
+            "sha256": hashlib.sha256(new_content).hexdigest(),
+            "block_1": middle_block,
+        }
+        response = self.client.post(
+            "/api/v1/file-blocks/{}/data.gpkg/".format(self.project1.id),
+            data,
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()["uploaded_blocks"], 1)
+        self.assertEqual(response.json()["copied_blocks"], 2)
+
+        response = self.client.get(
+            "/api/v1/files/{}/data.gpkg/".format(self.project1.id)
+        )
+        self.assertIsInstance(response, HttpResponseRedirect)
+        self.assertEqual(requests.get(response.url).content, new_content)
+        self.assertEqual(self.project1.file_versions.count(), 2)
+
+        # The block hashcodes of the new version are composed without reading it back
+        response = self.client.get(
+            "/api/v1/file-blocks/{}/data.gpkg/".format(self.project1.id)
+        )
+        self.assertTrue(status.is_success(response.status_code))
+        new_content_file.seek(0)
+        self.assertEqual(
+            response.json()["blocks"],
+            [
+                hashlib.sha256(block).hexdigest()
+                for block in iter(lambda: new_content_file.read(block_size), b"")
+            ],
+        )
+
+        # Blocks of another size than the block size are rejected
+        latest_version_id = response.json()["version_id"]
+        response = self.client.post(
+            "/api/v1/file-blocks/{}/data.gpkg/".format(self.project1.id),
+            {
+                **data,
+                "version_id": latest_version_id,
+                "block_1": SimpleUploadedFile("block_1", b"x" * 10),
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.project1.file_versions.count(), 2)
+
+        # The assembled file is verified against the declared sha256
+        middle_block.seek(0)
+        response = self.client.post(
+            "/api/v1/file-blocks/{}/data.gpkg/".format(self.project1.id),
+            {
+                **data,
+                "version_id": latest_version_id,
+                "sha256": hashlib.sha256(b"Something else").hexdigest(),
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.project1.file_versions.count(), 2)
+        self.assertEqual(
+            storage.get_file_version(self.project1, "data.gpkg").version_id,
+            latest_version_id,
+        )
+
+        # Blocks computed against an older version are rejected
+        middle_block.seek(0)
+        response = self.client.post(
+            "/api/v1/file-blocks/{}/data.gpkg/".format(self.project1.id),
+            data,
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def _direct_upload(self, filename, content, sha256sum=None):
+        response = self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/",
+            {
+                "filename": filename,
+                "size": len(content),
+                "sha256": sha256sum or hashlib.sha256(content).hexdigest(),
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        upload = response.json()
+
+        data = {"upload_token": upload["upload_token"]}
+        parts = []
+        if upload["method"] == "PUT":
+            storage_response = requests.put(
+                upload["url"], data=content, headers=upload["headers"]
+            )
+            self.assertTrue(status.is_success(storage_response.status_code))
+            data["version_id"] = storage_response.headers["x-amz-version-id"]
+        else:
+            content_file = io.BytesIO(content)
+            for part in upload["parts"]:
+                storage_response = requests.put(
+                    part["url"], data=content_file.read(upload["part_size"])
+                )
+                self.assertTrue(status.is_success(storage_response.status_code))
+                parts.append(
+                    {
+                        "part_number": part["part_number"],
+                        "etag": storage_response.headers["ETag"],
+                    }
+                )
+
+            data["parts"] = parts
+
+        return self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/complete/",
+            data,
+            format="json",
+        )
+
+    def test_download_files_archive(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        contents = {
+            "file.txt": open(testdata_path("file.txt"), "rb").read(),
+            "foo/bar.bin": os.urandom(1000),
+        }
+
+        for name, content in contents.items():
+            response = self.client.post(
+                f"/api/v1/files/{self.project1.id}/{name}/",
+                {"file": SimpleUploadedFile(name, content)},
+                format="multipart",
+            )
+            self.assertTrue(status.is_success(response.status_code))
+
+        # Download all the files as a single archive
+        response = self.client.get(f"/api/v1/file-archives/{self.project1.id}/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+        archive_content = b"".join(response.streaming_content)
+        self.assertEqual(len(archive_content), int(response["Content-Length"]))
+
+        with tarfile.open(fileobj=io.BytesIO(archive_content)) as tar:
+            self.assertEqual(sorted(tar.getnames()), sorted(contents.keys()))
+
+            for name, content in contents.items():
+                self.assertEqual(tar.extractfile(name).read(), content)
+
+        # Resume the download from the middle of the second file
+        start = len(archive_content) - 1500
+        response = self.client.get(
+            f"/api/v1/file-archives/{self.project1.id}/",
+            HTTP_RANGE=f"bytes={start}-",
+            HTTP_IF_RANGE=response["ETag"],
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(
+            response["Content-Range"],
+            f"bytes {start}-{len(archive_content) - 1}/{len(archive_content)}",
+        )
+        self.assertEqual(b"".join(response.streaming_content), archive_content[start:])
+
+        # The archive changes once a file is uploaded again
+        etag = response["ETag"]
+        contents["foo/bar.bin"] = os.urandom(1000)
+        response = self.client.post(
+            f"/api/v1/files/{self.project1.id}/foo/bar.bin/",
+            {"file": SimpleUploadedFile("foo/bar.bin", contents["foo/bar.bin"])},
+            format="multipart",
+        )
+        self.assertTrue(status.is_success(response.status_code))
+
+        # Resuming the outdated download sends the whole new archive
+        response = self.client.get(
+            f"/api/v1/file-archives/{self.project1.id}/",
+            HTTP_RANGE=f"bytes={start}-",
+            HTTP_IF_RANGE=etag,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+        with tarfile.open(
+            fileobj=io.BytesIO(b"".join(response.streaming_content))
+        ) as tar:
+            self.assertEqual(
+                tar.extractfile("foo/bar.bin").read(), contents["foo/bar.bin"]
+            )
+
+        # Or fails if the outdated archive is required
+        response = self.client.get(
+            f"/api/v1/file-archives/{self.project1.id}/",
+            HTTP_RANGE=f"bytes={start}-",
+            HTTP_IF_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+        # Only the requested files are archived
+        response = self.client.get(
+            f"/api/v1/file-archives/{self.project1.id}/?name=foo/bar.bin"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        archive_content = b"".join(response.streaming_content)
+
+        with tarfile.open(fileobj=io.BytesIO(archive_content)) as tar:
+            self.assertEqual(tar.getnames(), ["foo/bar.bin"])
+
+    def test_direct_upload_file(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        content = b"Hello direct upload!"
+        response = self._direct_upload("foo/file.txt", content)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.files_count, 1)
+        self.assertIsNotNone(project.data_last_updated_at)
+
+        # List files
+        response = self.client.get("/api/v1/files/{}/".format(self.project1.id))
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response.json()[0]["name"], "foo/file.txt")
+        self.assertEqual(
+            response.json()[0]["sha256"], hashlib.sha256(content).hexdigest()
+        )
+
+    @override_settings(STORAGE_MULTIPART_UPLOAD_PART_SIZE=5 * 1024 * 1024)
+    def test_direct_upload_multipart_file(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        content = b"1234567890" * 1024 * 1024
+        response = self._direct_upload("bigfile.big", content)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get("/api/v1/files/{}/".format(self.project1.id))
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response.json()[0]["size"], len(content))
+        self.assertEqual(
+            response.json()[0]["sha256"], hashlib.sha256(content).hexdigest()
+        )
+
+    def test_direct_upload_file_with_wrong_size(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        response = self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/",
+            {"filename": "file.txt", "size": 3, "sha256": "a" * 64},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        upload = response.json()
+
+        storage_response = requests.put(
+            upload["url"], data=b"abcd", headers=upload["headers"]
+        )
+
+        response = self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/complete/",
+            {
+                "upload_token": upload["upload_token"],
+                "version_id": storage_response.headers["x-amz-version-id"],
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Project.objects.get(pk=self.project1.pk).files_count, 0)
+
+    def test_direct_upload_file_with_wrong_content(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        # the declared size is right, but not the declared sha256
+        content = b"Hello direct upload!"
+        response = self._direct_upload(
+            "file.txt", content, hashlib.sha256(b"Something else").hexdigest()
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Project.objects.get(pk=self.project1.pk).files_count, 0)
+
+        response = self.client.get("/api/v1/files/{}/".format(self.project1.id))
+        self.assertEqual(response.json(), [])
+
+    @override_settings(STORAGE_INLINE_VERIFICATION_MAX_SIZE=0)
+    def test_direct_upload_file_verified_in_background(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        content = b"Hello direct upload!"
+        response = self._direct_upload("valid.txt", content)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # the declared sha256 is not checked within the request
+        response = self._direct_upload(
+            "invalid.txt", content, hashlib.sha256(b"Something else").hexdigest()
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            self.project1.file_versions.filter(is_verified=False).count(), 2
+        )
+
+        # nor trusted by the worker until verified
+        manifest = {f["name"]: f for f in storage.get_files_manifest(self.project1)}
+        self.assertIsNone(manifest["valid.txt"]["sha256"])
+
+        VerifyFileVersionsJob().do()
+
+        project = Project.objects.get(pk=self.project1.pk)
+        self.assertEqual(project.files_count, 1)
+        self.assertEqual(project.storage_bytes, len(content))
+        self.assertTrue(project.file_versions.get(name="valid.txt").is_verified)
+        self.assertIsNone(storage.get_file_version(project, "invalid.txt"))
+
+        response = self.client.get("/api/v1/files/{}/".format(self.project1.id))
+        self.assertEqual([f["name"] for f in response.json()], ["valid.txt"])
+
+    def test_direct_upload_cannot_be_completed_twice(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
+
+        content = b"Hello direct upload!"
+        response = self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/",
+            {
+                "filename": "file.txt",
+                "size": len(content),
+                "sha256": hashlib.sha256(content).hexdigest(),
+            },
+            format="json",
+        )
+        upload = response.json()
+        storage_response = requests.put(
+            upload["url"], data=content, headers=upload["headers"]
+        )
+        data = {
+            "upload_token": upload["upload_token"],
+            "version_id": storage_response.headers["x-amz-version-id"],
+        }
+
+        response = self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/complete/", data, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.post(
+            f"/api/v1/file-uploads/{self.project1.id}/complete/", data, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Project.objects.get(pk=self.project1.pk).files_count, 1)
+
     def test_one_qgis_project_per_project(self):
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token1.key)
 
@@ -562,3 +1311,7 @@ class QfcTestCase(APITransactionTestCase):
         self.assertEqual("bigfile.big", response.json()[0]["name"])
         self.assertGreater(response.json()[0]["size"], 10000000)
         self.assertLess(response.json()[0]["size"], 11000000)
+        self.assertEqual(
+            response.json()[0]["sha256"],
+            hashlib.sha256(b"\0" * 1024 * 1024 * 10).hexdigest(),
+        )
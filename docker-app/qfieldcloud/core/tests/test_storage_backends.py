@@ -0,0 +1,238 @@
+import io
+import logging
+import tempfile
+import uuid
+
+import requests
+from django.http import FileResponse
+from django.http.response import HttpResponseRedirect
+from django.test import SimpleTestCase
+from qfieldcloud.core.utils2.storage_backends import (
+    LocalStorageBackend,
+    S3StorageBackend,
+    StorageBackend,
+    StorageObjectRange,
+)
+
+logging.disable(logging.CRITICAL)
+
+
+class StorageBackendTestMixin:
+    """Tests shared by all the storage backends, the test cases only have to create the backend."""
+
+    def get_backend(self) -> StorageBackend:
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.backend = self.get_backend()
+        self.prefix = f"tests/{uuid.uuid4()}/"
+
+    def tearDown(self):
+        self.backend.delete_object_versions(
+            (v.key, v.id) for v in self.backend.list_versions(self.prefix)
+        )
+
+    def get_contents(self, key, version_id=None, start=0, end=None):
+        return b"".join(self.backend.iter_object(key, version_id, start, end))
+
+    def test_put_and_read_versions(self):
+        key = f"{self.prefix}foo/file.txt"
+
+        self.assertIsNone(self.backend.head_object(key))
+
+        version1 = self.backend.put_object(
+            io.BytesIO(b"version 1"), key, {"Sha256sum": "abc"}
+        )
+        version2 = self.backend.put_object(io.BytesIO(b"version 2!"), key)
+
+        self.assertNotEqual(version1.id, version2.id)
+        self.assertEqual(version2.size, 10)
+        self.assertTrue(version2.is_latest)
+
+        latest = self.backend.head_object(key)
+        self.assertEqual(latest.id, version2.id)
+        self.assertEqual(latest.metadata, {})
+        self.assertEqual(
+            self.backend.head_object(key, version1.id).metadata, {"sha256sum": "abc"}
+        )
+
+        self.assertEqual(self.get_contents(key), b"version 2!")
+        self.assertEqual(self.get_contents(key, version1.id), b"version 1")
+        self.assertEqual(self.get_contents(key, version1.id, 2, 4), b"rsi")
+        self.assertEqual(self.get_contents(key, None, 8), b"2!")
+
+    def test_list_versions(self):
+        self.backend.put_object(io.BytesIO(b"a1"), f"{self.prefix}a.txt")
+        self.backend.put_object(io.BytesIO(b"a2"), f"{self.prefix}a.txt")
+        self.backend.put_object(io.BytesIO(b"b"), f"{self.prefix}dir/b.txt")
+        self.backend.put_object(io.BytesIO(b"c"), f"{self.prefix}dir2/c.txt")
+
+        versions = list(self.backend.list_versions(self.prefix))
+
+        self.assertEqual(
+            [(v.name, v.size, v.is_latest) for v in versions],
+            [
+                ("a.txt", 2, True),
+                ("a.txt", 2, False),
+                ("dir/b.txt", 1, True),
+                ("dir2/c.txt", 1, True),
+            ],
+        )
+        self.assertGreaterEqual(versions[0].last_modified, versions[1].last_modified)
+
+        # the prefix does not need to be a directory
+        self.assertEqual(
+            [v.key for v in self.backend.list_versions(f"{self.prefix}dir/")],
+            [f"{self.prefix}dir/b.txt"],
+        )
+        self.assertEqual(
+            [
+                v.name
+                for v in self.backend.list_versions(
+                    f"{self.prefix}dir", strip_prefix=False
+                )
+            ],
+            [f"{self.prefix}dir/b.txt", f"{self.prefix}dir2/c.txt"],
+        )
+        self.assertEqual(list(self.backend.list_versions(f"{self.prefix}none/")), [])
+
+    def test_delete_object(self):
+        key = f"{self.prefix}file.txt"
+        version = self.backend.put_object(io.BytesIO(b"contents"), key)
+
+        delete_marker_id = self.backend.delete_object(key)
+
+        # the object is hidden behind a delete marker, but its versions are kept
+        self.assertIsNone(self.backend.head_object(key))
+        self.assertEqual(self.get_contents(key, version.id), b"contents")
+
+        versions = list(self.backend.list_versions(self.prefix))
+        # NOTE the S3 API lists the delete markers separately from the versions
+        self.assertCountEqual(
+            [(v.is_delete_marker, v.is_latest) for v in versions],
+            [(True, True), (False, False)],
+        )
+        self.assertEqual(
+            [v.id for v in versions if v.is_delete_marker], [delete_marker_id]
+        )
+
+        deleted = []
+        self.assertEqual(
+            self.backend.delete_object_versions(
+                ((v.key, v.id) for v in versions), on_deleted=deleted.append
+            ),
+            2,
+        )
+        self.assertEqual(deleted, [2])
+        self.assertEqual(list(self.backend.list_versions(self.prefix)), [])
+
+    def test_copy_object(self):
+        source_key = f"{self.prefix}source.txt"
+        key = f"{self.prefix}copy.txt"
+        source_version = self.backend.put_object(
+            io.BytesIO(b"source 1"), source_key, {"Sha256sum": "abc"}
+        )
+        self.backend.put_object(io.BytesIO(b"source 2"), source_key)
+
+        version = self.backend.copy_object(source_key, key, source_version.id)
+
+        self.assertEqual(self.get_contents(key), b"source 1")
+        self.assertEqual(version.metadata, {"sha256sum": "abc"})
+
+        # the copy is independent from the source
+        self.backend.delete_object_versions([(source_key, source_version.id)])
+        self.assertEqual(self.get_contents(key), b"source 1")
+
+        version = self.backend.copy_object(source_key, key, metadata={"foo": "bar"})
+        self.assertEqual(self.get_contents(key), b"source 2")
+        self.assertEqual(self.backend.head_object(key).metadata, {"foo": "bar"})
+
+    def test_compose_object(self):
+        source_key = f"{self.prefix}source.txt"
+        key = f"{self.prefix}composed.txt"
+        # NOTE S3 requires all the parts but the last to be at least 5MB
+        block = b"a" * (5 * 1024 * 1024)
+        source_version = self.backend.put_object(io.BytesIO(b"0123456789"), source_key)
+        self.backend.put_object(io.BytesIO(b"latest"), source_key)
+
+        version = self.backend.compose_object(
+            key,
+            [
+                io.BytesIO(block),
+                StorageObjectRange(source_key, source_version.id, 2, 4),
+            ],
+            {"Sha256sum": "abc"},
+        )
+
+        self.assertTrue(version.is_latest)
+        self.assertEqual(version.size, len(block) + 3)
+        self.assertEqual(self.get_contents(key), block + b"234")
+        self.assertEqual(self.backend.head_object(key).metadata, {"sha256sum": "abc"})
+
+        # the latest version of the source is copied without a version id
+        self.backend.compose_object(
+            key, [io.BytesIO(block), StorageObjectRange(source_key, None, 0, 1)]
+        )
+        self.assertEqual(self.get_contents(key, start=len(block)), b"la")
+
+    def test_download_response(self):
+        key = f"{self.prefix}file.txt"
+        version = self.backend.put_object(io.BytesIO(b"version 1"), key)
+        self.backend.put_object(io.BytesIO(b"version 2"), key)
+
+        response = self.backend.get_download_response(key, "file.txt", version.id)
+
+        self.assertEqual(self.get_response_contents(response), b"version 1")
+
+    def test_is_available(self):
+        self.assertTrue(self.backend.is_available())
+
+
+class LocalStorageBackendTestCase(StorageBackendTestMixin, SimpleTestCase):
+    def get_backend(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        return LocalStorageBackend(self.tmpdir.name)
+
+    def tearDown(self):
+        super().tearDown()
+
+        self.tmpdir.cleanup()
+
+    def get_response_contents(self, response):
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="file.txt"'
+        )
+
+        return b"".join(response.streaming_content)
+
+    def test_public_url(self):
+        key = f"{self.prefix}avatar.png"
+        self.backend.put_object(io.BytesIO(b"png"), key, is_public=True)
+
+        # the objects cannot be reached from outside of the app
+        self.assertIsNone(self.backend.get_public_url(key))
+
+    def test_invalid_keys(self):
+        for key in ("", "/abs", "a/../b", "a//b", "a.~versions/b"):
+            with self.assertRaises(ValueError):
+                self.backend.put_object(io.BytesIO(b""), key)
+
+    def test_empty_directories_are_removed(self):
+        key = f"{self.prefix}a/b/file.txt"
+        version = self.backend.put_object(io.BytesIO(b"contents"), key)
+
+        self.backend.delete_object_versions([(key, version.id)])
+
+        self.assertEqual(list(self.backend.root.iterdir()), [])
+
+
+class S3StorageBackendTestCase(StorageBackendTestMixin, SimpleTestCase):
+    def get_backend(self):
+        return S3StorageBackend()
+
+    def get_response_contents(self, response):
+        self.assertIsInstance(response, HttpResponseRedirect)
+
+        return requests.get(response.url).content
@@ -0,0 +1,99 @@
+import hashlib
+import io
+import logging
+import os
+from unittest import mock
+
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.test import SimpleTestCase
+from qfieldcloud.core import utils
+
+logging.disable(logging.CRITICAL)
+
+CONTENTS = b"0123456789" * 10000
+CONTENTS_SHA256 = hashlib.sha256(CONTENTS).hexdigest()
+
+
+class GetSha256TestCase(SimpleTestCase):
+    def test_bytes_io(self):
+        file = io.BytesIO(CONTENTS)
+        file.read(10)
+
+        with mock.patch.object(
+            utils, "_get_sha256_buffer", wraps=utils._get_sha256_buffer
+        ) as get_sha256_buffer:
+            self.assertEqual(utils.get_sha256(file), CONTENTS_SHA256)
+
+        get_sha256_buffer.assert_called_once()
+        self.assertEqual(file.tell(), 0)
+
+        # the buffer is released, otherwise the file could not be resized anymore
+        file.write(b"more")
+
+    def test_in_memory_uploaded_file(self):
+        file = InMemoryUploadedFile(
+            io.BytesIO(CONTENTS), "file", "file.txt", None, len(CONTENTS), None
+        )
+
+        self.assertEqual(utils.get_sha256(file), CONTENTS_SHA256)
+        self.assertEqual(file.tell(), 0)
+
+    def test_temporary_uploaded_file(self):
+        file = TemporaryUploadedFile("file.txt", None, len(CONTENTS), None)
+        # NOTE not flushed yet, like while being uploaded
+        file.write(CONTENTS)
+
+        with mock.patch.object(
+            utils, "_get_sha256_mmap", wraps=utils._get_sha256_mmap
+        ) as get_sha256_mmap:
+            self.assertEqual(utils.get_sha256(file), CONTENTS_SHA256)
+
+        get_sha256_mmap.assert_called_once()
+        self.assertEqual(file.tell(), 0)
+        self.assertEqual(file.read(), CONTENTS)
+
+        file.close()
+
+    def test_empty_file(self):
+        file = TemporaryUploadedFile("file.txt", None, 0, None)
+
+        # NOTE empty files cannot be memory mapped
+        with mock.patch.object(utils.mmap, "mmap") as mmap:
+            self.assertEqual(utils.get_sha256(file), hashlib.sha256().hexdigest())
+
+        mmap.assert_not_called()
+        self.assertEqual(file.tell(), 0)
+
+        file.close()
+
+    def test_not_seekable_file(self):
+        read_fd, write_fd = os.pipe()
+
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(CONTENTS[:1000])
+
+        with os.fdopen(read_fd, "rb") as file:
+            self.assertFalse(file.seekable())
+
+            with mock.patch.object(
+                utils, "_get_sha256_file", wraps=utils._get_sha256_file
+            ) as get_sha256_file:
+                self.assertEqual(
+                    utils.get_sha256(file),
+                    hashlib.sha256(CONTENTS[:1000]).hexdigest(),
+                )
+
+            get_sha256_file.assert_called_once()
+
+    def test_file_without_fileno(self):
+        file = mock.Mock(wraps=io.BufferedReader(io.BytesIO(CONTENTS)))
+        file.fileno.side_effect = io.UnsupportedOperation()
+
+        self.assertEqual(utils.get_sha256(file), CONTENTS_SHA256)
+        file.seek.assert_called_once_with(0)
+
+    def test_hash_computed_while_uploaded(self):
+        file = io.BytesIO(CONTENTS)
+        file.sha256sum = "abc"
+
+        self.assertEqual(utils.get_sha256(file), "abc")
@@ -0,0 +1,122 @@
+import json
+import logging
+import socket
+import tempfile
+import threading
+from pathlib import Path
+from unittest import mock
+
+from django.test import SimpleTestCase
+from worker_wrapper.pool import (
+    CONTAINER_JOBS_DIR,
+    ENTRYPOINT_COMMAND,
+    TIMEOUT_ERROR_EXIT_CODE,
+    PooledContainer,
+)
+
+logging.disable(logging.CRITICAL)
+
+
+class FakeJobServer:
+    """Accepts a single connection on a Unix socket, like the server of a pooled QGIS container."""
+
+    def __init__(self, socket_filename: Path, reply) -> None:
+        self.request = None
+        self._reply = reply
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(str(socket_filename))
+        self._server.listen(1)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.start()
+
+    def _serve(self) -> None:
+        conn, _address = self._server.accept()
+
+        with conn, conn.makefile("rwb") as f:
+            line = f.readline()
+
+            # the readiness checks send nothing
+            if line:
+                self.request = json.loads(line)
+                self._reply(f)
+
+    def close(self) -> None:
+        self._thread.join(5)
+        self._server.close()
+
+
+class PooledContainerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_filename = Path(self.tmpdir.name, "container.sock")
+        self.io_dir = Path(self.tmpdir.name, "job")
+        self.io_dir.mkdir()
+        self.container = mock.Mock()
+        self.pooled_container = PooledContainer(self.container, self.socket_filename)
+        self.command = [*ENTRYPOINT_COMMAND, "package", "projectid", "project.qgs"]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_job(self, reply, timeout=5):
+        server = FakeJobServer(self.socket_filename, reply)
+
+        try:
+            result = self.pooled_container.run(self.command, self.io_dir, timeout)
+        finally:
+            server.close()
+
+        return server, result
+
+    def test_reply(self):
+        def reply(f):
+            self.io_dir.joinpath("output.log").write_bytes(b"done\n")
+            f.write(b'{"exit_code": 3}\n')
+
+        server, result = self.run_job(reply)
+
+        self.assertEqual(result, (3, b"done\n"))
+        self.assertEqual(
+            server.request,
+            {
+                "args": ["package", "projectid", "project.qgs"],
+                "io_dir": f"{CONTAINER_JOBS_DIR}/job",
+            },
+        )
+        self.assertEqual(self.pooled_container.jobs_count, 1)
+        self.container.wait.assert_not_called()
+
+    def test_closed_without_reply(self):
+        self.container.wait.return_value = {"StatusCode": 139}
+
+        # e.g. QGIS crashed, the exit code is the one of the container
+        server, result = self.run_job(lambda f: None)
+
+        self.assertEqual(result, (139, b""))
+        self.container.wait.assert_called_once()
+
+    def test_closed_without_reply_and_container_still_running(self):
+        self.container.wait.side_effect = Exception("timed out")
+
+        server, result = self.run_job(lambda f: None)
+
+        self.assertEqual(result, (TIMEOUT_ERROR_EXIT_CODE, b""))
+
+    def test_timeout(self):
+        # the job is still running when the wrapper gives up and closes the connection
+        server, result = self.run_job(lambda f: f.read(), timeout=0.2)
+
+        self.assertEqual(result, (TIMEOUT_ERROR_EXIT_CODE, b""))
+        self.container.wait.assert_not_called()
+
+    def test_is_ready(self):
+        self.assertFalse(self.pooled_container.is_ready())
+
+        server = FakeJobServer(self.socket_filename, lambda f: None)
+
+        try:
+            self.assertTrue(self.pooled_container.is_ready())
+        finally:
+            server.close()
+
+        self.assertIsNone(server.request)
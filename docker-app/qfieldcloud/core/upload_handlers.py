@@ -0,0 +1,53 @@
+import hashlib
+
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+
+
+class Sha256MemoryFileUploadHandler(MemoryFileUploadHandler):
+    """Same as `MemoryFileUploadHandler`, but also computes the sha256 hashcode of the uploaded file
+    while receiving it and stores it in the `sha256sum` attribute of the uploaded file."""
+
+    def new_file(self, *args, **kwargs):
+        # NOTE the parent raises `StopFutureHandlers` when activated, so the hasher must be set before
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # NOTE when not activated the file is too big to be kept in memory and the chunks are just passed to the next handler
+        if self.activated:
+            self.hasher.update(raw_data)
+
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+
+        if file is not None:
+            file.sha256sum = self.hasher.hexdigest()
+
+        return file
+
+
+class Sha256TemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Same as `TemporaryFileUploadHandler`, but also computes the sha256 hashcode of the uploaded file
+    while writing it to the disk and stores it in the `sha256sum` attribute of the uploaded file.
+
+    This saves reading the temporary file once again just to compute the hashcode."""
+
+    def new_file(self, *args, **kwargs):
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256sum = self.hasher.hexdigest()
+
+        return file
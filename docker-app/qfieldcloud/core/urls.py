@@ -62,10 +62,24 @@ urlpatterns = [
         files_views.DownloadPushDeleteFileView.as_view(),
         name="project_file_download",
     ),
+    path("file-archives/<uuid:projectid>/", files_views.ArchiveFilesView.as_view()),
+    path(
+        "file-blocks/<uuid:projectid>/<path:filename>/",
+        files_views.FileBlocksView.as_view(),
+    ),
+    path("file-uploads/<uuid:projectid>/", files_views.FileUploadView.as_view()),
+    path(
+        "file-uploads/<uuid:projectid>/complete/",
+        files_views.FileUploadCompleteView.as_view(),
+    ),
     path(
         "packages/<uuid:project_id>/latest/",
         package_views.LatestPackageView.as_view(),
     ),
+    path(
+        "packages/<uuid:project_id>/latest/archive/",
+        package_views.LatestPackageArchiveView.as_view(),
+    ),
     path(
         "packages/<uuid:project_id>/latest/files/<path:filename>",
         package_views.LatestPackageDownloadFilesView.as_view(),
@@ -1,22 +1,32 @@
 import hashlib
+import io
 import json
 import logging
+import mmap
 import os
 import posixpath
+import stat
+import threading
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from itertools import islice
 from pathlib import PurePath
-from typing import IO, Iterable, List, NamedTuple, Optional, Union
+from typing import IO, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 import boto3
+import botocore.config
 import jsonschema
 import mypy_boto3_s3
 from botocore.errorfactory import ClientError
 from django.conf import settings
-from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.core.cache import cache
 from redis import Redis, exceptions
 
 logger = logging.getLogger(__name__)
 
+# the size of the reads when hashing files that can be neither memory mapped nor accessed as a buffer
+SHA256_BUFFER_SIZE = 1024 * 1024
+
 
 class S3PrefixPath(NamedTuple):
     Key: str
@@ -63,6 +73,15 @@ class S3ObjectVersion:
     def is_latest(self) -> bool:
         return self._data.is_latest
 
+    @property
+    def is_delete_marker(self) -> bool:
+        # NOTE delete markers are listed together with the versions, but they have no size
+        return self._data.size is None
+
+    def head(self) -> dict:
+        """Returns the HEAD response of the version, including the user metadata"""
+        return self._data.head()
+
 
 class S3ObjectWithVersions(NamedTuple):
     latest: S3ObjectVersion
@@ -81,69 +100,244 @@ def redis_is_running() -> bool:
     return True
 
 
-def get_s3_session() -> boto3.Session:
-    """Get a new S3 Session instance using Django settings"""
+_s3_lock = threading.Lock()
+_s3_client = None
+_s3_client_credentials = None
+_s3_generation = 0
+_s3_local = threading.local()
+
+
+def _get_s3_credentials() -> tuple:
+    """Returns the storage settings the S3 sessions and clients depend on."""
+    return (
+        settings.STORAGE_ACCESS_KEY_ID,
+        settings.STORAGE_SECRET_ACCESS_KEY,
+        settings.STORAGE_REGION_NAME,
+        settings.STORAGE_ENDPOINT_URL,
+    )
 
-    session = boto3.Session(
-        aws_access_key_id=settings.STORAGE_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.STORAGE_SECRET_ACCESS_KEY,
-        region_name=settings.STORAGE_REGION_NAME,
+
+def _get_s3_config() -> botocore.config.Config:
+    # NOTE the HTTP connections are kept alive and reused by the pool of the cached client
+    return botocore.config.Config(
+        max_pool_connections=settings.STORAGE_MAX_POOL_CONNECTIONS,
+        # NOTE presigned URLs are signed with SigV4, so the metadata headers are part of the signature
+        signature_version="s3v4",
     )
-    return session
+
+
+def reset_s3_clients() -> None:
+    """Invalidates the cached S3 sessions, resources and clients, e.g. when the storage credentials change.
+
+    They are also recreated automatically when the storage settings change.
+    """
+    global _s3_client, _s3_client_credentials, _s3_generation
+
+    with _s3_lock:
+        _s3_client = None
+        _s3_client_credentials = None
+        _s3_generation += 1
+
+
+def _get_s3_thread_local() -> threading.local:
+    """Returns the thread local cache, cleared if the credentials changed or the clients were reset."""
+    credentials = _get_s3_credentials()
+
+    if (
+        getattr(_s3_local, "generation", None) != _s3_generation
+        or getattr(_s3_local, "credentials", None) != credentials
+    ):
+        _s3_local.__dict__.clear()
+        _s3_local.generation = _s3_generation
+        _s3_local.credentials = credentials
+
+    return _s3_local
+
+
+def get_s3_session() -> boto3.Session:
+    """Get the S3 Session instance of the current thread using Django settings
+
+    NOTE boto3 sessions are not thread safe, so each thread has its own session.
+    """
+    local = _get_s3_thread_local()
+
+    if getattr(local, "session", None) is None:
+        local.session = boto3.Session(
+            aws_access_key_id=settings.STORAGE_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.STORAGE_SECRET_ACCESS_KEY,
+            region_name=settings.STORAGE_REGION_NAME,
+        )
+
+    return local.session
 
 
 def get_s3_bucket() -> mypy_boto3_s3.service_resource.Bucket:
-    """Get a new S3 Bucket instance using Django settings"""
+    """Get the S3 Bucket instance of the current thread using Django settings
 
-    session = get_s3_session()
+    NOTE boto3 resources are not thread safe, so each thread has its own resource.
+    """
+    local = _get_s3_thread_local()
+
+    if getattr(local, "resource", None) is None:
+        session = get_s3_session()
+        local.resource = session.resource(
+            "s3",
+            endpoint_url=settings.STORAGE_ENDPOINT_URL,
+            config=_get_s3_config(),
+        )
 
-    # Get the bucket objects
-    s3 = session.resource("s3", endpoint_url=settings.STORAGE_ENDPOINT_URL)
-    return s3.Bucket(settings.STORAGE_BUCKET_NAME)
+    return local.resource.Bucket(settings.STORAGE_BUCKET_NAME)
 
 
 def get_s3_client() -> mypy_boto3_s3.Client:
-    """Get a new S3 client instance using Django settings"""
-
-    s3_client = boto3.client(
-        "s3",
-        region_name=settings.STORAGE_REGION_NAME,
-        aws_access_key_id=settings.STORAGE_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.STORAGE_SECRET_ACCESS_KEY,
-        endpoint_url=settings.STORAGE_ENDPOINT_URL,
+    """Get the process wide S3 client instance using Django settings
+
+    NOTE boto3 clients are thread safe, so a single client and its connection pool are shared by all threads.
+    """
+    global _s3_client, _s3_client_credentials
+
+    credentials = _get_s3_credentials()
+    s3_client = _s3_client
+
+    if s3_client is not None and _s3_client_credentials == credentials:
+        return s3_client
+
+    with _s3_lock:
+        if _s3_client is None or _s3_client_credentials != credentials:
+            # NOTE boto3.client() uses the default session which is not thread safe, so create a dedicated one
+            session = boto3.Session(
+                aws_access_key_id=settings.STORAGE_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.STORAGE_SECRET_ACCESS_KEY,
+                region_name=settings.STORAGE_REGION_NAME,
+            )
+            _s3_client = session.client(
+                "s3",
+                endpoint_url=settings.STORAGE_ENDPOINT_URL,
+                config=_get_s3_config(),
+            )
+            _s3_client_credentials = credentials
+
+        return _s3_client
+
+
+def get_presigned_download_url(
+    key: str, filename: str, version_id: Optional[str] = None
+) -> str:
+    """Returns a presigned URL to download an object from the storage as an attachment.
+
+    Signing is cheap, but the download views are called for each of the hundreds of files of a project,
+    so the URLs are cached and reused while they are still valid for at least `STORAGE_DOWNLOAD_URL_MIN_VALIDITY` seconds.
+
+    Args:
+        key (str): the object key
+        filename (str): the filename of the downloaded attachment
+        version_id (Optional[str], optional): the object version, the latest one if not given. Defaults to None.
+
+    Returns:
+        str: the presigned URL
+    """
+    params = {
+        "Bucket": settings.STORAGE_BUCKET_NAME,
+        "Key": key,
+        "ResponseContentType": "application/force-download",
+        "ResponseContentDisposition": f'attachment;filename="{filename}"',
+    }
+
+    if version_id:
+        params["VersionId"] = version_id
+
+    # NOTE the URL is signed with the access key, so a new one is needed when the credentials change
+    cache_key = (
+        "presigned_download_url:"
+        + hashlib.sha256(
+            json.dumps(
+                [settings.STORAGE_ACCESS_KEY_ID, settings.STORAGE_ENDPOINT_URL, params]
+            ).encode()
+        ).hexdigest()
     )
-    return s3_client
+    url = cache.get(cache_key)
+
+    if url is None:
+        url = get_s3_client().generate_presigned_url(
+            "get_object",
+            Params=params,
+            ExpiresIn=settings.STORAGE_DOWNLOAD_URL_EXPIRES_IN,
+            HttpMethod="GET",
+        )
+        cache.set(
+            cache_key,
+            url,
+            settings.STORAGE_DOWNLOAD_URL_EXPIRES_IN
+            - settings.STORAGE_DOWNLOAD_URL_MIN_VALIDITY,
+        )
+
+    return url
 
 
 def get_sha256(file: IO) -> str:
-    """Return the sha256 hash of the file"""
-    if type(file) is InMemoryUploadedFile or type(file) is TemporaryUploadedFile:
-        return _get_sha256_memory_file(file)
-    else:
+    """Return the sha256 hash of the file
+
+    NOTE files uploaded with the handlers in `qfieldcloud.core.upload_handlers` already have their hash computed
+    while being received, so the file is not read again.
+    """
+    sha256sum = getattr(file, "sha256sum", None)
+    if sha256sum:
+        return sha256sum
+
+    # NOTE Django's `File` wraps the actual file object
+    raw_file = getattr(file, "file", file)
+
+    try:
+        if isinstance(raw_file, io.BytesIO):
+            return _get_sha256_buffer(raw_file)
+        else:
+            return _get_sha256_mmap(raw_file)
+    except (AttributeError, OSError, ValueError):
+        # not backed by memory or by a regular file, e.g. a pipe or a socket
         return _get_sha256_file(file)
+    finally:
+        if file.seekable():
+            file.seek(0)
 
 
-def _get_sha256_memory_file(
-    file: Union[InMemoryUploadedFile, TemporaryUploadedFile]
-) -> str:
-    BLOCKSIZE = 65536
+def _get_sha256_buffer(file: io.BytesIO) -> str:
+    """Hashes the contents of an in-memory file without copying them."""
+    with file.getbuffer() as buffer:
+        return hashlib.sha256(buffer).hexdigest()
+
+
+def _get_sha256_mmap(file: IO) -> str:
+    """Hashes the contents of a file on the disk by memory mapping it.
+
+    The whole file is passed to a single `update()` call, which releases the GIL while hashing,
+    instead of copying it chunk by chunk to Python objects.
+    """
     hasher = hashlib.sha256()
 
-    for chunk in file.chunks(BLOCKSIZE):
-        hasher.update(chunk)
+    # the data written to a temporary file might still be in Python's buffer
+    file.flush()
+
+    fileno = file.fileno()
+    file_stat = os.fstat(fileno)
+
+    # NOTE e.g. pipes have a file descriptor too, but they report a size of 0 whatever their contents
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise ValueError("Only regular files can be memory mapped.")
+
+    # NOTE empty files cannot be memory mapped
+    if file_stat.st_size > 0:
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+            hasher.update(mapped)
 
-    file.seek(0)
     return hasher.hexdigest()
 
 
 def _get_sha256_file(file: IO) -> str:
-    BLOCKSIZE = 65536
     hasher = hashlib.sha256()
-    buf = file.read(BLOCKSIZE)
-    while len(buf) > 0:
-        hasher.update(buf)
-        buf = file.read(BLOCKSIZE)
-    file.seek(0)
+
+    for chunk in iter(lambda: file.read(SHA256_BUFFER_SIZE), b""):
+        hasher.update(chunk)
+
     return hasher.hexdigest()
 
 
@@ -194,7 +388,10 @@ def is_qgis_project_file(filename: str) -> bool:
 
 def get_qgis_project_file(project_id: str) -> Optional[str]:
     """Return the relative path inside the project of the qgs/qgz file or
-    None if no qgs/qgz file is present"""
+    None if no qgs/qgz file is present
+
+    NOTE this lists the project files on the storage and is only used by migrations that run before the files index exists,
+    use `Project.project_filename` or `utils2.storage.get_project_filename` instead"""
 
     bucket = get_s3_bucket()
 
@@ -221,11 +418,133 @@ def check_s3_key(key: str) -> Optional[str]:
         else:
             raise e
 
-    metadata = head["Metadata"]
+    return get_sha256sum_from_metadata(head["Metadata"])
+
+
+def get_sha256sum_from_metadata(metadata: dict) -> Optional[str]:
+    """Returns the sha256 hashcode stored in the object's metadata, if any.
+
+    We cannot be sure of the metadata's first letter case
+    https://github.com/boto/boto3/issues/1709
+    """
     if "sha256sum" in metadata:
         return metadata["sha256sum"]
     else:
-        return metadata["Sha256sum"]
+        return metadata.get("Sha256sum")
+
+
+def get_sha256sums(
+    keys: Iterable[Tuple[str, Optional[str]]], max_workers: int = 10
+) -> Dict[Tuple[str, Optional[str]], Optional[str]]:
+    """Returns the sha256 hashcodes stored in the metadata of many objects.
+
+    The HEAD requests are made concurrently on a bounded thread pool sharing the same storage backend,
+    so the time needed is roughly the time of a single request times `len(keys) / max_workers`.
+
+    Args:
+        keys (Iterable[Tuple[str, Optional[str]]]): `(key, version_id)` pairs, `version_id` may be `None` for the latest version
+        max_workers (int, optional): maximum number of concurrent requests. Defaults to 10, the default botocore connection pool size.
+
+    Returns:
+        Dict[Tuple[str, Optional[str]], Optional[str]]: the sha256 hashcode per `(key, version_id)` pair, `None` if the object is missing or has no hashcode
+    """
+    # NOTE imported here, as the storage backends depend on this module
+    from qfieldcloud.core.utils2.storage_backends import get_storage_backend
+
+    keys = list(keys)
+
+    if not keys:
+        return {}
+
+    backend = get_storage_backend()
+
+    def head(key: str, version_id: Optional[str]) -> Optional[str]:
+        version = backend.head_object(key, version_id)
+
+        if version is None:
+            return None
+
+        return get_sha256sum_from_metadata(version.metadata)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        sha256sums = executor.map(lambda k: head(*k), keys)
+
+        return dict(zip(keys, sha256sums))
+
+
+def delete_object_versions(
+    versions: Iterable[Tuple[str, str]],
+    max_workers: int = 10,
+    on_deleted: Optional[Callable[[int], None]] = None,
+) -> int:
+    """Deletes many object versions with batched `DeleteObjects` requests.
+
+    Each request deletes up to 1000 versions, the maximum allowed by S3. The requests are made concurrently
+    on a bounded thread pool sharing the same client, while the versions are still being consumed,
+    so listing and deleting the versions of a large prefix overlap.
+
+    Args:
+        versions (Iterable[Tuple[str, str]]): `(key, version_id)` pairs
+        max_workers (int, optional): maximum number of concurrent requests. Defaults to 10.
+        on_deleted (Callable[[int], None], optional): called in the calling thread with the number of versions deleted by each batch. Defaults to None.
+
+    Raises:
+        Exception: if the storage failed to delete any of the versions
+
+    Returns:
+        int: the number of deleted versions
+    """
+    client = get_s3_client()
+
+    def delete(batch: List[Tuple[str, str]]) -> int:
+        response = client.delete_objects(
+            Bucket=settings.STORAGE_BUCKET_NAME,
+            Delete={
+                "Objects": [{"Key": k, "VersionId": v} for k, v in batch],
+                "Quiet": True,
+            },
+        )
+
+        errors = response.get("Errors", [])
+        if errors:
+            raise Exception(
+                f'Failed to delete {len(errors)} object version(s), first error on "{errors[0]["Key"]}": {errors[0]["Message"]}'
+            )
+
+        return len(batch)
+
+    deleted_count = 0
+    versions = iter(versions)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = set()
+
+        def collect(return_when: str) -> None:
+            nonlocal futures, deleted_count
+
+            done, futures = wait(futures, return_when=return_when)
+            for future in done:
+                count = future.result()
+                deleted_count += count
+
+                if on_deleted:
+                    on_deleted(count)
+
+        while True:
+            batch = list(islice(versions, 1000))
+
+            if not batch:
+                break
+
+            futures.add(executor.submit(delete, batch))
+
+            # keep a bounded number of batches in memory
+            if len(futures) >= max_workers:
+                collect(FIRST_COMPLETED)
+
+        collect(ALL_COMPLETED)
+
+    return deleted_count
 
 
 def get_deltafile_schema_validator() -> jsonschema.Draft7Validator:
@@ -277,41 +596,8 @@ def get_project_files_with_versions(project_id: str) -> Iterable[S3ObjectWithVer
     return list_files_with_versions(bucket, prefix, strip_prefix=True)
 
 
-def get_project_package_files(project_id: str) -> Iterable[S3Object]:
-    """Returns a list of package files.
-
-    Args:
-        project_id (str): the project id
-
-    Returns:
-        Iterable[S3ObjectWithVersions]: the list of package files
-    """
-    bucket = get_s3_bucket()
-    prefix = f"projects/{project_id}/export/"
-
-    return list_files(bucket, prefix, strip_prefix=True)
-
-
-def get_project_files_count(project_id: str) -> int:
-    """Returns the number of files within a project."""
-    bucket = get_s3_bucket()
-    prefix = f"projects/{project_id}/files/"
-    files = list(bucket.objects.filter(Prefix=prefix))
-
-    return len(files)
-
-
-def get_project_package_files_count(project_id: str) -> int:
-    """Returns the number of package files within a project."""
-    bucket = get_s3_bucket()
-    prefix = f"projects/{project_id}/export/"
-    files = list(bucket.objects.filter(Prefix=prefix))
-
-    return len(files)
-
-
 def get_s3_object_url(
-    key: str, bucket: mypy_boto3_s3.service_resource.Bucket = get_s3_bucket()
+    key: str, bucket: Optional[mypy_boto3_s3.service_resource.Bucket] = None
 ) -> str:
     """Returns the block storage URL for a given key. The key may not exist in the bucket.
 
@@ -322,6 +608,9 @@ def get_s3_object_url(
     Returns:
         str: URL
     """
+    if bucket is None:
+        bucket = get_s3_bucket()
+
     return f"{settings.STORAGE_ENDPOINT_URL_EXTERNAL}/{bucket.name}/{key}"
 
 
@@ -0,0 +1,180 @@
+import hashlib
+import re
+import tarfile
+from datetime import datetime
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ArchiveMember(NamedTuple):
+    name: str
+    key: str
+    version_id: Optional[str]
+    size: int
+    last_modified: datetime
+
+
+class StorageRange(NamedTuple):
+    key: str
+    version_id: Optional[str]
+    start: int
+
+
+class TarArchive:
+    """Uncompressed tar archive of objects on the storage, streamed without buffering.
+
+    The tar format stores the file contents as they are, after a header of known size, so the size of the archive
+    and the position of each file in it are known in advance. This allows any byte range of the archive
+    to be streamed by reading only the needed ranges of the objects, e.g. to resume an interrupted download.
+    """
+
+    def __init__(self, members: Iterable[ArchiveMember]) -> None:
+        # the consecutive segments of the archive, either literal bytes or a range of an object
+        self.segments: List[Tuple[int, int, Union[bytes, StorageRange]]] = []
+        self.size = 0
+
+        hasher = hashlib.sha256()
+
+        for member in members:
+            info = tarfile.TarInfo(member.name)
+            info.size = member.size
+            info.mtime = int(member.last_modified.timestamp())
+            info.mode = 0o644
+
+            self._add(info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8"))
+            self._add(StorageRange(member.key, member.version_id, 0), member.size)
+            self._add(bytes(-member.size % BLOCK_SIZE))
+
+            # NOTE the last modified time tells the contents apart when the storage does not keep versions
+            hasher.update(
+                f"{member.name}\0{member.key}\0{member.version_id}\0{member.size}\0{info.mtime}\0".encode()
+            )
+
+        # the end of the archive is marked by two empty blocks
+        self._add(bytes(2 * BLOCK_SIZE))
+
+        self.etag = f'"{hasher.hexdigest()}"'
+
+    def _add(self, data: Union[bytes, StorageRange], size: int = None) -> None:
+        if size is None:
+            size = len(data)
+
+        if size:
+            self.segments.append((self.size, size, data))
+            self.size += size
+
+    def iter_bytes(self, start: int = 0, end: int = None) -> Iterator[bytes]:
+        """Yields the bytes of the archive from `start` to `end`, both inclusive."""
+        if end is None:
+            end = self.size - 1
+
+        backend = get_storage_backend()
+
+        for offset, size, data in self.segments:
+            if offset + size <= start:
+                continue
+
+            if offset > end:
+                break
+
+            # the part of the segment within the requested range
+            segment_start = max(start - offset, 0)
+            segment_end = min(end - offset, size - 1)
+
+            if isinstance(data, bytes):
+                segment_stop = segment_end + 1
+                yield data[segment_start:segment_stop]
+                continue
+
+            yield from backend.iter_object(
+                data.key,
+                data.version_id,
+                data.start + segment_start,
+                data.start + segment_end,
+            )
+
+
+def get_archive_response(
+    request: HttpRequest, members: Iterable[ArchiveMember], filename: str
+) -> HttpResponse:
+    """Returns a response streaming a tar archive of the given objects, supporting single byte range requests.
+
+    The archive is identified by its `ETag`. A download should be resumed with both `Range` and `If-Range`,
+    so the whole archive is sent again if it has changed meanwhile, e.g. if the project has been packaged again
+    and the previous package versions have been deleted. Alternatively, `If-Match` makes the request fail with 412.
+
+    If an object is deleted while being sent, the response is cut short of its `Content-Length`
+    and should be retried as an interrupted download.
+
+    NOTE the archive is sent by the app server, so each request is bound to its timeout, 300 seconds with
+    the default gunicorn `-t 300`. Archives that cannot be sent within that time are sent in several requests
+    by resuming the download, or should rather be downloaded file by file from the storage.
+
+    Args:
+        request (HttpRequest): the request, whose `Range`, `If-Range` and `If-Match` headers are honored
+        members (Iterable[ArchiveMember]): the objects to be archived
+        filename (str): the filename of the archive to be downloaded
+
+    Returns:
+        HttpResponse: the streaming response
+    """
+    archive = TarArchive(members)
+    start = 0
+    end = archive.size - 1
+    status = 200
+
+    if_match = [etag.strip() for etag in request.headers.get("If-Match", "").split(",")]
+
+    if any(if_match) and "*" not in if_match and archive.etag not in if_match:
+        response = HttpResponse(status=412)
+        response["ETag"] = archive.etag
+
+        return response
+
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+
+    # the range is ignored if the archive has changed since the first part was downloaded
+    if range_header and (not if_range or if_range == archive.etag):
+        match = RANGE_REGEX.match(range_header.strip())
+
+        # NOTE multiple ranges are not supported, in which case the whole archive is sent
+        if match and any(match.groups()):
+            first, last = match.groups()
+
+            if not first:
+                # suffix range, e.g. the last 500 bytes
+                start = max(archive.size - int(last), 0)
+            else:
+                start = int(first)
+
+                if last:
+                    end = min(int(last), archive.size - 1)
+
+            if start > end:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{archive.size}"
+
+                return response
+
+            status = 206
+
+    response = StreamingHttpResponse(
+        archive.iter_bytes(start, end),
+        status=status,
+        content_type="application/x-tar",
+    )
+    response["Content-Length"] = end - start + 1
+    response["Content-Disposition"] = f'attachment;filename="{filename}"'
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = archive.etag
+
+    if status == 206:
+        response["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+
+    return response
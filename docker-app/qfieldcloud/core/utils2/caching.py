@@ -0,0 +1,88 @@
+import functools
+import uuid
+from typing import Callable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def _get_project_version_key(project_id) -> str:
+    return f"project_cache_version:{project_id}"
+
+
+def get_project_cache_version(project_id) -> str:
+    """Returns the current cache version of a project, the cached values of older versions are never read again.
+
+    NOTE the version is a random token rather than a counter, so a version evicted from the cache
+    can never be reused for values that were cached before the eviction.
+    """
+    key = _get_project_version_key(project_id)
+    version = cache.get(key)
+
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        # NOTE another process might have set it meanwhile
+        version = cache.get(key)
+
+    # if the cache is not available at all, a new version every time means nothing is ever reused
+    return version or uuid.uuid4().hex
+
+
+def invalidate_project_cache(project_id) -> None:
+    """Invalidates all the cached values of a project.
+
+    Within a transaction, the cache is invalidated only once it is committed,
+    otherwise a concurrent request might cache the data of before the transaction again.
+    """
+
+    def invalidate():
+        cache.set(_get_project_version_key(project_id), uuid.uuid4().hex, None)
+
+    transaction.on_commit(invalidate)
+
+
+def cache_project_response(
+    project_id_kwarg: str = "projectid",
+    timeout: Optional[int] = None,
+) -> Callable:
+    """Decorator caching the data of the successful responses of a project API view handler,
+    until they expire or `invalidate_project_cache` is called for the project.
+
+    The permissions are checked by the view before the handler is called, so the cached data is shared
+    by all the users allowed to read it. Only use it for data that is the same for all of them.
+
+    Args:
+        project_id_kwarg (str, optional): the URL kwarg with the project id. Defaults to "projectid".
+        timeout (Optional[int], optional): timeout in seconds, `PROJECT_CACHE_TIMEOUT` if not given. Defaults to None.
+    """
+
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            project_id = kwargs[project_id_kwarg]
+            key = f"project_response:{type(view).__module__}.{type(view).__qualname__}:{request.get_full_path()}"
+
+            version = get_project_cache_version(project_id)
+            data = cache.get(key, version=version)
+
+            if data is not None:
+                return Response(data)
+
+            response = handler(view, request, *args, **kwargs)
+
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(
+                    key,
+                    response.data,
+                    timeout if timeout is not None else settings.PROJECT_CACHE_TIMEOUT,
+                    version=version,
+                )
+
+            return response
+
+        return wrapper
+
+    return decorator
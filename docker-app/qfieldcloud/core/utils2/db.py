@@ -1,5 +1,9 @@
 import logging
+import select
+import time
 
+import psycopg2
+import psycopg2.extensions
 from django.conf import settings
 from django.db import connection, connections
 
@@ -10,6 +14,8 @@ class use_test_db_if_exists:
     """
     Context manager that updates django database settings to use the test db if it exists.
     Will be ignored if debug is False
+
+    NOTE the settings are changed for the whole process, so it must not be used while other threads query the database
     """
 
     def __enter__(self):
@@ -43,3 +49,96 @@ class use_test_db_if_exists:
         # invalidate connections so they are recreated with the modified dbname
         for conn in connections.all():
             conn.close()
+
+
+JOBS_CHANNEL = "qfieldcloud_jobs"
+
+
+def notify_jobs_changed() -> None:
+    """Notifies the workers that there might be new jobs to dequeue, see `JobsListener`.
+
+    NOTE Postgres delivers the notification only once the current transaction is committed,
+    so the job is always visible to the workers when they receive it.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_notify(%s, '')", [JOBS_CHANNEL])
+
+
+class JobsListener:
+    """Listens to the notifications sent by `notify_jobs_changed` on a dedicated connection,
+    so the workers are woken up as soon as a job is created instead of polling the jobs table.
+
+    The connection follows the database currently used by Django, see `use_test_db_if_exists`.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._connection_params = None
+
+    def wait(self, timeout: float) -> bool:
+        """Waits for a notification.
+
+        NOTE the notifications sent before listening are lost, so right after (re)connecting
+        this returns `True` immediately for the jobs to be checked once more.
+
+        Args:
+            timeout (float): maximum time in seconds to wait
+
+        Returns:
+            bool: whether the jobs should be checked, `False` on timeout or connection error
+        """
+        try:
+            if not self._is_listening():
+                self._listen()
+
+                return True
+
+            if not self._connection.notifies:
+                if select.select([self._connection], [], [], timeout) == ([], [], []):
+                    return False
+
+                self._connection.poll()
+
+            notified = bool(self._connection.notifies)
+            # multiple notifications are handled at once by dequeuing until there are no more jobs
+            self._connection.notifies.clear()
+
+            return notified
+        except (psycopg2.Error, OSError) as err:
+            logger.warning(f"Failed to listen to the jobs notifications: {err}")
+            self.close()
+            time.sleep(timeout)
+
+            return False
+
+    def close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except psycopg2.Error:
+                pass
+
+        self._connection = None
+        self._connection_params = None
+
+    def _is_listening(self) -> bool:
+        return (
+            self._connection is not None
+            and not self._connection.closed
+            and self._connection_params == connection.get_connection_params()
+        )
+
+    def _listen(self) -> None:
+        self.close()
+
+        connection_params = connection.get_connection_params()
+
+        self._connection = psycopg2.connect(**connection_params)
+        self._connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        )
+
+        with self._connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {JOBS_CHANNEL}")
+
+        self._connection_params = connection_params
@@ -0,0 +1,183 @@
+import codecs
+import json
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# written by `logger_context` in the QGIS container when a step starts and ends
+STEP_START_MARKER = "::<<<::"
+STEP_END_MARKER = "::>>>::"
+
+# the output is stored in chunks of at most that many characters
+CHUNK_SIZE = 16 * 1024
+# only about that many of the latest chunks are kept while the job runs, the whole output is saved in `Job.output`
+MAX_CHUNKS = 256
+# a pending chunk is stored after that many seconds, even if not full
+FLUSH_SECONDS = 0.5
+# maximum number of chunks returned at once
+READ_CHUNKS = 64
+# the logs are removed after that many seconds without being written
+LOGS_TIMEOUT = 24 * 60 * 60
+
+CURSOR_REGEX = re.compile(r"^\d+-\d+$")
+
+
+def _get_output_key(job_id) -> str:
+    return cache.make_key(f"job_logs:{job_id}:output")
+
+
+def _get_state_key(job_id) -> str:
+    return cache.make_key(f"job_logs:{job_id}:state")
+
+
+class JobLogWriter:
+    """Stores the output of a running job in Redis, so it can be read before the job is finished.
+
+    The output is appended to a Redis stream in bounded chunks, the ids of the stream entries being the cursors
+    of `read_job_logs`. The step markers are parsed to tell which steps of the job have started and ended.
+
+    Storing the logs is best effort, the Redis errors are logged and the job runs regardless.
+    """
+
+    def __init__(self, job_id) -> None:
+        self.job_id = job_id
+        self.steps: List[Dict[str, Any]] = []
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""
+        self._line = ""
+        self._flushed_at = time.monotonic()
+        self._steps_changed = False
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection("default")
+
+    def write(self, data: bytes) -> None:
+        with self._lock:
+            text = self._decoder.decode(data)
+
+            self._pending += text
+            self._parse_steps(text)
+
+            if (
+                self._steps_changed
+                or len(self._pending) >= CHUNK_SIZE
+                or time.monotonic() - self._flushed_at >= FLUSH_SECONDS
+            ):
+                self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._pending += self._decoder.decode(b"", final=True)
+            self._flush(is_finished=True)
+
+    def _parse_steps(self, text: str) -> None:
+        lines = (self._line + text).split("\n")
+        # the last line is not complete yet
+        self._line = lines.pop()
+
+        for line in lines:
+            line = line.strip()
+
+            if line.startswith(STEP_START_MARKER):
+                payload = line.partition(STEP_START_MARKER)[2]
+                step_id, _sep, name = payload.partition(" ")
+                self.steps.append(
+                    {"id": step_id, "name": name, "stage": 1, "is_running": True}
+                )
+                self._steps_changed = True
+            elif line.startswith(STEP_END_MARKER):
+                payload = line.partition(STEP_END_MARKER)[2]
+                step_id, _sep, stage = payload.partition(" ")
+
+                for step in self.steps:
+                    if step["id"] == step_id:
+                        step["stage"] = int(stage) if stage.isdigit() else 1
+                        step["is_running"] = False
+                        self._steps_changed = True
+
+    def _flush(self, is_finished: bool = False) -> None:
+        output_key = _get_output_key(self.job_id)
+        state_key = _get_state_key(self.job_id)
+
+        try:
+            with self._redis.pipeline() as pipe:
+                while self._pending:
+                    pipe.xadd(
+                        output_key,
+                        {"output": self._pending[:CHUNK_SIZE]},
+                        maxlen=MAX_CHUNKS,
+                        approximate=True,
+                    )
+                    self._pending = self._pending[CHUNK_SIZE:]
+
+                if self._steps_changed or is_finished:
+                    pipe.set(
+                        state_key,
+                        json.dumps({"steps": self.steps, "is_finished": is_finished}),
+                    )
+
+                pipe.expire(output_key, LOGS_TIMEOUT)
+                pipe.expire(state_key, LOGS_TIMEOUT)
+                pipe.execute()
+        except RedisError as err:
+            logger.warning(f"Failed to store the logs of job {self.job_id}: {err}")
+            # do not keep piling up the output while Redis is not available
+            self._pending = ""
+
+        self._steps_changed = False
+        self._flushed_at = time.monotonic()
+
+
+def read_job_logs(job_id, cursor: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Returns the output of a job after the cursor, the new cursor and the progress of the steps.
+
+    Args:
+        job_id: the job id
+        cursor (Optional[str], optional): the cursor returned by the previous call, or from the start if not given.
+            Defaults to None.
+
+    Raises:
+        ValueError: if the cursor is invalid
+
+    Returns:
+        Optional[Dict[str, Any]]: the logs, `None` if not stored in Redis, e.g. the job has not started yet,
+            its logs have expired or Redis is not available
+    """
+    if cursor is not None and not CURSOR_REGEX.match(cursor):
+        raise ValueError(f'Invalid cursor "{cursor}"')
+
+    redis = get_redis_connection("default")
+
+    try:
+        state = redis.get(_get_state_key(job_id))
+        # NOTE the entries after the cursor, or from the oldest kept entry if the cursor has been trimmed
+        result = redis.xread(
+            {_get_output_key(job_id): cursor or "0-0"}, count=READ_CHUNKS
+        )
+    except RedisError as err:
+        logger.warning(f"Failed to read the logs of job {job_id}: {err}")
+        return None
+
+    if state is None and not result:
+        return None
+
+    state = json.loads(state) if state else {"steps": [], "is_finished": False}
+    entries = result[0][1] if result else []
+
+    if entries:
+        cursor = entries[-1][0].decode()
+
+    return {
+        "output": "".join(fields[b"output"].decode() for _id, fields in entries),
+        "cursor": cursor,
+        "steps": state["steps"],
+        # NOTE there might be more output to read even when the job is finished
+        "is_finished": state["is_finished"] and len(entries) < READ_CHUNKS,
+    }
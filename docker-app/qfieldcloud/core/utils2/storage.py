@@ -1,8 +1,32 @@
 from __future__ import annotations
 
-from typing import IO
+import hashlib
+import logging
+import math
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import PurePath
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import qfieldcloud.core.utils
+from botocore.errorfactory import ClientError
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from qfieldcloud.core import exceptions
+from qfieldcloud.core.utils2.caching import invalidate_project_cache
+from qfieldcloud.core.utils2.storage_backends import (
+    StorageObjectRange,
+    StorageObjectVersion,
+    get_storage_backend,
+)
+
+logger = logging.getLogger(__name__)
 
 
 def upload_user_avatar(user: "User", file: IO, mimetype: str) -> str:  # noqa: F821
@@ -18,8 +42,6 @@ def upload_user_avatar(user: "User", file: IO, mimetype: str) -> str:  # noqa: F
     Returns:
         str: URI to the avatar
     """
-    bucket = qfieldcloud.core.utils.get_s3_bucket()
-
     if mimetype == "image/svg+xml":
         extension = "svg"
     elif mimetype == "image/png":
@@ -30,21 +52,26 @@ def upload_user_avatar(user: "User", file: IO, mimetype: str) -> str:  # noqa: F
         raise Exception(f"Unknown mimetype: {mimetype}")
 
     key = f"users/{user.username}/avatar.{extension}"
-    bucket.upload_fileobj(
-        file,
-        key,
-        {
-            "ACL": "public-read",
-            "ContentType": mimetype,
-        },
-    )
+    get_storage_backend().put_object(file, key, content_type=mimetype, is_public=True)
     return key
 
 
+def _remove_object_versions(key: str) -> None:
+    """Permanently removes all the versions of the object."""
+    # NOTE an empty key would be the prefix of all the objects
+    if not key:
+        return
+
+    backend = get_storage_backend()
+    backend.delete_object_versions(
+        (v.key, v.id)
+        for v in backend.list_versions(key, strip_prefix=False)
+        if v.key == key
+    )
+
+
 def remove_user_avatar(user: "User") -> None:  # noqa: F821
-    bucket = qfieldcloud.core.utils.get_s3_bucket()
-    key = user.useraccount.avatar_uri
-    bucket.object_versions.filter(Prefix=key).delete()
+    _remove_object_versions(user.useraccount.avatar_uri)
 
 
 def upload_project_thumbail(
@@ -63,8 +90,6 @@ def upload_project_thumbail(
     Returns:
         str: URI to the thumbnail
     """
-    bucket = qfieldcloud.core.utils.get_s3_bucket()
-
     # for now we always expect PNGs
     if mimetype == "image/svg+xml":
         extension = "svg"
@@ -75,16 +100,17 @@ def upload_project_thumbail(
     else:
         raise Exception(f"Unknown mimetype: {mimetype}")
 
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+
     key = f"projects/{project.id}/meta/{filename}.{extension}"
-    bucket.upload_fileobj(
-        file,
-        key,
-        {
-            # TODO most probably this is not public-read, since the project might be private
-            "ACL": "public-read",
-            "ContentType": mimetype,
-        },
-    )
+    # TODO most probably this is not public-read, since the project might be private
+    get_storage_backend().put_object(file, key, content_type=mimetype, is_public=True)
+
+    # NOTE each upload adds a version, the previous ones are kept
+    update_storage_usage(project, size, 1)
+
     return key
 
 
@@ -93,6 +119,894 @@ def remove_project_thumbail(project: "Project") -> None:  # noqa: F821
 
     NOTE you need to remove the URI to the project manually
     """
-    bucket = qfieldcloud.core.utils.get_s3_bucket()
-    key = project.thumbnail_uri
-    bucket.object_versions.filter(Prefix=key).delete()
+    _remove_object_versions(project.thumbnail_uri)
+
+
+def _file_version_name(project: "Project", key: str) -> str:  # noqa: F821
+    """Returns the project relative file name of a storage key."""
+    return PurePath(key).relative_to(f"projects/{project.id}/files").as_posix()
+
+
+def _get_pending_cleanups(
+    project: "Project",  # noqa: F821
+) -> List["StorageCleanup"]:  # noqa: F821
+    """Returns the cleanups of the project objects that are not yet done.
+
+    The versions they cover are already removed from the database and must not be counted or indexed again.
+    """
+    StorageCleanup = apps.get_model("core", "StorageCleanup")
+    prefix = f"projects/{project.id}/"
+
+    return list(
+        StorageCleanup.objects.filter(key__startswith=prefix).exclude(
+            status=StorageCleanup.Status.FINISHED
+        )
+    )
+
+
+def _filter_cleanups(
+    versions: Iterable[StorageObjectVersion],
+    cleanups: List["StorageCleanup"],  # noqa: F821
+    covered: bool = False,
+) -> Iterator[StorageObjectVersion]:
+    """Yields the versions not covered by any of the cleanups, or only the covered ones, see `StorageCleanup.covers`."""
+    backend = get_storage_backend()
+    delete_markers_last_modified = {}
+
+    for cleanup in cleanups:
+        if cleanup.is_prefix or not cleanup.delete_marker_id:
+            continue
+
+        # NOTE the S3 API lists the delete markers separately from the versions, so they are looked up beforehand
+        for version in backend.list_versions(cleanup.key, strip_prefix=False):
+            if version.id == cleanup.delete_marker_id:
+                delete_markers_last_modified[cleanup.pk] = version.last_modified
+                break
+
+    for version in versions:
+        is_covered = any(
+            c.covers(
+                version.key,
+                version.id,
+                version.last_modified,
+                delete_markers_last_modified.get(c.pk),
+            )
+            for c in cleanups
+        )
+
+        if is_covered == covered:
+            yield version
+
+
+def add_file_version(
+    project: "Project",  # noqa: F821
+    filename: str,
+    sha256sum: str,
+    version: Optional[StorageObjectVersion] = None,
+    is_verified: bool = True,
+) -> "FileVersion":  # noqa: F821
+    """Adds the latest version of an uploaded project file to the files index.
+
+    NOTE if the stored version is not given, this will make a HEAD request to get the version details from the storage
+
+    Args:
+        project (Project): the project the file belongs to
+        filename (str): the filename relative to the project files directory
+        sha256sum (str): the sha256 hashcode of the uploaded file
+        version (StorageObjectVersion, optional): the stored version, as returned by `StorageBackend.put_object`. Defaults to None.
+        is_verified (bool, optional): whether the sha256 hashcode has been computed from the stored contents. Defaults to True.
+
+    Returns:
+        FileVersion: the indexed file version
+    """
+    key = qfieldcloud.core.utils.safe_join(f"projects/{project.id}/files/", filename)
+    name = _file_version_name(project, key)
+
+    if version is None:
+        version = get_storage_backend().head_object(key)
+        assert version
+
+    with transaction.atomic():
+        project.file_versions.filter(name=name, is_latest=True).update(is_latest=False)
+        file_version, created = project.file_versions.update_or_create(
+            name=name,
+            version_id=version.id,
+            defaults={
+                "size": version.size,
+                "sha256": sha256sum,
+                "last_modified": version.last_modified,
+                "is_latest": True,
+                "is_verified": is_verified,
+            },
+        )
+
+        if created:
+            update_storage_usage(project, file_version.size, 1)
+
+        invalidate_project_cache(project.id)
+
+    return file_version
+
+
+def add_file_blob_version(
+    project: "Project", filename: str, file: File, sha256sum: str  # noqa: F821
+) -> Tuple["FileVersion", bool]:  # noqa: F821
+    """Adds a version of a project file that references a deduplicated blob, see `STORAGE_DEDUPLICATE_FILES`.
+
+    The file is uploaded only if there is no blob with the same contents yet.
+    No version is added if the contents are the same as the latest version of the file.
+
+    NOTE the sha256 hashcode must be computed by the server from the file contents, never declared by the client
+
+    Args:
+        project (Project): the project the file belongs to
+        filename (str): the filename relative to the project files directory
+        file (File): the uploaded file
+        sha256sum (str): the sha256 hashcode of the uploaded file
+
+    Returns:
+        Tuple[FileVersion, bool]: the latest file version and whether it has been created
+    """
+    FileBlob = apps.get_model("core", "FileBlob")
+    key = qfieldcloud.core.utils.safe_join(f"projects/{project.id}/files/", filename)
+    name = _file_version_name(project, key)
+
+    latest = project.file_versions.filter(name=name, is_latest=True).first()
+    if latest and latest.is_verified and latest.sha256 == sha256sum:
+        return latest, False
+
+    with transaction.atomic():
+        # lock the blob, so it cannot be collected before it is referenced, see `collect_file_blobs`
+        blob = FileBlob.objects.select_for_update().filter(sha256=sha256sum).first()
+
+        if blob is None:
+            get_storage_backend().put_object(
+                file, f"blobs/{sha256sum}", {"Sha256sum": sha256sum}
+            )
+            # NOTE the same blob might have been uploaded concurrently
+            blob, _created = FileBlob.objects.get_or_create(
+                sha256=sha256sum, defaults={"size": file.size}
+            )
+
+        project.file_versions.filter(name=name, is_latest=True).update(is_latest=False)
+        file_version = project.file_versions.create(
+            name=name,
+            version_id=uuid.uuid4().hex,
+            size=blob.size,
+            sha256=sha256sum,
+            last_modified=timezone.now(),
+            is_latest=True,
+            blob=blob,
+        )
+
+        update_storage_usage(project, file_version.size, 1)
+        invalidate_project_cache(project.id)
+
+    return file_version, True
+
+
+def get_file_version(
+    project: "Project", filename: str, version_id: str = None  # noqa: F821
+) -> Optional["FileVersion"]:  # noqa: F821
+    """Returns the given or the latest version of a project file from the files index, if any."""
+    key = qfieldcloud.core.utils.safe_join(f"projects/{project.id}/files/", filename)
+    file_versions = project.file_versions.filter(name=_file_version_name(project, key))
+
+    if version_id:
+        return file_versions.filter(version_id=version_id).first()
+    else:
+        return file_versions.filter(is_latest=True).first()
+
+
+def _hash_file_blocks(
+    key: str, version_id: Optional[str], block_size: int
+) -> Tuple[str, int, List[str]]:
+    """Reads an object from the storage and returns its sha256 hashcode, its size and the sha256 hashcode of each of its blocks."""
+    hasher = hashlib.sha256()
+    block_hasher = hashlib.sha256()
+    block_sha256s = []
+    block_filled = 0
+    size = 0
+
+    for chunk in get_storage_backend().iter_object(key, version_id):
+        hasher.update(chunk)
+        size += len(chunk)
+
+        # the chunks are not aligned with the blocks, slice them without copying
+        view = memoryview(chunk)
+        while view:
+            remaining = block_size - block_filled
+            block_hasher.update(view[:remaining])
+            block_filled += min(len(view), remaining)
+            view = view[remaining:]
+
+            if block_filled == block_size:
+                block_sha256s.append(block_hasher.hexdigest())
+                block_hasher = hashlib.sha256()
+                block_filled = 0
+
+    if block_filled:
+        block_sha256s.append(block_hasher.hexdigest())
+
+    return hasher.hexdigest(), size, block_sha256s
+
+
+def get_file_block_sha256s(file_version: "FileVersion") -> List[str]:  # noqa: F821
+    """Returns the sha256 hashcode of each `STORAGE_FILE_BLOCK_SIZE` block of a file version.
+
+    NOTE the hashcodes are computed and stored the first time they are needed, which reads the whole file from the storage
+
+    Args:
+        file_version (FileVersion): the file version
+
+    Returns:
+        List[str]: the block hashcodes
+    """
+    block_size = settings.STORAGE_FILE_BLOCK_SIZE
+
+    if file_version.block_sha256s is None or file_version.block_size != block_size:
+        _sha256sum, _size, block_sha256s = _hash_file_blocks(
+            file_version.key,
+            None if file_version.blob_id else file_version.version_id,
+            block_size,
+        )
+
+        file_version.block_size = block_size
+        file_version.block_sha256s = block_sha256s
+        file_version.save(update_fields=["block_size", "block_sha256s"])
+
+    return file_version.block_sha256s
+
+
+def upload_file_blocks(
+    project: "Project",  # noqa: F821
+    filename: str,
+    base_version: "FileVersion",  # noqa: F821
+    size: int,
+    sha256sum: str,
+    blocks: Dict[int, File],
+) -> "FileVersion":  # noqa: F821
+    """Adds a new version of a project file, sending only the blocks that changed since the base version.
+
+    The new object is assembled on the storage with `StorageBackend.compose_object`, where each block is a part:
+    the given `blocks` are uploaded and all the others are copied from the base version on the storage side.
+    Its size is checked block by block and its block hashcodes are composed from the ones of the base version
+    and the ones of the uploaded blocks. The sha256 hashcode of the whole file cannot be composed from them though,
+    so the new object is verified against the declared one like the direct uploads, see `add_verified_file_version`.
+
+    Args:
+        project (Project): the project the file belongs to
+        filename (str): the filename relative to the project files directory
+        base_version (FileVersion): the version the changed blocks were computed against
+        size (int): the size of the new file
+        sha256sum (str): the sha256 hashcode of the new file
+        blocks (Dict[int, File]): the changed blocks of the new file by their zero based index
+
+    Raises:
+        exceptions.ValidationError: if the blocks do not make up a file with the declared size,
+            or the declared sha256 hashcode when verified right away
+
+    Returns:
+        FileVersion: the new file version
+    """
+    base_block_sha256s = get_file_block_sha256s(base_version)
+    block_size = base_version.block_size
+    blocks_count = math.ceil(size / block_size)
+
+    if any(index < 0 or index >= blocks_count for index in blocks):
+        raise exceptions.ValidationError("Unexpected block beyond the file size.")
+
+    for index in range(blocks_count):
+        start = index * block_size
+        expected_size = min(block_size, size - start)
+
+        if index in blocks:
+            actual_size = blocks[index].size
+        else:
+            # the block is copied from the base version
+            actual_size = min(block_size, max(base_version.size - start, 0))
+
+        if actual_size != expected_size:
+            raise exceptions.ValidationError(
+                f"Block {index} is missing or does not have the expected size of {expected_size} bytes."
+            )
+
+    key = qfieldcloud.core.utils.safe_join(f"projects/{project.id}/files/", filename)
+    # NOTE the blob keys are not versioned, their contents never change
+    base_version_id = None if base_version.blob_id else base_version.version_id
+    parts = []
+    block_sha256s = []
+
+    for index in range(blocks_count):
+        if index in blocks:
+            parts.append(blocks[index])
+            block_sha256s.append(qfieldcloud.core.utils.get_sha256(blocks[index]))
+        else:
+            start = index * block_size
+            end = min(start + block_size, base_version.size) - 1
+            parts.append(
+                StorageObjectRange(base_version.key, base_version_id, start, end)
+            )
+            block_sha256s.append(base_block_sha256s[index])
+
+    try:
+        version = get_storage_backend().compose_object(
+            key, parts, {"Sha256sum": sha256sum}
+        )
+    except (ClientError, FileNotFoundError) as err:
+        raise exceptions.ValidationError(f"Failed to assemble the file: {err}")
+
+    return add_verified_file_version(
+        project, filename, version, size, sha256sum, block_sha256s
+    )
+
+
+def add_verified_file_version(
+    project: "Project",  # noqa: F821
+    filename: str,
+    version: StorageObjectVersion,
+    size: int,
+    sha256sum: str,
+    block_sha256s: List[str] = None,
+) -> "FileVersion":  # noqa: F821
+    """Adds a version uploaded with a sha256 hashcode declared by the client, which is verified against the stored contents.
+
+    The size is checked right away. The contents of the versions up to `STORAGE_INLINE_VERIFICATION_MAX_SIZE`
+    are read back and hashed within the request too. The bigger versions would take too long to be read back,
+    they are indexed as not verified and verified later by `verify_file_versions`, which removes them if invalid.
+
+    Args:
+        project (Project): the project the file belongs to
+        filename (str): the filename relative to the project files directory
+        version (StorageObjectVersion): the uploaded version, as returned by `StorageBackend.head_object`
+        size (int): the declared size
+        sha256sum (str): the declared sha256 hashcode
+        block_sha256s (List[str], optional): the `STORAGE_FILE_BLOCK_SIZE` block hashcodes, if already known. Defaults to None.
+
+    Raises:
+        exceptions.ValidationError: if the version does not match the declared size, or the declared sha256 hashcode
+            when verified right away
+
+    Returns:
+        FileVersion: the indexed file version
+    """
+    block_size = settings.STORAGE_FILE_BLOCK_SIZE
+    is_verified = False
+
+    if version.size != size:
+        is_valid = False
+    elif size <= settings.STORAGE_INLINE_VERIFICATION_MAX_SIZE:
+        stored_sha256sum, _size, block_sha256s = _hash_file_blocks(
+            version.key, version.id, block_size
+        )
+        is_valid = is_verified = stored_sha256sum == sha256sum
+    else:
+        is_valid = True
+
+    if not is_valid:
+        # remove the invalid upload, not just hide it behind a delete marker
+        get_storage_backend().delete_object_versions([(version.key, version.id)])
+
+        raise exceptions.ValidationError(
+            "The uploaded file does not match the declared size and sha256."
+        )
+
+    file_version = add_file_version(project, filename, sha256sum, version, is_verified)
+
+    if block_sha256s is not None:
+        file_version.block_size = block_size
+        file_version.block_sha256s = block_sha256s
+        file_version.save(update_fields=["block_size", "block_sha256s"])
+
+    return file_version
+
+
+def verify_file_version(file_version: "FileVersion") -> bool:  # noqa: F821
+    """Verifies the declared sha256 hashcode of a file version against its stored contents, see `add_verified_file_version`.
+
+    An invalid version is deleted from the storage and removed from the files index,
+    the previous version of the file, if any, becomes the latest again.
+
+    Args:
+        file_version (FileVersion): the version to be verified
+
+    Returns:
+        bool: whether the version is valid
+    """
+    block_size = settings.STORAGE_FILE_BLOCK_SIZE
+    stored_sha256sum, stored_size, block_sha256s = _hash_file_blocks(
+        file_version.key, file_version.version_id, block_size
+    )
+
+    if stored_sha256sum == file_version.sha256 and stored_size == file_version.size:
+        file_version.is_verified = True
+        file_version.block_size = block_size
+        file_version.block_sha256s = block_sha256s
+        file_version.save(update_fields=["is_verified", "block_size", "block_sha256s"])
+
+        return True
+
+    logger.warning(
+        f'Removing the version "{file_version}", whose contents do not match its declared sha256.'
+    )
+
+    get_storage_backend().delete_object_versions(
+        [(file_version.key, file_version.version_id)]
+    )
+
+    project = file_version.project
+    with transaction.atomic():
+        file_version.delete()
+
+        if file_version.is_latest:
+            previous = (
+                project.file_versions.filter(name=file_version.name)
+                .order_by("-last_modified")
+                .first()
+            )
+
+            if previous:
+                previous.is_latest = True
+                previous.save(update_fields=["is_latest"])
+
+        update_storage_usage(project, -file_version.size, -1)
+        invalidate_project_cache(project.id)
+
+    return False
+
+
+def verify_file_versions() -> Tuple[int, int]:
+    """Verifies all the file versions whose declared sha256 hashcode has not been verified yet, see `verify_file_version`.
+
+    Returns:
+        Tuple[int, int]: the number of valid and of removed versions
+    """
+    FileVersion = apps.get_model("core", "FileVersion")
+
+    valid_count = 0
+    removed_count = 0
+    for file_version in FileVersion.objects.filter(is_verified=False).select_related(
+        "project"
+    ):
+        try:
+            if verify_file_version(file_version):
+                valid_count += 1
+            else:
+                removed_count += 1
+        except Exception as err:
+            logger.error(f'Failed to verify the version "{file_version}": {err}')
+
+    return valid_count, removed_count
+
+
+def get_project_filename(project: "Project") -> Optional[str]:  # noqa: F821
+    """Returns the filename of the QGIS project file (qgs/qgz) of the project, as found in the files index.
+
+    NOTE only one QGIS project file is allowed per project, if there are more the most recently modified is returned
+
+    Args:
+        project (Project): the project
+
+    Returns:
+        Optional[str]: the project relative filename or None if the project has no QGIS project file
+    """
+    return (
+        project.file_versions.filter(is_latest=True)
+        .filter(Q(name__endswith=".qgs") | Q(name__endswith=".qgz"))
+        .order_by("-last_modified")
+        .values_list("name", flat=True)
+        .first()
+    )
+
+
+def get_files_manifest(project: "Project") -> List[Dict[str, Any]]:  # noqa: F821
+    """Returns the storage location of the latest version of each project file.
+
+    Used by the worker to download the project files when some of them are stored as blobs,
+    or have not been verified yet, so the worker neither trusts their stored `Sha256sum` metadata.
+    """
+    return [
+        {
+            "name": file_version.name,
+            "key": file_version.key,
+            "version_id": None if file_version.blob_id else file_version.version_id,
+            # NOTE the sha256 hashcodes declared by the clients are not trusted until verified
+            "sha256": file_version.sha256 if file_version.is_verified else None,
+            "size": file_version.size,
+        }
+        for file_version in project.file_versions.filter(is_latest=True)
+    ]
+
+
+def collect_file_blobs() -> int:
+    """Deletes the blobs that are no longer referenced by any file version, both from the storage and the database.
+
+    Returns:
+        int: the number of deleted blobs
+    """
+    FileBlob = apps.get_model("core", "FileBlob")
+    backend = get_storage_backend()
+
+    deleted_count = 0
+    for sha256sum in FileBlob.objects.filter(file_versions__isnull=True).values_list(
+        "sha256", flat=True
+    ):
+        with transaction.atomic():
+            # lock the blob and check again, it might have been referenced in the meantime
+            blob = (
+                FileBlob.objects.select_for_update(of=("self",))
+                .filter(sha256=sha256sum, file_versions__isnull=True)
+                .first()
+            )
+
+            if blob is None:
+                continue
+
+            # NOTE the blob is deleted from the storage while locked, so a concurrent upload of the same contents waits and uploads it again
+            backend.delete_object_versions(
+                (v.key, v.id)
+                for v in backend.list_versions(blob.key, strip_prefix=False)
+                if v.key == blob.key
+            )
+            blob.delete()
+
+        deleted_count += 1
+
+    return deleted_count
+
+
+def remove_file_versions(project: "Project", filename: str) -> None:  # noqa: F821
+    """Removes all the versions of a project file from the files index."""
+    key = qfieldcloud.core.utils.safe_join(f"projects/{project.id}/files/", filename)
+    file_versions = project.file_versions.filter(name=_file_version_name(project, key))
+
+    with transaction.atomic():
+        usage = file_versions.aggregate(size=Sum("size"), count=Count("pk"))
+        file_versions.delete()
+        update_storage_usage(project, -(usage["size"] or 0), -usage["count"])
+        invalidate_project_cache(project.id)
+
+
+def prune_file_versions(
+    project: "Project", batch_size: int = 1000  # noqa: F821
+) -> int:
+    """Deletes the old versions of the project files according to the project's retention policy,
+    see `Project.file_versions_retention`. The latest version of a file is never deleted.
+
+    The versions are deleted from the storage with batched `DeleteObjects` requests first and then removed from the files index,
+    so a failure in between leaves only index entries that `sync_file_versions` removes.
+    The versions referencing a blob only lose the reference, the unreferenced blobs are deleted by `collect_file_blobs`.
+
+    Args:
+        project (Project): the project
+        batch_size (int, optional): number of versions deleted at once. Defaults to 1000.
+
+    Returns:
+        int: the number of deleted versions
+    """
+    to_keep, max_age = project.file_versions_retention
+
+    if to_keep is None and max_age is None:
+        return 0
+
+    FileVersion = apps.get_model("core", "FileVersion")
+    min_last_modified = timezone.now() - max_age if max_age is not None else None
+
+    def pruned_versions():
+        name = None
+        position = 0
+
+        # NOTE only the fields needed to rank the versions and build their storage keys, streamed in chunks
+        file_versions = (
+            project.file_versions.order_by("name", "-last_modified")
+            .only("project", "blob", "name", "version_id", "last_modified", "is_latest")
+            .iterator(chunk_size=batch_size)
+        )
+
+        for file_version in file_versions:
+            if file_version.name != name:
+                name = file_version.name
+                position = 0
+
+            position += 1
+
+            if file_version.is_latest:
+                continue
+
+            if (to_keep is not None and position > to_keep) or (
+                min_last_modified is not None
+                and file_version.last_modified < min_last_modified
+            ):
+                yield file_version
+
+    deleted_count = 0
+    file_versions = pruned_versions()
+
+    while True:
+        batch = list(islice(file_versions, batch_size))
+
+        if not batch:
+            break
+
+        get_storage_backend().delete_object_versions(
+            (fv.key, fv.version_id) for fv in batch if not fv.blob_id
+        )
+
+        with transaction.atomic():
+            deleted_versions = FileVersion.objects.filter(
+                pk__in=[fv.pk for fv in batch]
+            )
+            usage = deleted_versions.aggregate(size=Sum("size"), count=Count("pk"))
+            deleted_versions.delete()
+            update_storage_usage(project, -(usage["size"] or 0), -usage["count"])
+            invalidate_project_cache(project.id)
+
+        deleted_count += usage["count"]
+
+    return deleted_count
+
+
+def sync_file_versions(
+    project: "Project", dry_run: bool = False  # noqa: F821
+) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """Synchronizes the project files index with the object versions on the storage.
+
+    Versions missing in the index are added, versions no longer on the storage are removed
+    and the latest version flags are updated. The versions referencing blobs are left untouched.
+
+    NOTE this lists all the object versions of the project files on the storage and
+    makes a HEAD request for each version missing in the index, see `get_sha256sums`.
+
+    Args:
+        project (Project): the project to be synchronized
+        dry_run (bool, optional): only compare the index with the storage. Defaults to False.
+
+    Returns:
+        Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]: the `(name, version_id)` pairs missing from and extra in the index
+    """
+    prefix = f"projects/{project.id}/files/"
+
+    cleanups = _get_pending_cleanups(project)
+
+    stored_versions = {}
+    for version in _filter_cleanups(
+        get_storage_backend().list_versions(prefix), cleanups
+    ):
+        if version.is_delete_marker:
+            continue
+
+        stored_versions[(version.name, version.id)] = version
+
+    # the versions referencing blobs are not stored under the project prefix
+    indexed_versions = {
+        (v.name, v.version_id): v
+        for v in project.file_versions.filter(blob__isnull=True)
+    }
+
+    missing = sorted(set(stored_versions.keys()) - set(indexed_versions.keys()))
+    extra = sorted(set(indexed_versions.keys()) - set(stored_versions.keys()))
+
+    if dry_run:
+        return missing, extra
+
+    sha256sums = qfieldcloud.core.utils.get_sha256sums(
+        (stored_versions[k].key, stored_versions[k].id) for k in missing
+    )
+
+    new_file_versions = []
+    for name, version_id in missing:
+        version = stored_versions[(name, version_id)]
+
+        new_file_versions.append(
+            project.file_versions.model(
+                project=project,
+                name=name,
+                version_id=version_id,
+                size=version.size,
+                sha256=sha256sums[(version.key, version_id)],
+                last_modified=version.last_modified,
+                is_latest=version.is_latest,
+            )
+        )
+
+    with transaction.atomic():
+        project.file_versions.filter(
+            pk__in=[indexed_versions[key].pk for key in extra]
+        ).delete()
+
+        project.file_versions.bulk_create(new_file_versions)
+
+        update_storage_usage(
+            project,
+            sum(v.size for v in new_file_versions)
+            - sum(indexed_versions[key].size for key in extra),
+            len(new_file_versions) - len(extra),
+        )
+
+        for key, file_version in indexed_versions.items():
+            if key not in stored_versions:
+                continue
+
+            is_latest = stored_versions[key].is_latest
+            if file_version.is_latest != is_latest:
+                file_version.is_latest = is_latest
+                file_version.save(update_fields=["is_latest"])
+
+        # when a file has versions both on the project prefix and referencing blobs, the newest one is the latest
+        blob_names = set(
+            project.file_versions.filter(blob__isnull=False).values_list(
+                "name", flat=True
+            )
+        )
+        for name in blob_names & {name for name, _version_id in stored_versions}:
+            file_versions = project.file_versions.filter(name=name)
+            newest = file_versions.order_by("-last_modified").first()
+            file_versions.exclude(pk=newest.pk).update(is_latest=False)
+            file_versions.filter(pk=newest.pk).update(is_latest=True)
+
+        invalidate_project_cache(project.id)
+
+    if missing or extra:
+        logger.info(
+            f"Synchronized files index of project {project.id}: {len(missing)} version(s) added, {len(extra)} removed."
+        )
+
+    return missing, extra
+
+
+def update_storage_usage(
+    project: "Project", bytes_delta: int, objects_delta: int  # noqa: F821
+) -> None:
+    """Atomically updates the storage usage counters of the project and of its owner.
+
+    Args:
+        project (Project): the project
+        bytes_delta (int): the change of the stored bytes, negative if objects were removed
+        objects_delta (int): the change of the number of stored objects, negative if objects were removed
+    """
+    if not bytes_delta and not objects_delta:
+        return
+
+    UserAccount = apps.get_model("core", "UserAccount")
+
+    with transaction.atomic():
+        type(project).objects.filter(pk=project.pk).update(
+            storage_bytes=F("storage_bytes") + bytes_delta,
+            storage_objects=F("storage_objects") + objects_delta,
+        )
+        UserAccount.objects.filter(user_id=project.owner_id).update(
+            storage_bytes=F("storage_bytes") + bytes_delta,
+            storage_objects=F("storage_objects") + objects_delta,
+        )
+
+    project.storage_bytes += bytes_delta
+    project.storage_objects += objects_delta
+
+
+def reconcile_storage_usage(project: "Project") -> Tuple[int, int]:  # noqa: F821
+    """Recounts the storage usage of the project from all the object versions under its prefix
+    and corrects the counters of the project and of its owner, as well as the project's package files count.
+
+    NOTE this lists all the object versions of the project on the storage, so it is not meant for the request/response cycle
+
+    Args:
+        project (Project): the project
+
+    Returns:
+        Tuple[int, int]: the stored bytes and the number of stored objects
+    """
+    prefix = f"projects/{project.id}/"
+
+    storage_bytes = 0
+    storage_objects = 0
+    package_files_count = 0
+    cleanups = _get_pending_cleanups(project)
+    for version in _filter_cleanups(
+        get_storage_backend().list_versions(prefix), cleanups
+    ):
+        if version.is_delete_marker:
+            continue
+
+        storage_bytes += version.size
+        storage_objects += 1
+
+        if version.is_latest and version.key.startswith(f"{prefix}export/"):
+            package_files_count += 1
+
+    # the versions referencing blobs count as if they were stored under the project prefix
+    blob_usage = project.file_versions.filter(blob__isnull=False).aggregate(
+        size=Sum("size"), count=Count("pk")
+    )
+    storage_bytes += blob_usage["size"] or 0
+    storage_objects += blob_usage["count"]
+
+    with transaction.atomic():
+        counted_bytes, counted_objects = (
+            type(project)
+            .objects.select_for_update()
+            .filter(pk=project.pk)
+            .values_list("storage_bytes", "storage_objects")[0]
+        )
+
+        update_storage_usage(
+            project, storage_bytes - counted_bytes, storage_objects - counted_objects
+        )
+
+        type(project).objects.filter(pk=project.pk).update(
+            package_files_count=package_files_count
+        )
+
+    project.storage_bytes = storage_bytes
+    project.storage_objects = storage_objects
+    project.package_files_count = package_files_count
+
+    return storage_bytes, storage_objects
+
+
+def get_package_storage_usage(
+    project: "Project",  # noqa: F821
+) -> Tuple[int, int, int]:
+    """Returns the storage usage of the project package, listing only the versions under the package prefix.
+
+    NOTE the package versions are permanently deleted when the project is packaged again, so there are only a few
+
+    Args:
+        project (Project): the project
+
+    Returns:
+        Tuple[int, int, int]: the stored bytes, the number of stored objects and the number of package files
+    """
+    prefix = f"projects/{project.id}/export/"
+
+    storage_bytes = 0
+    storage_objects = 0
+    package_files_count = 0
+    cleanups = _get_pending_cleanups(project)
+    for version in _filter_cleanups(
+        get_storage_backend().list_versions(prefix), cleanups
+    ):
+        if version.is_delete_marker:
+            continue
+
+        storage_bytes += version.size
+        storage_objects += 1
+
+        if version.is_latest:
+            package_files_count += 1
+
+    return storage_bytes, storage_objects, package_files_count
+
+
+def run_storage_cleanup(
+    cleanup: "StorageCleanup", max_workers: int = 10  # noqa: F821
+) -> int:
+    """Deletes the object versions covered by a storage cleanup, including the delete markers.
+
+    The versions are deleted with batched `DeleteObjects` requests while they are being listed,
+    see `StorageBackend.delete_object_versions`. The progress is stored in `cleanup.deleted_count` after each batch.
+
+    Args:
+        cleanup (StorageCleanup): the storage cleanup
+        max_workers (int, optional): maximum number of concurrent delete requests. Defaults to 10.
+
+    Returns:
+        int: the number of deleted versions
+    """
+    backend = get_storage_backend()
+
+    def versions():
+        for version in _filter_cleanups(
+            backend.list_versions(cleanup.key, strip_prefix=False),
+            [cleanup],
+            covered=True,
+        ):
+            yield version.key, version.id
+
+    def on_deleted(count: int) -> None:
+        type(cleanup).objects.filter(pk=cleanup.pk).update(
+            deleted_count=F("deleted_count") + count, updated_at=timezone.now()
+        )
+
+    return backend.delete_object_versions(
+        versions(), max_workers=max_workers, on_deleted=on_deleted
+    )
@@ -0,0 +1,934 @@
+"""Storage backends for the objects of QFieldCloud (project files, packages, blobs, deltas etc).
+
+The objects are versioned: each write adds a new version of the object and deleting an object only hides it
+behind a delete marker, the versions are deleted explicitly with `delete_object_versions`.
+
+Two backends are available, selected with the `STORAGE_BACKEND` setting:
+
+- `s3` stores the objects in a versioned S3 compatible bucket, e.g. MinIO
+- `local` stores the objects in the `STORAGE_LOCAL_ROOT` directory, for single node installations
+
+NOTE the presigned URLs for direct and multipart uploads and the QGIS worker only work with the `s3` backend,
+the worker refuses to start with the `local` backend
+"""
+
+import json
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from itertools import chain, islice
+from pathlib import Path
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from botocore.errorfactory import ClientError
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.http.response import HttpResponseRedirect
+from qfieldcloud.core import utils
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# the objects written by the app larger than that are uploaded in parts of that size, the same as `upload_fileobj`
+PUT_PART_SIZE = 8 * 1024 * 1024
+# larger objects cannot be copied with a single request
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+
+class StorageObjectVersion(NamedTuple):
+    # the key relative to the listed prefix, the same as `key` when not listed
+    name: str
+    key: str
+    id: str
+    # NOTE delete markers have no size
+    size: Optional[int]
+    last_modified: datetime
+    is_latest: bool
+    # the user metadata, only available when the version is read with `head_object`
+    metadata: Dict[str, str] = {}
+
+    @property
+    def is_delete_marker(self) -> bool:
+        return self.size is None
+
+
+class StorageObjectRange(NamedTuple):
+    """A byte range of an object version, see `StorageBackend.compose_object`."""
+
+    key: str
+    # the latest version if None
+    version_id: Optional[str]
+    start: int
+    # inclusive, like the HTTP ranges
+    end: int
+
+
+class StorageBackend(ABC):
+    """Interface of the storage backends."""
+
+    # whether the objects can be uploaded and downloaded directly with presigned URLs, bypassing the app server
+    supports_presigned_urls = False
+
+    @abstractmethod
+    def put_object(
+        self,
+        file: IO,
+        key: str,
+        metadata: Dict[str, str] = None,
+        content_type: str = None,
+        is_public: bool = False,
+    ) -> StorageObjectVersion:
+        """Stores the contents of the file as the latest version of the object.
+
+        Args:
+            file (IO): the file to read the contents from
+            key (str): the object key
+            metadata (Dict[str, str], optional): the user metadata of the version. Defaults to None.
+            content_type (str, optional): the content type of the object. Defaults to None.
+            is_public (bool, optional): whether the object can be read by anyone from `get_public_url`. Defaults to False.
+
+        Returns:
+            StorageObjectVersion: the new version
+        """
+
+    @abstractmethod
+    def head_object(
+        self, key: str, version_id: str = None
+    ) -> Optional[StorageObjectVersion]:
+        """Returns the given or the latest version of the object, with its user metadata.
+
+        Returns:
+            Optional[StorageObjectVersion]: the version or None if it does not exist or the object is deleted
+        """
+
+    @abstractmethod
+    def iter_object(
+        self, key: str, version_id: str = None, start: int = 0, end: int = None
+    ) -> Iterator[bytes]:
+        """Yields the contents of the given or the latest version of the object in chunks.
+
+        Args:
+            key (str): the object key
+            version_id (str, optional): the version id, the latest if not given. Defaults to None.
+            start (int, optional): the first byte to read. Defaults to 0.
+            end (int, optional): the last byte to read, inclusive, until the end if not given. Defaults to None.
+        """
+
+    @abstractmethod
+    def list_versions(
+        self, prefix: str, strip_prefix: bool = True
+    ) -> Iterator[StorageObjectVersion]:
+        """Yields all the versions of the objects whose key starts with the prefix, including the delete markers.
+
+        The versions are ordered by key and from the newest to the oldest.
+        """
+
+    @abstractmethod
+    def delete_object(self, key: str) -> str:
+        """Hides the object behind a delete marker, its versions are kept. Returns the version id of the delete marker."""
+
+    @abstractmethod
+    def delete_object_versions(
+        self,
+        versions: Iterable[Tuple[str, str]],
+        max_workers: int = 10,
+        on_deleted: Optional[Callable[[int], None]] = None,
+    ) -> int:
+        """Deletes many object versions permanently, including delete markers.
+
+        Args:
+            versions (Iterable[Tuple[str, str]]): `(key, version_id)` pairs
+            max_workers (int, optional): maximum number of concurrent requests, if relevant for the backend. Defaults to 10.
+            on_deleted (Callable[[int], None], optional): called with the number of versions deleted by each batch. Defaults to None.
+
+        Returns:
+            int: the number of deleted versions
+        """
+
+    @abstractmethod
+    def copy_object(
+        self,
+        source_key: str,
+        key: str,
+        source_version_id: str = None,
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        """Copies the given or the latest version of an object as the latest version of another object.
+
+        Args:
+            source_key (str): the key of the copied object
+            key (str): the key of the new object
+            source_version_id (str, optional): the copied version, the latest if not given. Defaults to None.
+            metadata (Dict[str, str], optional): the user metadata of the new version, the same as the copied version if not given. Defaults to None.
+
+        Returns:
+            StorageObjectVersion: the new version
+        """
+
+    @abstractmethod
+    def compose_object(
+        self,
+        key: str,
+        parts: List[Union[IO, StorageObjectRange]],
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        """Stores the concatenation of the parts as the latest version of the object.
+
+        NOTE with the `s3` backend all the parts but the last must be at least 5MB.
+
+        Args:
+            key (str): the object key
+            parts (List[Union[IO, StorageObjectRange]]): either files to read the contents from,
+                or byte ranges of the stored objects, which are copied on the storage side
+            metadata (Dict[str, str], optional): the user metadata of the version. Defaults to None.
+
+        Returns:
+            StorageObjectVersion: the new version
+        """
+
+    @abstractmethod
+    def get_download_response(
+        self, key: str, filename: str, version_id: str = None
+    ) -> HttpResponse:
+        """Returns a response to download the given or the latest version of the object as an attachment."""
+
+    @abstractmethod
+    def get_public_url(self, key: str) -> Optional[str]:
+        """Returns the URL of an object stored with `is_public`, None if the objects cannot be reached from outside of the app."""
+
+    def get_upload_url(
+        self, key: str, metadata: Dict[str, str], expires_in: int
+    ) -> str:
+        """Returns a presigned URL to upload the object with a single PUT request, see `supports_presigned_urls`."""
+        raise NotImplementedError()
+
+    def create_multipart_upload(self, key: str, metadata: Dict[str, str]) -> str:
+        """Starts a multipart upload of the object and returns its upload id, see `supports_presigned_urls`."""
+        raise NotImplementedError()
+
+    def get_upload_part_url(
+        self, key: str, upload_id: str, part_number: int, expires_in: int
+    ) -> str:
+        """Returns a presigned URL to upload a part of a multipart upload with a PUT request, see `supports_presigned_urls`."""
+        raise NotImplementedError()
+
+    def complete_multipart_upload(
+        self, key: str, upload_id: str, parts: List[Tuple[int, str]]
+    ) -> str:
+        """Assembles the uploaded `(part_number, etag)` parts as the latest version of the object, returns its version id.
+
+        Raises:
+            ValueError: if the parts do not match the uploaded ones
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def is_available(self) -> bool:
+        """Returns whether the storage can be reached."""
+
+
+class S3StorageBackend(StorageBackend):
+    """Stores the objects in the versioned `STORAGE_BUCKET_NAME` bucket, using the shared S3 client."""
+
+    supports_presigned_urls = True
+
+    def put_object(
+        self,
+        file: IO,
+        key: str,
+        metadata: Dict[str, str] = None,
+        content_type: str = None,
+        is_public: bool = False,
+    ) -> StorageObjectVersion:
+        kwargs = {
+            "Bucket": settings.STORAGE_BUCKET_NAME,
+            "Key": key,
+            "Metadata": metadata or {},
+        }
+
+        if content_type:
+            kwargs["ContentType"] = content_type
+
+        if is_public:
+            kwargs["ACL"] = "public-read"
+
+        part_size = PUT_PART_SIZE
+        body = file.read(part_size)
+        next_body = file.read(part_size)
+
+        if not next_body:
+            version_id = utils.get_s3_client().put_object(Body=body, **kwargs)[
+                "VersionId"
+            ]
+        else:
+
+            def upload_parts(upload_id: str) -> Iterator[Dict]:
+                bodies = chain(
+                    [body, next_body], iter(partial(file.read, part_size), b"")
+                )
+
+                for part_number, part_body in enumerate(bodies, 1):
+                    response = utils.get_s3_client().upload_part(
+                        Bucket=settings.STORAGE_BUCKET_NAME,
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        Body=part_body,
+                    )
+
+                    yield {"PartNumber": part_number, "ETag": response["ETag"]}
+
+            version_id = self._multipart_upload(kwargs, upload_parts)
+
+        # NOTE the written version is read, not the latest one which might come from a concurrent write of the same key
+        version = self.head_object(key, version_id)
+        assert version
+
+        # the version is the latest as of writing it, the same as with the local backend
+        return version._replace(is_latest=True)
+
+    def _multipart_upload(
+        self, kwargs: Dict, upload_parts: Callable[[str], Iterable[Dict]]
+    ) -> str:
+        """Uploads an object in parts, returns its version id, the upload is aborted if any part fails.
+
+        Args:
+            kwargs (Dict): the arguments to create the multipart upload
+            upload_parts (Callable[[str], Iterable[Dict]]): uploads the parts given the upload id,
+                yields the `PartNumber` and `ETag` of each part
+
+        Returns:
+            str: the version id of the uploaded object
+        """
+        client = utils.get_s3_client()
+        upload_id = client.create_multipart_upload(**kwargs)["UploadId"]
+
+        try:
+            parts = list(upload_parts(upload_id))
+            response = client.complete_multipart_upload(
+                Bucket=kwargs["Bucket"],
+                Key=kwargs["Key"],
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            # otherwise the uploaded parts are kept on the storage
+            client.abort_multipart_upload(
+                Bucket=kwargs["Bucket"], Key=kwargs["Key"], UploadId=upload_id
+            )
+            raise
+
+        return response["VersionId"]
+
+    def head_object(
+        self, key: str, version_id: str = None
+    ) -> Optional[StorageObjectVersion]:
+        kwargs = {"Bucket": settings.STORAGE_BUCKET_NAME, "Key": key}
+
+        if version_id:
+            kwargs["VersionId"] = version_id
+
+        try:
+            response = utils.get_s3_client().head_object(**kwargs)
+        except ClientError as err:
+            # NOTE deleted objects return 405 when asked for their delete marker
+            if err.response["Error"]["Code"] in ("404", "405", "NoSuchKey"):
+                return None
+
+            raise
+
+        return StorageObjectVersion(
+            name=key,
+            key=key,
+            id=response.get("VersionId"),
+            size=response["ContentLength"],
+            last_modified=response["LastModified"],
+            is_latest=not version_id,
+            # NOTE the metadata keys are returned lowercase, whatever their original case
+            metadata={k.lower(): v for k, v in response.get("Metadata", {}).items()},
+        )
+
+    def iter_object(
+        self, key: str, version_id: str = None, start: int = 0, end: int = None
+    ) -> Iterator[bytes]:
+        kwargs = {"Bucket": settings.STORAGE_BUCKET_NAME, "Key": key}
+
+        if version_id:
+            kwargs["VersionId"] = version_id
+
+        if start or end is not None:
+            kwargs["Range"] = f"bytes={start}-{'' if end is None else end}"
+
+        body = utils.get_s3_client().get_object(**kwargs)["Body"]
+
+        yield from body.iter_chunks(CHUNK_SIZE)
+
+    def list_versions(
+        self, prefix: str, strip_prefix: bool = True
+    ) -> Iterator[StorageObjectVersion]:
+        for version in utils.list_versions(
+            utils.get_s3_bucket(), prefix, strip_prefix=strip_prefix
+        ):
+            yield StorageObjectVersion(
+                name=version.name,
+                key=version.key,
+                id=version.id,
+                size=version.size,
+                last_modified=version.last_modified,
+                is_latest=version.is_latest,
+            )
+
+    def delete_object(self, key: str) -> str:
+        return utils.get_s3_client().delete_object(
+            Bucket=settings.STORAGE_BUCKET_NAME, Key=key
+        )["VersionId"]
+
+    def delete_object_versions(
+        self,
+        versions: Iterable[Tuple[str, str]],
+        max_workers: int = 10,
+        on_deleted: Optional[Callable[[int], None]] = None,
+    ) -> int:
+        return utils.delete_object_versions(
+            versions, max_workers=max_workers, on_deleted=on_deleted
+        )
+
+    def copy_object(
+        self,
+        source_key: str,
+        key: str,
+        source_version_id: str = None,
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        source_version = self.head_object(source_key, source_version_id)
+
+        if source_version is None:
+            raise FileNotFoundError(
+                f'No such storage object "{source_key}" ({source_version_id})'
+            )
+
+        copy_source = {
+            "Bucket": settings.STORAGE_BUCKET_NAME,
+            "Key": source_key,
+            "VersionId": source_version.id,
+        }
+        kwargs = {
+            "Bucket": settings.STORAGE_BUCKET_NAME,
+            "Key": key,
+            "Metadata": source_version.metadata if metadata is None else metadata,
+        }
+
+        # NOTE the copy is done on the storage side, the contents do not go through the app server
+        if source_version.size <= MAX_COPY_SIZE:
+            version_id = utils.get_s3_client().copy_object(
+                CopySource=copy_source, MetadataDirective="REPLACE", **kwargs
+            )["VersionId"]
+        else:
+
+            def upload_parts(upload_id: str) -> Iterator[Dict]:
+                part_size = settings.STORAGE_MULTIPART_UPLOAD_PART_SIZE
+
+                for part_number, start in enumerate(
+                    range(0, source_version.size, part_size), 1
+                ):
+                    end = min(start + part_size, source_version.size) - 1
+                    response = utils.get_s3_client().upload_part_copy(
+                        Bucket=settings.STORAGE_BUCKET_NAME,
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        CopySource=copy_source,
+                        CopySourceRange=f"bytes={start}-{end}",
+                    )
+
+                    yield {
+                        "PartNumber": part_number,
+                        "ETag": response["CopyPartResult"]["ETag"],
+                    }
+
+            version_id = self._multipart_upload(kwargs, upload_parts)
+
+        version = self.head_object(key, version_id)
+        assert version
+
+        # the version is the latest as of writing it, the same as with the local backend
+        return version._replace(is_latest=True)
+
+    def compose_object(
+        self,
+        key: str,
+        parts: List[Union[IO, StorageObjectRange]],
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        kwargs = {
+            "Bucket": settings.STORAGE_BUCKET_NAME,
+            "Key": key,
+            "Metadata": metadata or {},
+        }
+
+        def upload_part(upload_id: str, part_number: int, part) -> Dict:
+            part_kwargs = {
+                "Bucket": settings.STORAGE_BUCKET_NAME,
+                "Key": key,
+                "UploadId": upload_id,
+                "PartNumber": part_number,
+            }
+
+            if isinstance(part, StorageObjectRange):
+                copy_source = {"Bucket": settings.STORAGE_BUCKET_NAME, "Key": part.key}
+
+                if part.version_id:
+                    copy_source["VersionId"] = part.version_id
+
+                etag = utils.get_s3_client().upload_part_copy(
+                    **part_kwargs,
+                    CopySource=copy_source,
+                    CopySourceRange=f"bytes={part.start}-{part.end}",
+                )["CopyPartResult"]["ETag"]
+            else:
+                etag = utils.get_s3_client().upload_part(
+                    **part_kwargs, Body=part.read()
+                )["ETag"]
+
+            return {"PartNumber": part_number, "ETag": etag}
+
+        def upload_parts(upload_id: str) -> List[Dict]:
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                return list(
+                    executor.map(
+                        partial(upload_part, upload_id), range(1, len(parts) + 1), parts
+                    )
+                )
+
+        version_id = self._multipart_upload(kwargs, upload_parts)
+        version = self.head_object(key, version_id)
+        assert version
+
+        # the version is the latest as of writing it, the same as with the local backend
+        return version._replace(is_latest=True)
+
+    def get_upload_url(
+        self, key: str, metadata: Dict[str, str], expires_in: int
+    ) -> str:
+        return utils.get_s3_client().generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": settings.STORAGE_BUCKET_NAME,
+                "Key": key,
+                "Metadata": metadata,
+            },
+            ExpiresIn=expires_in,
+            HttpMethod="PUT",
+        )
+
+    def create_multipart_upload(self, key: str, metadata: Dict[str, str]) -> str:
+        return utils.get_s3_client().create_multipart_upload(
+            Bucket=settings.STORAGE_BUCKET_NAME,
+            Key=key,
+            Metadata=metadata,
+        )["UploadId"]
+
+    def get_upload_part_url(
+        self, key: str, upload_id: str, part_number: int, expires_in: int
+    ) -> str:
+        return utils.get_s3_client().generate_presigned_url(
+            "upload_part",
+            Params={
+                "Bucket": settings.STORAGE_BUCKET_NAME,
+                "Key": key,
+                "UploadId": upload_id,
+                "PartNumber": part_number,
+            },
+            ExpiresIn=expires_in,
+            HttpMethod="PUT",
+        )
+
+    def complete_multipart_upload(
+        self, key: str, upload_id: str, parts: List[Tuple[int, str]]
+    ) -> str:
+        try:
+            response = utils.get_s3_client().complete_multipart_upload(
+                Bucket=settings.STORAGE_BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": part_number, "ETag": etag}
+                        for part_number, etag in parts
+                    ]
+                },
+            )
+        except ClientError as err:
+            raise ValueError(f"Failed to complete the multipart upload: {err}")
+
+        return response["VersionId"]
+
+    def get_download_response(
+        self, key: str, filename: str, version_id: str = None
+    ) -> HttpResponse:
+        # the client downloads the object directly from the storage
+        return HttpResponseRedirect(
+            utils.get_presigned_download_url(key, filename, version_id)
+        )
+
+    def get_public_url(self, key: str) -> Optional[str]:
+        return utils.get_s3_object_url(key)
+
+    def is_available(self) -> bool:
+        try:
+            utils.get_s3_client().head_bucket(Bucket=settings.STORAGE_BUCKET_NAME)
+        except Exception:
+            return False
+
+        return True
+
+
+class LocalStorageBackend(StorageBackend):
+    """Stores the objects in a local directory, without the network and S3 protocol overhead.
+
+    Each object is a directory named after its key with the `.~versions` suffix, containing a file per version
+    and a JSON file per version with its details. The JSON file is written last, so a version exists only once it is complete.
+    Delete markers are versions with only the JSON file.
+
+    The version ids start with the creation time in nanoseconds, so they sort from the oldest to the newest.
+    The downloads are sent with `sendfile` by the WSGI server, see `FileResponse`.
+
+    NOTE the objects cannot be reached from outside of the app, so presigned URLs are not supported,
+    and with them the direct uploads, see `supports_presigned_urls`. Nor can the QGIS worker reach them.
+    """
+
+    VERSIONS_SUFFIX = ".~versions"
+
+    def __init__(self, root: str) -> None:
+        self.root = Path(root)
+
+    def _get_versions_dir(self, key: str) -> Path:
+        parts = key.split("/")
+
+        if (
+            not key
+            or key.startswith("/")
+            or any(p in ("", ".", "..") for p in parts)
+            or any(p.endswith(self.VERSIONS_SUFFIX) for p in parts)
+        ):
+            raise ValueError(f'Invalid storage key "{key}"')
+
+        return self.root.joinpath(*parts[:-1], parts[-1] + self.VERSIONS_SUFFIX)
+
+    def _read_version(
+        self, key: str, versions_dir: Path, version_id: str, is_latest: bool
+    ) -> StorageObjectVersion:
+        with open(versions_dir.joinpath(f"{version_id}.json")) as f:
+            details = json.load(f)
+
+        return StorageObjectVersion(
+            name=key,
+            key=key,
+            id=version_id,
+            size=details["size"],
+            last_modified=datetime.fromtimestamp(
+                int(version_id[:20]) / 1e9, tz=timezone.utc
+            ),
+            is_latest=is_latest,
+            metadata=details["metadata"],
+        )
+
+    def _get_version_ids(self, versions_dir: Path) -> list:
+        """Returns the ids of the complete versions, from the newest to the oldest."""
+        try:
+            filenames = os.listdir(versions_dir)
+        except FileNotFoundError:
+            return []
+
+        return sorted((f[:-5] for f in filenames if f.endswith(".json")), reverse=True)
+
+    def _add_version(
+        self,
+        key: str,
+        write: Optional[Callable[[Path], None]],
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        """Adds a version to the object, its contents are written by `write` to the given path, or a delete marker if None."""
+        versions_dir = self._get_versions_dir(key)
+        versions_dir.mkdir(parents=True, exist_ok=True)
+
+        version_id = f"{time.time_ns():020d}{secrets.token_hex(6)}"
+        size = None
+
+        if write:
+            data_path = versions_dir.joinpath(version_id)
+            write(data_path)
+            size = data_path.stat().st_size
+
+        with tempfile.NamedTemporaryFile(
+            "w", dir=versions_dir, suffix=".tmp", delete=False
+        ) as f:
+            # NOTE the metadata keys are lowercase, like the ones returned by S3
+            json.dump(
+                {
+                    "size": size,
+                    "metadata": {k.lower(): v for k, v in (metadata or {}).items()},
+                },
+                f,
+            )
+
+        os.replace(f.name, versions_dir.joinpath(f"{version_id}.json"))
+
+        return self._read_version(key, versions_dir, version_id, True)
+
+    def _get_data_path(self, key: str, version_id: str = None) -> Path:
+        version = self.head_object(key, version_id)
+
+        if version is None:
+            raise FileNotFoundError(f'No such storage object "{key}" ({version_id})')
+
+        return self._get_versions_dir(key).joinpath(version.id)
+
+    def put_object(
+        self,
+        file: IO,
+        key: str,
+        metadata: Dict[str, str] = None,
+        content_type: str = None,
+        is_public: bool = False,
+    ) -> StorageObjectVersion:
+        def write(path: Path) -> None:
+            with open(path, "xb") as f:
+                shutil.copyfileobj(file, f, CHUNK_SIZE)
+
+        # NOTE the content type is not stored, downloads are always attachments.
+        # The objects are never public, see `get_public_url`
+        return self._add_version(key, write, metadata)
+
+    def head_object(
+        self, key: str, version_id: str = None
+    ) -> Optional[StorageObjectVersion]:
+        versions_dir = self._get_versions_dir(key)
+        version_ids = self._get_version_ids(versions_dir)
+
+        if not version_ids:
+            return None
+
+        if version_id is None:
+            version_id = version_ids[0]
+        elif version_id not in version_ids:
+            return None
+
+        version = self._read_version(
+            key, versions_dir, version_id, version_id == version_ids[0]
+        )
+
+        if version.is_delete_marker:
+            return None
+
+        return version
+
+    def iter_object(
+        self, key: str, version_id: str = None, start: int = 0, end: int = None
+    ) -> Iterator[bytes]:
+        with open(self._get_data_path(key, version_id), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+
+            while remaining is None or remaining > 0:
+                chunk = f.read(
+                    CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                )
+
+                if not chunk:
+                    break
+
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+                yield chunk
+
+    def list_versions(
+        self, prefix: str, strip_prefix: bool = True
+    ) -> Iterator[StorageObjectVersion]:
+        # only the directory of the prefix can contain matching keys
+        prefix_dir = self.root.joinpath(*prefix.split("/")[:-1])
+        keys = []
+
+        for dirpath, dirnames, _filenames in os.walk(prefix_dir):
+            for dirname in list(dirnames):
+                if not dirname.endswith(self.VERSIONS_SUFFIX):
+                    continue
+
+                # the versions directories contain no other objects
+                dirnames.remove(dirname)
+
+                key = (
+                    Path(dirpath, dirname[: -len(self.VERSIONS_SUFFIX)])
+                    .relative_to(self.root)
+                    .as_posix()
+                )
+
+                if key.startswith(prefix):
+                    keys.append(key)
+
+        for key in sorted(keys):
+            versions_dir = self._get_versions_dir(key)
+            start_idx = len(prefix)
+            name = key[start_idx:] if strip_prefix else key
+
+            for idx, version_id in enumerate(self._get_version_ids(versions_dir)):
+                version = self._read_version(key, versions_dir, version_id, idx == 0)
+
+                yield version._replace(name=name, metadata={})
+
+    def delete_object(self, key: str) -> str:
+        return self._add_version(key, None).id
+
+    def delete_object_versions(
+        self,
+        versions: Iterable[Tuple[str, str]],
+        max_workers: int = 10,
+        on_deleted: Optional[Callable[[int], None]] = None,
+    ) -> int:
+        deleted_count = 0
+        versions = iter(versions)
+
+        while True:
+            batch = list(islice(versions, 1000))
+
+            if not batch:
+                break
+
+            for key, version_id in batch:
+                versions_dir = self._get_versions_dir(key)
+
+                # NOTE like S3, deleting a version that does not exist is not an error
+                versions_dir.joinpath(f"{version_id}.json").unlink(missing_ok=True)
+                versions_dir.joinpath(version_id).unlink(missing_ok=True)
+
+                self._remove_empty_dirs(versions_dir)
+
+            deleted_count += len(batch)
+
+            if on_deleted:
+                on_deleted(len(batch))
+
+        return deleted_count
+
+    def _remove_empty_dirs(self, path: Path) -> None:
+        """Removes the directory and its parents up to the root, as long as they are empty."""
+        while path != self.root:
+            try:
+                path.rmdir()
+            except (FileNotFoundError, OSError):
+                # not empty, or already removed by a concurrent delete
+                if path.exists():
+                    return
+
+            path = path.parent
+
+    def copy_object(
+        self,
+        source_key: str,
+        key: str,
+        source_version_id: str = None,
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        source_version = self.head_object(source_key, source_version_id)
+
+        if source_version is None:
+            raise FileNotFoundError(
+                f'No such storage object "{source_key}" ({source_version_id})'
+            )
+
+        source_path = self._get_versions_dir(source_key).joinpath(source_version.id)
+
+        def write(path: Path) -> None:
+            shutil.copyfile(source_path, path)
+
+        if metadata is None:
+            metadata = source_version.metadata
+
+        return self._add_version(key, write, metadata)
+
+    def compose_object(
+        self,
+        key: str,
+        parts: List[Union[IO, StorageObjectRange]],
+        metadata: Dict[str, str] = None,
+    ) -> StorageObjectVersion:
+        def write(path: Path) -> None:
+            with open(path, "xb") as f:
+                for part in parts:
+                    if isinstance(part, StorageObjectRange):
+                        for chunk in self.iter_object(
+                            part.key, part.version_id, part.start, part.end
+                        ):
+                            f.write(chunk)
+                    else:
+                        shutil.copyfileobj(part, f, CHUNK_SIZE)
+
+        return self._add_version(key, write, metadata)
+
+    def get_download_response(
+        self, key: str, filename: str, version_id: str = None
+    ) -> HttpResponse:
+        try:
+            f = open(self._get_data_path(key, version_id), "rb")
+        except FileNotFoundError:
+            return HttpResponse(status=404)
+
+        # NOTE the WSGI server sends the file with `sendfile`, without copying it in user space
+        return FileResponse(
+            f,
+            as_attachment=True,
+            filename=filename,
+            content_type="application/force-download",
+        )
+
+    def get_public_url(self, key: str) -> Optional[str]:
+        # NOTE the objects cannot be reached from outside of the app
+        return None
+
+    def is_available(self) -> bool:
+        return self.root.is_dir() and os.access(self.root, os.W_OK)
+
+
+_backend_lock = threading.Lock()
+_backend = None
+_backend_settings = None
+
+
+def get_storage_backend() -> StorageBackend:
+    """Returns the storage backend configured with `STORAGE_BACKEND`, shared by all threads."""
+    global _backend, _backend_settings
+
+    backend_settings = (settings.STORAGE_BACKEND, settings.STORAGE_LOCAL_ROOT)
+
+    with _backend_lock:
+        if _backend is None or _backend_settings != backend_settings:
+            if settings.STORAGE_BACKEND == "s3":
+                _backend = S3StorageBackend()
+            elif settings.STORAGE_BACKEND == "local":
+                _backend = LocalStorageBackend(settings.STORAGE_LOCAL_ROOT)
+            else:
+                raise Exception(f'Unknown storage backend "{settings.STORAGE_BACKEND}"')
+
+            _backend_settings = backend_settings
+
+        return _backend
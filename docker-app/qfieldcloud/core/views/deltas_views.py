@@ -11,6 +11,7 @@ from qfieldcloud.core import exceptions, permissions_utils, utils
 from qfieldcloud.core.models import Delta, Project
 from qfieldcloud.core.serializers import DeltaSerializer
 from qfieldcloud.core.utils2 import jobs
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 from rest_framework import generics, permissions, views
 from rest_framework.response import Response
 
@@ -113,7 +114,7 @@ class ListCreateDeltasView(generics.ListCreateAPIView):
                 key = f"projects/{projectid}/deltas/{datetime.now().isoformat()}.json"
                 # otherwise we upload an empty file
                 request_file.seek(0)
-                utils.get_s3_bucket().upload_fileobj(request_file, key)
+                get_storage_backend().put_object(request_file, key)
                 logger.info(f'Invalid deltafile saved as "{key}"')
 
             logger.exception(err)
@@ -1,13 +1,29 @@
+import math
+import re
 from pathlib import PurePath
+from typing import Any, Dict, Optional
 
-from django.http.response import HttpResponseRedirect
+from django.conf import settings
+from django.core import signing
 from django.utils import timezone
 from qfieldcloud.core import exceptions, permissions_utils, utils
-from qfieldcloud.core.models import ProcessProjectfileJob, Project
+from qfieldcloud.core.models import (
+    FileVersion,
+    ProcessProjectfileJob,
+    Project,
+    StorageCleanup,
+    User,
+)
+from qfieldcloud.core.utils2 import archive, storage
+from qfieldcloud.core.utils2.caching import cache_project_response
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 from rest_framework import permissions, status, views
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 
+SHA256_REGEX = re.compile(r"^[0-9a-f]{64}$")
+UPLOAD_TOKEN_SALT = "qfieldcloud.core.views.files_views.upload"
+
 
 class ListFilesViewPermissions(permissions.BasePermission):
     def has_permission(self, request, view):
@@ -26,51 +42,102 @@ class ListFilesView(views.APIView):
 
     permission_classes = [permissions.IsAuthenticated, ListFilesViewPermissions]
 
+    @cache_project_response()
     def get(self, request, projectid):
+        project = Project.objects.get(id=projectid)
 
-        Project.objects.get(id=projectid)
+        files = []
+        for file in project.files:
+            versions = []
+            for version in file.versions:
+                versions.append(
+                    {
+                        "size": version.size,
+                        "sha256": version.sha256,
+                        "version_id": version.version_id,
+                        "last_modified": self._format_last_modified(version),
+                        "is_latest": version.is_latest,
+                    }
+                )
+
+            files.append(
+                {
+                    "name": file.latest.name,
+                    "size": file.latest.size,
+                    "sha256": file.latest.sha256,
+                    "last_modified": self._format_last_modified(file.latest),
+                    "versions": versions,
+                }
+            )
 
-        bucket = utils.get_s3_bucket()
+        return Response(files)
 
-        prefix = "projects/{}/files/".format(projectid)
+    def _format_last_modified(self, version: FileVersion) -> str:
+        return version.last_modified.strftime("%d.%m.%Y %H:%M:%S %Z")
 
-        files = {}
-        for version in bucket.object_versions.filter(Prefix=prefix):
-            # Created the dict entry if doesn't exist
-            if version.key not in files:
-                files[version.key] = {"versions": []}
 
-            head = version.head()
-            path = PurePath(version.key)
-            filename = str(path.relative_to(*path.parts[:3]))
-            last_modified = version.last_modified.strftime("%d.%m.%Y %H:%M:%S %Z")
+class ArchiveFilesView(views.APIView):
+    """Downloads the latest versions of the project files as a single uncompressed tar archive.
 
-            # We cannot be sure of the metadata's first letter case
-            # https://github.com/boto/boto3/issues/1709
-            metadata = head["Metadata"]
-            if "sha256sum" in metadata:
-                sha256sum = metadata["sha256sum"]
-            else:
-                sha256sum = metadata["Sha256sum"]
+    The files can be limited with one or more `name` query parameters.
+    Interrupted downloads can be resumed with a `Range` request."""
 
-            if version.is_latest:
-                files[version.key]["name"] = filename
-                files[version.key]["size"] = version.size
-                files[version.key]["sha256"] = sha256sum
-                files[version.key]["last_modified"] = last_modified
+    permission_classes = [permissions.IsAuthenticated, ListFilesViewPermissions]
 
-            files[version.key]["versions"].append(
-                {
-                    "size": version.size,
-                    "sha256": sha256sum,
-                    "version_id": version.version_id,
-                    "last_modified": last_modified,
-                    "is_latest": version.is_latest,
-                }
+    def get(self, request, projectid):
+        project = Project.objects.get(id=projectid)
+        file_versions = project.file_versions.filter(is_latest=True).order_by("name")
+        names = request.query_params.getlist("name")
+
+        if names:
+            file_versions = file_versions.filter(name__in=names)
+
+        members = [
+            archive.ArchiveMember(
+                name=file_version.name,
+                key=file_version.key,
+                # the blobs are never overwritten, so they have no version to be pinned
+                version_id=None if file_version.blob_id else file_version.version_id,
+                size=file_version.size,
+                last_modified=file_version.last_modified,
             )
+            for file_version in file_versions
+        ]
+
+        if names and len(members) != len(set(names)):
+            raise exceptions.ObjectNotFoundError("Not all the requested files exist.")
+
+        return archive.get_archive_response(request, members, f"{projectid}.tar")
+
+
+def _check_file_can_be_uploaded(project: Project, filename: str) -> None:
+    """Raises if the file cannot be uploaded to the project, currently only one qgs/qgz file per project is allowed."""
+    if (
+        utils.is_qgis_project_file(filename)
+        and project.project_filename is not None
+        and PurePath(filename) != PurePath(project.project_filename)
+    ):
+        raise exceptions.MultipleProjectsError(
+            "Only one QGIS project per project allowed"
+        )
+
 
-        result_list = [files[key] for key in files]
-        return Response(result_list)
+def _check_storage_supports_presigned_urls() -> None:
+    """Raises if the files cannot be uploaded directly to the storage, e.g. with the local storage backend."""
+    if not get_storage_backend().supports_presigned_urls:
+        raise exceptions.StorageOperationNotSupportedError(
+            "Direct uploads are not supported by the storage, upload the file with the files API."
+        )
+
+
+def _on_file_uploaded(user: User, project: Project, filename: str) -> None:
+    """Updates the project once a new file version has been added."""
+    if utils.is_qgis_project_file(filename):
+        project.project_filename = filename
+        ProcessProjectfileJob.objects.create(project=project, created_by=user)
+
+    project.data_last_updated_at = timezone.now()
+    project.save()
 
 
 class DownloadPushDeleteFileViewPermissions(permissions.BasePermission):
@@ -101,29 +168,20 @@ class DownloadPushDeleteFileView(views.APIView):
     ]
 
     def get(self, request, projectid, filename):
-        Project.objects.get(id=projectid)
+        project = Project.objects.get(id=projectid)
 
-        extra_args = {}
-        if "version" in self.request.query_params:
-            version = self.request.query_params["version"]
-            extra_args["VersionId"] = version
+        version = self.request.query_params.get("version")
+        file_version = storage.get_file_version(project, filename, version)
 
-        filekey = utils.safe_join("projects/{}/files/".format(projectid), filename)
+        if file_version and file_version.blob_id:
+            # the contents are stored once for all the versions referencing the same blob
+            return get_storage_backend().get_download_response(
+                file_version.key, filename
+            )
 
-        url = utils.get_s3_client().generate_presigned_url(
-            "get_object",
-            Params={
-                **extra_args,
-                "Key": filekey,
-                "Bucket": utils.get_s3_bucket().name,
-                "ResponseContentType": "application/force-download",
-                "ResponseContentDisposition": f'attachment;filename="{filename}"',
-            },
-            ExpiresIn=600,
-            HttpMethod="GET",
-        )
+        filekey = utils.safe_join("projects/{}/files/".format(projectid), filename)
 
-        return HttpResponseRedirect(url)
+        return get_storage_backend().get_download_response(filekey, filename, version)
 
     def post(self, request, projectid, filename, format=None):
         project = Project.objects.get(id=projectid)
@@ -131,47 +189,342 @@ class DownloadPushDeleteFileView(views.APIView):
         if "file" not in request.data:
             raise exceptions.EmptyContentError()
 
-        is_qgis_project_file = utils.is_qgis_project_file(filename)
-        # check only one qgs/qgz file per project
-        if (
-            is_qgis_project_file
-            and project.project_filename is not None
-            and PurePath(filename) != PurePath(project.project_filename)
-        ):
-            raise exceptions.MultipleProjectsError(
-                "Only one QGIS project per project allowed"
-            )
+        _check_file_can_be_uploaded(project, filename)
 
         request_file = request.FILES.get("file")
 
         sha256sum = utils.get_sha256(request_file)
-        bucket = utils.get_s3_bucket()
 
-        key = utils.safe_join(f"projects/{projectid}/files/", filename)
-        metadata = {"Sha256sum": sha256sum}
+        if settings.STORAGE_DEDUPLICATE_FILES:
+            _file_version, created = storage.add_file_blob_version(
+                project, filename, request_file, sha256sum
+            )
 
-        bucket.upload_fileobj(request_file, key, ExtraArgs={"Metadata": metadata})
+            # re-uploading an unchanged file is a no-op
+            if not created:
+                return Response(status=status.HTTP_201_CREATED)
+        else:
+            key = utils.safe_join(f"projects/{projectid}/files/", filename)
+            metadata = {"Sha256sum": sha256sum}
 
-        if is_qgis_project_file:
-            project.project_filename = filename
-            ProcessProjectfileJob.objects.create(
-                project=project, created_by=self.request.user
-            )
+            version = get_storage_backend().put_object(request_file, key, metadata)
+            storage.add_file_version(project, filename, sha256sum, version)
 
-        project.data_last_updated_at = timezone.now()
-        project.save()
+        _on_file_uploaded(request.user, project, filename)
 
         return Response(status=status.HTTP_201_CREATED)
 
     def delete(self, request, projectid, filename):
         project = Project.objects.get(id=projectid)
         key = utils.safe_join(f"projects/{projectid}/files/", filename)
-        bucket = utils.get_s3_bucket()
 
-        bucket.object_versions.filter(Prefix=key).delete()
+        # a delete marker hides the file from the storage listings right away (e.g. in the worker),
+        # while all the versions are deleted in the background
+        delete_marker_id = get_storage_backend().delete_object(key)
+        storage.remove_file_versions(project, filename)
+        # NOTE only the versions older than the delete marker are deleted, so a file uploaded again meanwhile is kept
+        StorageCleanup.objects.create(key=key, delete_marker_id=delete_marker_id)
 
         if utils.is_qgis_project_file(filename):
-            project.project_filename = None
+            project.project_filename = storage.get_project_filename(project)
             project.save()
 
         return Response(status=status.HTTP_200_OK)
+
+
+class FileBlocksView(views.APIView):
+    """Uploads a new version of a project file by sending only the blocks that changed since its latest version.
+
+    GET returns the `version_id`, `size`, `sha256`, `block_size` and the sha256 hashcodes of the `blocks` of the latest version.
+    POST expects the `version_id` the blocks were compared against, the `size` and `sha256` of the new file
+    and the changed blocks as files named `block_<index>`, with zero based indices.
+    The blocks that are not sent are taken from the same position in the latest version.
+    """
+
+    parser_classes = [MultiPartParser]
+    permission_classes = [
+        permissions.IsAuthenticated,
+        DownloadPushDeleteFileViewPermissions,
+    ]
+
+    def get(self, request, projectid, filename):
+        project = Project.objects.get(id=projectid)
+        file_version = storage.get_file_version(project, filename)
+
+        if file_version is None:
+            raise exceptions.ObjectNotFoundError(f"File {filename} does not exist.")
+
+        block_sha256s = storage.get_file_block_sha256s(file_version)
+
+        return Response(
+            {
+                "version_id": file_version.version_id,
+                "size": file_version.size,
+                "sha256": file_version.sha256,
+                "block_size": file_version.block_size,
+                "blocks": block_sha256s,
+            }
+        )
+
+    def post(self, request, projectid, filename):
+        project = Project.objects.get(id=projectid)
+
+        _check_file_can_be_uploaded(project, filename)
+
+        sha256sum = str(request.data.get("sha256", "")).lower()
+
+        try:
+            size = int(request.data.get("size"))
+        except (TypeError, ValueError):
+            size = 0
+
+        if size <= 0 or not SHA256_REGEX.match(sha256sum):
+            raise exceptions.ValidationError(
+                "Expected `size` and `sha256` of the file to be uploaded."
+            )
+
+        base_version = storage.get_file_version(project, filename)
+
+        if base_version is None:
+            raise exceptions.ObjectNotFoundError(f"File {filename} does not exist.")
+
+        if base_version.version_id != request.data.get("version_id"):
+            raise exceptions.FileVersionConflictError(
+                f"The latest version of {filename} is {base_version.version_id}."
+            )
+
+        blocks = {}
+        for name, block in request.FILES.items():
+            prefix, _sep, index = name.partition("_")
+
+            if prefix != "block" or not index.isdigit():
+                raise exceptions.ValidationError(f"Unexpected file {name}.")
+
+            blocks[int(index)] = block
+
+        file_version = storage.upload_file_blocks(
+            project, filename, base_version, size, sha256sum, blocks
+        )
+        _on_file_uploaded(request.user, project, filename)
+
+        return Response(
+            {
+                "version_id": file_version.version_id,
+                "uploaded_blocks": len(blocks),
+                "copied_blocks": len(file_version.block_sha256s) - len(blocks),
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class FileUploadViewPermissions(permissions.BasePermission):
+    def has_permission(self, request, view):
+        if "projectid" not in request.parser_context["kwargs"]:
+            return False
+
+        projectid = request.parser_context["kwargs"]["projectid"]
+        project = Project.objects.get(id=projectid)
+
+        return permissions_utils.can_create_files(request.user, project)
+
+
+class FileUploadView(views.APIView):
+    """Initiates an upload of a project file directly to the storage.
+
+    Expects the `filename`, `size` and `sha256` of the file to be uploaded. Returns an `upload_token` and either:
+    - `method` "PUT" with the presigned `url` and the `headers` that must be sent with the file contents.
+      The `x-amz-version-id` response header must be kept, or
+    - `method` "MULTIPART" with the `part_size` and the presigned `url` of each of the `parts`. The `ETag` response header of each part must be kept.
+
+    When `STORAGE_DEDUPLICATE_FILES` is enabled and the file is unchanged, returns only `method` "NONE" and nothing has to be uploaded.
+    Files uploaded directly are not deduplicated, since their hashcode is declared by the client.
+
+    Once uploaded, the upload must be completed with `FileUploadCompleteView`.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, FileUploadViewPermissions]
+
+    def post(self, request, projectid):
+        _check_storage_supports_presigned_urls()
+
+        project = Project.objects.get(id=projectid)
+
+        filename = request.data.get("filename")
+        sha256sum = str(request.data.get("sha256", "")).lower()
+
+        try:
+            size = int(request.data.get("size"))
+        except (TypeError, ValueError):
+            size = -1
+
+        if not filename or size < 0 or not SHA256_REGEX.match(sha256sum):
+            raise exceptions.ValidationError(
+                "Expected `filename`, `size` and `sha256` of the file to be uploaded."
+            )
+
+        _check_file_can_be_uploaded(project, filename)
+
+        if settings.STORAGE_DEDUPLICATE_FILES:
+            latest = storage.get_file_version(project, filename)
+
+            # re-uploading an unchanged file is a no-op
+            if latest and latest.is_verified and latest.sha256 == sha256sum:
+                return Response({"method": "NONE"}, status=status.HTTP_200_OK)
+
+        backend = get_storage_backend()
+        key = utils.safe_join(f"projects/{projectid}/files/", filename)
+        metadata = {"Sha256sum": sha256sum}
+        expires_in = settings.STORAGE_UPLOAD_URL_EXPIRES_IN
+
+        if size <= settings.STORAGE_MULTIPART_UPLOAD_PART_SIZE:
+            url = backend.get_upload_url(key, metadata, expires_in)
+
+            return Response(
+                {
+                    "upload_token": _dump_upload_token(
+                        project, filename, key, size, sha256sum
+                    ),
+                    "method": "PUT",
+                    "url": url,
+                    "headers": {"x-amz-meta-sha256sum": sha256sum},
+                },
+                status=status.HTTP_201_CREATED,
+            )
+
+        # S3 allows at most 10000 parts per upload
+        part_size = max(
+            settings.STORAGE_MULTIPART_UPLOAD_PART_SIZE, math.ceil(size / 10000)
+        )
+        parts_count = math.ceil(size / part_size)
+
+        upload_id = backend.create_multipart_upload(key, metadata)
+
+        parts = []
+        for part_number in range(1, parts_count + 1):
+            url = backend.get_upload_part_url(key, upload_id, part_number, expires_in)
+            parts.append({"part_number": part_number, "url": url})
+
+        return Response(
+            {
+                "upload_token": _dump_upload_token(
+                    project, filename, key, size, sha256sum, upload_id
+                ),
+                "method": "MULTIPART",
+                "part_size": part_size,
+                "parts": parts,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class FileUploadCompleteView(views.APIView):
+    """Completes an upload initiated with `FileUploadView`.
+
+    Expects the `upload_token` and either the `version_id` returned by the storage for a single PUT upload,
+    or for multipart uploads the `parts`, a list of `part_number` and `etag` pairs.
+    The uploaded version is verified against the size and sha256 hashcode declared when the upload was initiated,
+    within the request up to `STORAGE_INLINE_VERIFICATION_MAX_SIZE` and in the background for the bigger files,
+    see `storage.add_verified_file_version`.
+    """
+
+    permission_classes = [permissions.IsAuthenticated, FileUploadViewPermissions]
+
+    def post(self, request, projectid):
+        _check_storage_supports_presigned_urls()
+
+        project = Project.objects.get(id=projectid)
+        upload = _load_upload_token(project, request.data.get("upload_token"))
+        filename = upload["filename"]
+        key = upload["key"]
+
+        _check_file_can_be_uploaded(project, filename)
+
+        if upload["upload_id"]:
+            try:
+                parts = [
+                    (int(p["part_number"]), p["etag"])
+                    for p in request.data.get("parts") or []
+                ]
+            except (KeyError, TypeError, ValueError):
+                raise exceptions.ValidationError(
+                    "Expected `parts` with the `part_number` and `etag` of each uploaded part."
+                )
+
+            try:
+                version_id = get_storage_backend().complete_multipart_upload(
+                    key, upload["upload_id"], parts
+                )
+            except ValueError as err:
+                raise exceptions.ValidationError(str(err))
+        else:
+            # NOTE the latest version might have been uploaded by someone else meanwhile
+            version_id = request.data.get("version_id")
+
+        if not version_id:
+            raise exceptions.ValidationError(
+                "Expected the `version_id` returned by the storage for the uploaded file."
+            )
+
+        # the version must have been uploaded with this upload token
+        if project.file_versions.filter(version_id=version_id).exists():
+            raise exceptions.ValidationError("The upload has already been completed.")
+
+        version = get_storage_backend().head_object(key, version_id)
+
+        if version is None:
+            raise exceptions.ObjectNotFoundError(f"File {filename} was not uploaded.")
+
+        # NOTE the storage modification times have a precision of a second
+        if version.last_modified.timestamp() < upload["created_at"] - 1:
+            raise exceptions.ValidationError(
+                "The version was not uploaded with this `upload_token`."
+            )
+
+        storage.add_verified_file_version(
+            project, filename, version, upload["size"], upload["sha256"]
+        )
+        _on_file_uploaded(request.user, project, filename)
+
+        return Response(status=status.HTTP_201_CREATED)
+
+
+def _dump_upload_token(
+    project: Project,
+    filename: str,
+    key: str,
+    size: int,
+    sha256sum: str,
+    upload_id: Optional[str] = None,
+) -> str:
+    return signing.dumps(
+        {
+            "project_id": str(project.id),
+            "filename": filename,
+            "key": key,
+            "size": size,
+            "sha256": sha256sum,
+            "upload_id": upload_id,
+            "created_at": timezone.now().timestamp(),
+        },
+        salt=UPLOAD_TOKEN_SALT,
+    )
+
+
+def _load_upload_token(project: Project, token: str) -> Dict[str, Any]:
+    try:
+        upload = signing.loads(
+            token or "",
+            salt=UPLOAD_TOKEN_SALT,
+            max_age=settings.STORAGE_UPLOAD_URL_EXPIRES_IN,
+        )
+    except signing.BadSignature:
+        raise exceptions.ValidationError("Invalid or expired `upload_token`.")
+
+    # NOTE the tokens issued before the uploads were pinned to a version cannot be completed anymore
+    if "created_at" not in upload:
+        raise exceptions.ValidationError("Invalid or expired `upload_token`.")
+
+    if upload["project_id"] != str(project.id):
+        raise exceptions.ValidationError("The `upload_token` is for another project.")
+
+    return upload
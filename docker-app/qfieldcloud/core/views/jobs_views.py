@@ -1,7 +1,9 @@
 from django.core.exceptions import ObjectDoesNotExist
-from qfieldcloud.core import permissions_utils, serializers
+from qfieldcloud.core import exceptions, permissions_utils, serializers
 from qfieldcloud.core.models import Job, Project
+from qfieldcloud.core.utils2.job_logs import read_job_logs
 from rest_framework import generics, permissions, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.status import HTTP_201_CREATED
 
@@ -18,6 +20,11 @@ class JobPermissions(permissions.BasePermission):
         return permissions_utils.can_read_files(request.user, project)
 
 
+class JobLogsPermissions(permissions.BasePermission):
+    def has_object_permission(self, request, view, obj):
+        return permissions_utils.can_read_files(request.user, obj.project)
+
+
 class JobViewSet(viewsets.ReadOnlyModelViewSet):
 
     serializer_class = serializers.JobSerializer
@@ -71,3 +78,46 @@ class JobViewSet(viewsets.ReadOnlyModelViewSet):
             qs = qs.filter(project=project)
 
         return qs
+
+    @action(
+        detail=True,
+        methods=["get"],
+        permission_classes=[permissions.IsAuthenticated, JobLogsPermissions],
+    )
+    def logs(self, request, job_id=None):
+        """Returns the output of the job after the `cursor` query param and the progress of its steps, while it runs.
+
+        The returned `cursor` is passed to the next request to only get the output written since.
+        """
+        job = self.get_object()
+        cursor = request.query_params.get("cursor") or None
+
+        try:
+            logs = read_job_logs(job.id, cursor)
+        except ValueError as err:
+            raise exceptions.ValidationError(str(err))
+
+        if logs is None:
+            # the job has not started yet, or its logs are only kept in the job once finished
+            is_finished = job.status in (
+                Job.Status.FINISHED,
+                Job.Status.STOPPED,
+                Job.Status.FAILED,
+            )
+            steps = (job.feedback or {}).get("steps", []) if is_finished else []
+            logs = {
+                "output": (job.output or "") if is_finished and not cursor else "",
+                "cursor": cursor,
+                "steps": [
+                    {
+                        "id": step.get("id"),
+                        "name": step.get("name"),
+                        "stage": step.get("stage"),
+                        "is_running": False,
+                    }
+                    for step in steps
+                ],
+                "is_finished": is_finished,
+            }
+
+        return Response(logs)
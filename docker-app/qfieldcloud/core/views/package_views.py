@@ -1,8 +1,10 @@
 from django.core.exceptions import ObjectDoesNotExist
-from django.http.response import HttpResponseRedirect
 from qfieldcloud.core import exceptions, permissions_utils, utils
 from qfieldcloud.core.models import PackageJob, Project
-from qfieldcloud.core.utils import check_s3_key, get_project_package_files
+from qfieldcloud.core.utils import get_sha256sums
+from qfieldcloud.core.utils2 import archive
+from qfieldcloud.core.utils2.caching import cache_project_response
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 from rest_framework import permissions, views
 from rest_framework.response import Response
 
@@ -21,6 +23,7 @@ class LatestPackageView(views.APIView):
 
     permission_classes = [permissions.IsAuthenticated, PackageViewPermissions]
 
+    @cache_project_response("project_id")
     def get(self, request, project_id):
         """Get last project package status and file list."""
         project = Project.objects.get(id=project_id)
@@ -38,14 +41,23 @@ class LatestPackageView(views.APIView):
                 "Packaging has never been triggered or successful for this project."
             )
 
+        package_files = [
+            v
+            for v in get_storage_backend().list_versions(
+                f"projects/{project_id}/export/"
+            )
+            if v.is_latest and not v.is_delete_marker
+        ]
+        sha256sums = get_sha256sums((f.key, None) for f in package_files)
+
         files = []
-        for f in get_project_package_files(project_id):
+        for f in package_files:
             files.append(
                 {
                     "name": f.name,
                     "size": f.size,
                     "last_modified": f.last_modified,
-                    "sha256": check_s3_key(f.key),
+                    "sha256": sha256sums[(f.key, None)],
                 }
             )
 
@@ -93,16 +105,62 @@ class LatestPackageDownloadFilesView(views.APIView):
             )
 
         file_key = f"projects/{project_id}/export/{filename}"
-        url = utils.get_s3_client().generate_presigned_url(
-            "get_object",
-            Params={
-                "Key": file_key,
-                "Bucket": utils.get_s3_bucket().name,
-                "ResponseContentType": "application/force-download",
-                "ResponseContentDisposition": f'attachment;filename="{filename}"',
-            },
-            ExpiresIn=60,
-            HttpMethod="GET",
-        )
+        return get_storage_backend().get_download_response(file_key, filename)
+
+
+class LatestPackageArchiveView(views.APIView):
+
+    permission_classes = [permissions.IsAuthenticated, PackageViewPermissions]
 
-        return HttpResponseRedirect(url)
+    def get(self, request, project_id):
+        """Download the package files as a single uncompressed tar archive.
+
+        The files can be limited with one or more `name` query parameters.
+        Interrupted downloads can be resumed with a `Range` request, guarded with the `ETag` in `If-Range`.
+        Once the project is packaged again, the previous package files are deleted, so such a request
+        gets the whole new archive. The archive is sent by the app server within its request timeout,
+        the package files can be downloaded directly from the storage with `LatestPackageDownloadFilesView`.
+
+        Raises:
+            exceptions.InvalidJobError: the project has never been packaged
+        """
+        project = Project.objects.get(id=project_id)
+
+        if not PackageJob.objects.filter(
+            project=project, status=PackageJob.Status.FINISHED
+        ).exists():
+            raise exceptions.InvalidJobError(
+                "Packaging has never been triggered or successful for this project."
+            )
+
+        names = set(request.query_params.getlist("name"))
+        members = []
+
+        for version in get_storage_backend().list_versions(
+            f"projects/{project_id}/export/"
+        ):
+            if not version.is_latest or version.is_delete_marker:
+                continue
+
+            if names and version.name not in names:
+                continue
+
+            members.append(
+                archive.ArchiveMember(
+                    name=version.name,
+                    key=version.key,
+                    version_id=version.id,
+                    size=version.size,
+                    last_modified=version.last_modified,
+                )
+            )
+
+        if not members:
+            raise exceptions.InvalidJobError("Empty project package.")
+
+        if names and len(members) != len(names):
+            raise exceptions.ObjectNotFoundError("Not all the requested files exist.")
+
+        return archive.get_archive_response(
+            request, members, f"{project_id}_package.tar"
+        )
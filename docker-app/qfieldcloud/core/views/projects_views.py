@@ -2,7 +2,7 @@ from django.contrib.auth import get_user_model
 from django.utils.decorators import method_decorator
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from qfieldcloud.core import permissions_utils, utils
+from qfieldcloud.core import permissions_utils
 from qfieldcloud.core.models import Project, ProjectQueryset
 from qfieldcloud.core.serializers import ProjectSerializer
 from rest_framework import generics, permissions, viewsets
@@ -115,14 +115,6 @@ class ProjectViewSet(viewsets.ModelViewSet):
             )
         return projects
 
-    def destroy(self, request, projectid):
-        # Delete files from storage
-        bucket = utils.get_s3_bucket()
-        prefix = utils.safe_join("projects/{}/".format(projectid))
-        bucket.objects.filter(Prefix=prefix).delete()
-
-        return super().destroy(request, projectid)
-
 
 @method_decorator(
     name="get",
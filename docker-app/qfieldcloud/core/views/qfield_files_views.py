@@ -2,11 +2,12 @@ from pathlib import PurePath
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
-from django.http.response import HttpResponseRedirect
 from django.utils.decorators import method_decorator
 from drf_yasg.utils import swagger_auto_schema
 from qfieldcloud.core import exceptions, permissions_utils, serializers, utils
 from qfieldcloud.core.models import PackageJob, Project
+from qfieldcloud.core.utils2.caching import cache_project_response
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 from rest_framework import permissions, views
 from rest_framework.response import Response
 
@@ -79,6 +80,7 @@ class PackageView(views.APIView):
 
         return Response(serializer.data)
 
+    @cache_project_response()
     def get(self, request, projectid):
         project_obj = Project.objects.get(id=projectid)
 
@@ -101,6 +103,7 @@ class ListFilesView(views.APIView):
 
     permission_classes = [permissions.IsAuthenticated, PackageViewPermissions]
 
+    @cache_project_response()
     def get(self, request, projectid):
 
         project_obj = Project.objects.get(id=projectid)
@@ -123,29 +126,25 @@ class ListFilesView(views.APIView):
 
         assert export_job
 
-        # Obtain the bucket object
-        bucket = utils.get_s3_bucket()
-
         export_prefix = "projects/{}/export/".format(projectid)
 
+        objs = [
+            v
+            for v in get_storage_backend().list_versions(export_prefix)
+            if v.is_latest and not v.is_delete_marker
+        ]
+        sha256sums = utils.get_sha256sums((obj.key, None) for obj in objs)
+
         files = []
-        for obj in bucket.objects.filter(Prefix=export_prefix):
+        for obj in objs:
             path = PurePath(obj.key)
 
-            # We cannot be sure of the metadata's first letter case
-            # https://github.com/boto/boto3/issues/1709
-            metadata = obj.Object().metadata
-            if "sha256sum" in metadata:
-                sha256sum = metadata["sha256sum"]
-            else:
-                sha256sum = metadata["Sha256sum"]
-
             files.append(
                 {
                     # Get the path of the file relative to the export directory
                     "name": str(path.relative_to(*path.parts[:3])),
                     "size": obj.size,
-                    "sha256": sha256sum,
+                    "sha256": sha256sums[(obj.key, None)],
                 }
             )
 
@@ -192,16 +191,4 @@ class DownloadFileView(views.APIView):
 
         filekey = utils.safe_join("projects/{}/export/".format(projectid), filename)
 
-        url = utils.get_s3_client().generate_presigned_url(
-            "get_object",
-            Params={
-                "Key": filekey,
-                "Bucket": utils.get_s3_bucket().name,
-                "ResponseContentType": "application/force-download",
-                "ResponseContentDisposition": f'attachment;filename="{filename}"',
-            },
-            ExpiresIn=60,
-            HttpMethod="GET",
-        )
-
-        return HttpResponseRedirect(url)
+        return get_storage_backend().get_download_response(filekey, filename)
@@ -1,9 +1,9 @@
-from django.conf import settings
 from django.core.cache import cache
 from django.utils.decorators import method_decorator
 from drf_yasg.utils import swagger_auto_schema
 from qfieldcloud.core import geodb_utils, utils
 from qfieldcloud.core.logging.filters import skip_logging
+from qfieldcloud.core.utils2.storage_backends import get_storage_backend
 from rest_framework import status, views
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
@@ -36,11 +36,8 @@ class APIStatusView(views.APIView):
                 results["geodb"] = "error"
 
             results["storage"] = "ok"
-            # Check if bucket exists (i.e. the connection works)
-            try:
-                s3_client = utils.get_s3_client()
-                s3_client.head_bucket(Bucket=settings.STORAGE_BUCKET_NAME)
-            except Exception:
+            # Check if the storage can be reached (e.g. the bucket exists)
+            if not get_storage_backend().is_available():
                 results["storage"] = "error"
 
             # Cache the result for 10 minutes
@@ -93,10 +93,21 @@ MIDDLEWARE = [
     "axes.middleware.AxesMiddleware",
 ]
 
+# Compute the sha256 hashcode of the uploaded files while receiving them, see `utils.get_sha256`
+FILE_UPLOAD_HANDLERS = [
+    "qfieldcloud.core.upload_handlers.Sha256MemoryFileUploadHandler",
+    "qfieldcloud.core.upload_handlers.Sha256TemporaryFileUploadHandler",
+]
+
 CRON_CLASSES = [
     "qfieldcloud.notifs.cron.SendNotificationsJob",
     # "qfieldcloud.core.cron.DeleteExpiredInvitationsJob",
     "qfieldcloud.core.cron.ResendFailedInvitationsJob",
+    "qfieldcloud.core.cron.ReconcileStorageUsageJob",
+    "qfieldcloud.core.cron.StorageCleanupJob",
+    "qfieldcloud.core.cron.CollectFileBlobsJob",
+    "qfieldcloud.core.cron.PruneFileVersionsJob",
+    "qfieldcloud.core.cron.VerifyFileVersionsJob",
 ]
 
 ROOT_URLCONF = "qfieldcloud.urls"
@@ -137,6 +148,27 @@ DATABASES = {
     }
 }
 
+# Cache shared by all the app processes, e.g. for the presigned URLs and the project responses, see `qfieldcloud.core.utils2.caching`
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": os.environ.get("REDIS_URL", "redis://redis:6379/1"),
+        "KEY_PREFIX": "qfieldcloud",
+        "OPTIONS": {
+            "PASSWORD": os.environ.get("REDIS_PASSWORD"),
+            "SOCKET_CONNECT_TIMEOUT": 2,
+            "SOCKET_TIMEOUT": 2,
+            # the cache is an optimization, if Redis is down the values are just computed every time
+            "IGNORE_EXCEPTIONS": True,
+        },
+    }
+}
+# the ignored exceptions are logged by the `django_redis` logger, see `LOGGING`
+DJANGO_REDIS_LOG_IGNORED_EXCEPTIONS = True
+
+# Timeout in seconds of the cached project responses, they are invalidated anyway when the project changes
+PROJECT_CACHE_TIMEOUT = 60 * 10
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -183,12 +215,35 @@ MEDIA_URL = "/mediafiles/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "mediafiles")
 
 # S3 Storage
+# Either `s3` or `local`, see `qfieldcloud.core.utils2.storage_backends`
+# NOTE `local` does not support presigned URLs, so it cannot serve the direct uploads, and the QGIS worker refuses to start with it
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+STORAGE_LOCAL_ROOT = os.environ.get("STORAGE_LOCAL_ROOT", "/storage")
 STORAGE_ACCESS_KEY_ID = os.environ.get("STORAGE_ACCESS_KEY_ID")
 STORAGE_SECRET_ACCESS_KEY = os.environ.get("STORAGE_SECRET_ACCESS_KEY")
 STORAGE_BUCKET_NAME = os.environ.get("STORAGE_BUCKET_NAME")
 STORAGE_REGION_NAME = os.environ.get("STORAGE_REGION_NAME")
 STORAGE_ENDPOINT_URL = os.environ.get("STORAGE_ENDPOINT_URL")
 STORAGE_ENDPOINT_URL_EXTERNAL = os.environ.get("STORAGE_ENDPOINT_URL_EXTERNAL")
+# Connection pool size of the shared S3 client, should not be lower than the number of threads using it
+STORAGE_MAX_POOL_CONNECTIONS = 50
+# Validity in seconds of the presigned URLs for direct uploads to the storage
+STORAGE_UPLOAD_URL_EXPIRES_IN = 60 * 60 * 6
+# Validity in seconds of the presigned download URLs
+STORAGE_DOWNLOAD_URL_EXPIRES_IN = 60 * 15
+# Cached presigned download URLs are reused only while still valid for at least that many seconds
+STORAGE_DOWNLOAD_URL_MIN_VALIDITY = 60 * 5
+# Files bigger than this are uploaded directly to the storage in parts of this size (S3 requires at least 5 MiB)
+STORAGE_MULTIPART_UPLOAD_PART_SIZE = 64 * 1024 * 1024
+# Block size used to upload only the changed parts of a file, each block is a multipart upload part so at least 5 MiB
+STORAGE_FILE_BLOCK_SIZE = 8 * 1024 * 1024
+# The files uploaded with a declared sha256 hashcode up to that size are read back and verified within the request,
+# the bigger ones are verified in the background by `VerifyFileVersionsJob`
+STORAGE_INLINE_VERIFICATION_MAX_SIZE = 64 * 1024 * 1024
+# Store the uploaded project files once per sha256 hashcode under `blobs/`, project file versions only reference them
+STORAGE_DEDUPLICATE_FILES = bool(
+    int(os.environ.get("STORAGE_DEDUPLICATE_FILES", default=0))
+)
 
 AUTH_USER_MODEL = "core.User"
 
@@ -321,6 +376,10 @@ LOGGING = {
             ],
             "propagate": False,
         },
+        # NOTE the Redis errors are otherwise hidden, as the cache ignores them
+        "django_redis": {
+            "level": "WARNING",
+        },
     },
 }
 
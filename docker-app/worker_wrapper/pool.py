@@ -0,0 +1,380 @@
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import docker
+from docker.models.containers import Container
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_ERROR_EXIT_CODE = -1
+
+# number of idle QGIS containers kept started, 0 to start a new container for each job
+POOL_SIZE = int(os.environ.get("QFIELDCLOUD_WORKER_POOL_SIZE") or 0)
+# a pooled container is replaced after running that many jobs
+POOL_MAX_JOBS = int(os.environ.get("QFIELDCLOUD_WORKER_POOL_MAX_JOBS") or 20)
+# a pooled container is replaced once it uses more memory than that, in bytes
+POOL_MAX_MEMORY = int(
+    os.environ.get("QFIELDCLOUD_WORKER_POOL_MAX_MEMORY") or 1024 * 1024 * 1024
+)
+# maximum time in seconds a job waits for an idle container
+POOL_ACQUIRE_TIMEOUT = 5 * 60
+
+# NOTE the worker wrapper's `/tmp` is the host's `TMP_DIRECTORY`, so the paths are the same for the docker daemon
+JOBS_DIR = Path("/tmp/qfieldcloud_jobs")
+CONTAINER_JOBS_DIR = "/jobs"
+SOCKETS_DIRNAME = ".sockets"
+POOL_LABEL = "qfieldcloud.worker_pool"
+POOL_SOCKET_LABEL = "qfieldcloud.worker_pool.socket"
+# maximum time in seconds for a pooled container to start serving jobs
+POOL_START_TIMEOUT = 2 * 60
+
+ENTRYPOINT_COMMAND = ["python3", "entrypoint.py"]
+
+
+def get_qgis_container_options(volumes: List[str]) -> Dict[str, Any]:
+    """Returns the options to run a QGIS container, with the given volumes and the transformation grids."""
+    QGIS_CONTAINER_NAME = os.environ.get("QGIS_CONTAINER_NAME", None)
+    TRANSFORMATION_GRIDS_VOLUME_NAME = os.environ.get(
+        "TRANSFORMATION_GRIDS_VOLUME_NAME", None
+    )
+    PROJECTS_CACHE_VOLUME_NAME = os.environ.get("PROJECTS_CACHE_VOLUME_NAME", None)
+
+    assert QGIS_CONTAINER_NAME
+    assert TRANSFORMATION_GRIDS_VOLUME_NAME
+    assert PROJECTS_CACHE_VOLUME_NAME
+
+    return {
+        "image": QGIS_CONTAINER_NAME,
+        "environment": {
+            "STORAGE_ACCESS_KEY_ID": os.environ.get("STORAGE_ACCESS_KEY_ID"),
+            "STORAGE_SECRET_ACCESS_KEY": os.environ.get("STORAGE_SECRET_ACCESS_KEY"),
+            "STORAGE_BUCKET_NAME": os.environ.get("STORAGE_BUCKET_NAME"),
+            "STORAGE_REGION_NAME": os.environ.get("STORAGE_REGION_NAME"),
+            "STORAGE_ENDPOINT_URL": os.environ.get("STORAGE_ENDPOINT_URL"),
+            "STORAGE_TRANSFER_FILES_CONCURRENCY": os.environ.get(
+                "STORAGE_TRANSFER_FILES_CONCURRENCY"
+            ),
+            "STORAGE_TRANSFER_MULTIPART_CHUNKSIZE": os.environ.get(
+                "STORAGE_TRANSFER_MULTIPART_CHUNKSIZE"
+            ),
+            "STORAGE_TRANSFER_MULTIPART_CONCURRENCY": os.environ.get(
+                "STORAGE_TRANSFER_MULTIPART_CONCURRENCY"
+            ),
+            "QFIELDCLOUD_PROJECTS_CACHE_DIR": "/projects_cache",
+            "QFIELDCLOUD_PROJECTS_CACHE_SIZE": os.environ.get(
+                "QFIELDCLOUD_WORKER_PROJECTS_CACHE_SIZE"
+            ),
+            "PROJ_DOWNLOAD_DIR": "/transformation_grids",
+            "QT_QPA_PLATFORM": "offscreen",
+        },
+        "volumes": [
+            *volumes,
+            f"{TRANSFORMATION_GRIDS_VOLUME_NAME}:/transformation_grids:ro",
+            f"{PROJECTS_CACHE_VOLUME_NAME}:/projects_cache:rw",
+        ],
+        "network": os.environ.get("QFIELDCLOUD_DEFAULT_NETWORK"),
+    }
+
+
+class PooledContainer:
+    """A started QGIS container serving the jobs on a Unix socket, one at a time, see `serve` in the QGIS entrypoint."""
+
+    def __init__(self, container: Container, socket_filename: Path) -> None:
+        self.container = container
+        self.socket_filename = socket_filename
+        self.jobs_count = 0
+
+    def is_ready(self) -> bool:
+        """Whether the server in the container accepts jobs, the QGIS application takes a while to start."""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(str(self.socket_filename))
+        except OSError:
+            return False
+
+        return True
+
+    def run(
+        self, command: List[str], io_dir: Path, timeout: float
+    ) -> Tuple[int, bytes]:
+        """Sends a job to the server in the container and returns its exit code and output.
+
+        Args:
+            command (List[str]): the command to run, as for a new QGIS container
+            io_dir (Path): the job directory, within `JOBS_DIR`
+            timeout (float): timeout in seconds
+
+        Returns:
+            Tuple[int, bytes]: the exit code, `TIMEOUT_ERROR_EXIT_CODE` on timeout, and the output
+        """
+        entrypoint_length = len(ENTRYPOINT_COMMAND)
+
+        assert command[:entrypoint_length] == ENTRYPOINT_COMMAND
+
+        request = {
+            "args": command[entrypoint_length:],
+            "io_dir": f"{CONTAINER_JOBS_DIR}/{io_dir.name}",
+        }
+        exit_code = TIMEOUT_ERROR_EXIT_CODE
+
+        self.jobs_count += 1
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(self.socket_filename))
+
+            with sock.makefile("rwb") as f:
+                f.write(json.dumps(request).encode() + b"\n")
+                f.flush()
+
+                try:
+                    response = f.readline()
+                except socket.timeout:
+                    response = None
+
+        if response:
+            exit_code = json.loads(response)["exit_code"]
+        elif response is not None:
+            # the server closed the connection without replying, e.g. QGIS crashed
+            exit_code = self._wait_exit_code()
+
+        try:
+            output = io_dir.joinpath("output.log").read_bytes()
+        except FileNotFoundError:
+            output = b""
+
+        return exit_code, output
+
+    def _wait_exit_code(self) -> int:
+        try:
+            return self.container.wait(timeout=10)["StatusCode"]
+        except Exception as err:
+            logger.warning(f"Failed to get the exit code of a pooled container: {err}")
+            return TIMEOUT_ERROR_EXIT_CODE
+
+    def get_memory_usage(self) -> int:
+        stats = self.container.stats(stream=False)
+
+        return stats.get("memory_stats", {}).get("usage", 0)
+
+    def remove(self) -> None:
+        try:
+            self.container.remove(force=True)
+        except docker.errors.APIError as err:
+            logger.warning(
+                f"Failed to remove pooled container {self.container.id}: {err}"
+            )
+
+        if self.socket_filename.is_socket():
+            self.socket_filename.unlink()
+
+
+class QgisContainerPool:
+    """Pool of started QGIS containers, to save the container and QGIS application startup time for each job.
+
+    The containers are replaced in the background after `max_jobs` jobs, when they use more than `max_memory`,
+    or when a job timed out or failed in an unexpected way.
+    """
+
+    def __init__(self, size: int, max_jobs: int, max_memory: int) -> None:
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self._idle: "queue.Queue[PooledContainer]" = queue.Queue()
+        self._closed = False
+        self._client = docker.from_env()
+        # NOTE the hostname of a container is its short id
+        self._owner = socket.gethostname()
+
+        JOBS_DIR.joinpath(SOCKETS_DIRNAME).mkdir(parents=True, exist_ok=True)
+
+        self._remove_orphan_containers()
+
+        for _i in range(size):
+            self._start_container_in_background()
+
+    def run(
+        self, command: List[str], io_dir: Path, timeout: float
+    ) -> Tuple[int, bytes]:
+        """Runs a command in an idle container, see `PooledContainer.run`."""
+        try:
+            container = self._idle.get(timeout=POOL_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise Exception("No QGIS container available in the pool.")
+
+        try:
+            exit_code, output = container.run(command, io_dir, timeout)
+        except Exception:
+            # the container might be in an unknown state
+            self._release(container, True)
+            raise
+
+        self._release(container, self._should_replace(container, exit_code))
+
+        return exit_code, output
+
+    def close(self) -> None:
+        """Removes the idle containers, the containers still running jobs are removed once released."""
+        self._closed = True
+
+        while True:
+            try:
+                self._idle.get_nowait().remove()
+            except queue.Empty:
+                break
+
+    def _should_replace(self, container: PooledContainer, exit_code: int) -> bool:
+        # NOTE a timed out job might be still running, and a crashed server does not accept jobs anymore
+        if (
+            exit_code == TIMEOUT_ERROR_EXIT_CODE
+            or container.jobs_count >= self.max_jobs
+            or not container.is_ready()
+        ):
+            return True
+
+        try:
+            return container.get_memory_usage() > self.max_memory
+        except docker.errors.APIError as err:
+            logger.warning(
+                f"Failed to get the memory usage of a pooled container: {err}"
+            )
+            return True
+
+    def _release(self, container: PooledContainer, should_replace: bool) -> None:
+        if self._closed:
+            container.remove()
+        elif should_replace:
+            self._replace_in_background(container)
+        else:
+            self._idle.put(container)
+
+    def _start_container_in_background(self) -> None:
+        threading.Thread(target=self._start_container, daemon=True).start()
+
+    def _replace_in_background(self, container: PooledContainer) -> None:
+        def replace():
+            container.remove()
+            self._start_container()
+
+        threading.Thread(target=replace, daemon=True).start()
+
+    def _start_container(self) -> None:
+        retry_seconds = 1
+
+        while not self._closed:
+            socket_name = f"{uuid.uuid4().hex}.sock"
+
+            try:
+                container = self._client.containers.run(
+                    **get_qgis_container_options(
+                        [f"{JOBS_DIR}:{CONTAINER_JOBS_DIR}:rw"]
+                    ),
+                    command=[
+                        *ENTRYPOINT_COMMAND,
+                        "serve",
+                        "--socket",
+                        f"{CONTAINER_JOBS_DIR}/{SOCKETS_DIRNAME}/{socket_name}",
+                    ],
+                    labels={POOL_LABEL: self._owner, POOL_SOCKET_LABEL: socket_name},
+                    detach=True,
+                )
+            except docker.errors.APIError as err:
+                logger.error(
+                    f"Failed to start a pooled QGIS container, retrying in {retry_seconds} seconds: {err}"
+                )
+                time.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, 60)
+                continue
+
+            pooled_container = PooledContainer(
+                container, JOBS_DIR.joinpath(SOCKETS_DIRNAME, socket_name)
+            )
+
+            if not self._wait_ready(pooled_container):
+                logger.error(
+                    f"The pooled QGIS container {container.id} did not start serving jobs, retrying in {retry_seconds} seconds"
+                )
+                pooled_container.remove()
+                time.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, 60)
+                continue
+
+            if self._closed:
+                pooled_container.remove()
+            else:
+                self._idle.put(pooled_container)
+
+            return
+
+    def _wait_ready(self, container: PooledContainer) -> bool:
+        deadline = time.monotonic() + POOL_START_TIMEOUT
+
+        while time.monotonic() < deadline and not self._closed:
+            if container.is_ready():
+                return True
+
+            try:
+                container.container.reload()
+            except docker.errors.APIError:
+                return False
+
+            if container.container.status != "running":
+                return False
+
+            time.sleep(0.5)
+
+        return False
+
+    def _remove_orphan_containers(self) -> None:
+        """Removes the pooled containers of worker wrappers that are gone, e.g. after a crash."""
+        for container in self._client.containers.list(
+            all=True, filters={"label": POOL_LABEL}
+        ):
+            owner = container.labels.get(POOL_LABEL)
+
+            try:
+                is_orphan = self._client.containers.get(owner).status != "running"
+            except docker.errors.NotFound:
+                is_orphan = True
+
+            if is_orphan or owner == self._owner:
+                logger.info(f"Removing orphan pooled container {container.id}")
+                socket_name = container.labels.get(POOL_SOCKET_LABEL, "")
+                PooledContainer(
+                    container, JOBS_DIR.joinpath(SOCKETS_DIRNAME, socket_name)
+                ).remove()
+
+
+_pool: Optional[QgisContainerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Optional[QgisContainerPool]:
+    """Returns the pool of QGIS containers, `None` if disabled with `QFIELDCLOUD_WORKER_POOL_SIZE`."""
+    global _pool
+
+    if POOL_SIZE <= 0:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = QgisContainerPool(POOL_SIZE, POOL_MAX_JOBS, POOL_MAX_MEMORY)
+
+        return _pool
+
+
+def close_pool() -> None:
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
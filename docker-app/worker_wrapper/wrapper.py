@@ -3,6 +3,7 @@ import logging
 import os
 import sys
 import tempfile
+import threading
 import traceback
 import uuid
 from pathlib import Path
@@ -12,8 +13,10 @@ import docker
 import qfieldcloud.core.utils2.storage
 import requests
 from django.db import transaction
+from django.db.models import Q
 from django.forms.models import model_to_dict
 from django.utils import timezone
+from docker.models.containers import Container
 from qfieldcloud.core.models import (
     ApplyJob,
     ApplyJobDelta,
@@ -21,11 +24,19 @@ from qfieldcloud.core.models import (
     Job,
     PackageJob,
     ProcessProjectfileJob,
+    Project,
+)
+from qfieldcloud.core.utils2.job_logs import FLUSH_SECONDS, JobLogWriter
+from worker_wrapper.pool import (
+    ENTRYPOINT_COMMAND,
+    JOBS_DIR,
+    TIMEOUT_ERROR_EXIT_CODE,
+    get_pool,
+    get_qgis_container_options,
 )
 
 logger = logging.getLogger(__name__)
 
-TIMEOUT_ERROR_EXIT_CODE = -1
 QGIS_CONTAINER_NAME = os.environ.get("QGIS_CONTAINER_NAME", None)
 QFIELDCLOUD_HOST = os.environ.get("QFIELDCLOUD_HOST", None)
 
@@ -37,6 +48,49 @@ class QgisException(Exception):
     pass
 
 
+class FileFollower(threading.Thread):
+    """Writes what is appended to a file to a `JobLogWriter`, until stopped."""
+
+    def __init__(self, filename: Path, writer: JobLogWriter) -> None:
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.writer = writer
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+    def run(self) -> None:
+        position = 0
+
+        while True:
+            is_stopped = self._stopped.wait(FLUSH_SECONDS)
+
+            try:
+                with open(self.filename, "rb") as f:
+                    f.seek(position)
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+
+            if data:
+                position += len(data)
+                self.writer.write(data)
+
+            # NOTE read one last time after being stopped, to get the end of the output
+            if is_stopped:
+                break
+
+
+def _stream_container_logs(container: Container, writer: JobLogWriter) -> None:
+    try:
+        for data in container.logs(stream=True, follow=True):
+            writer.write(data)
+    except Exception as err:
+        logger.warning(f"Failed to stream the logs of the QGIS container: {err}")
+
+
 class JobRun:
     container_timeout_secs = 10 * 60
     job_class = Job
@@ -46,7 +100,9 @@ class JobRun:
         try:
             self.job_id = job_id
             self.job = self.job_class.objects.select_related().get(id=job_id)
-            self.shared_tempdir = Path(tempfile.mkdtemp(dir="/tmp"))
+            # NOTE the directory must be within `JOBS_DIR` to be seen by the pooled containers
+            JOBS_DIR.mkdir(parents=True, exist_ok=True)
+            self.shared_tempdir = Path(tempfile.mkdtemp(dir=JOBS_DIR))
         except Exception as err:
             feedback = {}
             (_type, _value, tb) = sys.exc_info()
@@ -76,9 +132,7 @@ class JobRun:
         return context
 
     def get_command(self) -> List[str]:
-        return [
-            p % self.get_context() for p in ["python3", "entrypoint.py", *self.command]
-        ]
+        return [p % self.get_context() for p in [*ENTRYPOINT_COMMAND, *self.command]]
 
     def before_docker_run(self) -> None:
         pass
@@ -99,6 +153,17 @@ class JobRun:
 
             self.before_docker_run()
 
+            # the project files referencing blobs cannot be found by listing the project prefix,
+            # and the sha256 metadata of the versions not verified yet must not be trusted
+            project = self.job.project
+            if project.file_versions.filter(
+                Q(blob__isnull=False) | Q(is_verified=False), is_latest=True
+            ).exists():
+                with open(self.shared_tempdir.joinpath("files.json"), "w") as f:
+                    json.dump(
+                        qfieldcloud.core.utils2.storage.get_files_manifest(project), f
+                    )
+
             command = self.get_command()
             volumes = []
             volumes.append(f"{str(self.shared_tempdir)}:/io/:rw")
@@ -188,42 +253,50 @@ class JobRun:
     def _run_docker(
         self, command: List[str], volumes: List[str], run_opts: Dict[str, Any] = {}
     ) -> Tuple[int, bytes]:
-        QGIS_CONTAINER_NAME = os.environ.get("QGIS_CONTAINER_NAME", None)
         QFIELDCLOUD_HOST = os.environ.get("QFIELDCLOUD_HOST", None)
-        TRANSFORMATION_GRIDS_VOLUME_NAME = os.environ.get(
-            "TRANSFORMATION_GRIDS_VOLUME_NAME", None
-        )
 
-        assert QGIS_CONTAINER_NAME
         assert QFIELDCLOUD_HOST
-        assert TRANSFORMATION_GRIDS_VOLUME_NAME
-
-        client = docker.from_env()
 
         logger.info(f"Execute: {' '.join(command)}")
-        volumes.append(f"{TRANSFORMATION_GRIDS_VOLUME_NAME}:/transformation_grids:ro")
+
+        # the output is streamed to Redis while the job runs, see `JobViewSet.logs`
+        log_writer = JobLogWriter(self.job.id)
+
+        pool = get_pool()
+        if pool:
+            # the pooled containers write the output to a file in the job directory
+            follower = FileFollower(
+                self.shared_tempdir.joinpath("output.log"), log_writer
+            )
+            follower.start()
+
+            try:
+                # the pooled containers see the job directory at another path than `/io/`
+                exit_code, logs = pool.run(
+                    command, self.shared_tempdir, self.container_timeout_secs
+                )
+            finally:
+                follower.stop()
+                log_writer.close()
+
+            logger.info(f"Finished execution with code {exit_code}, logs:\n{logs}")
+
+            return exit_code, logs
+
+        client = docker.from_env()
 
         container = client.containers.run(
-            QGIS_CONTAINER_NAME,
-            command,
-            environment={
-                "STORAGE_ACCESS_KEY_ID": os.environ.get("STORAGE_ACCESS_KEY_ID"),
-                "STORAGE_SECRET_ACCESS_KEY": os.environ.get(
-                    "STORAGE_SECRET_ACCESS_KEY"
-                ),
-                "STORAGE_BUCKET_NAME": os.environ.get("STORAGE_BUCKET_NAME"),
-                "STORAGE_REGION_NAME": os.environ.get("STORAGE_REGION_NAME"),
-                "STORAGE_ENDPOINT_URL": os.environ.get("STORAGE_ENDPOINT_URL"),
-                "PROJ_DOWNLOAD_DIR": "/transformation_grids",
-                "QT_QPA_PLATFORM": "offscreen",
-            },
-            volumes=volumes,
-            # TODO keep the logs somewhere or even better -> pipe them to redis and store them there
+            command=command,
+            **get_qgis_container_options(volumes),
             # auto_remove=True,
-            network=os.environ.get("QFIELDCLOUD_DEFAULT_NETWORK"),
             detach=True,
         )
 
+        streamer = threading.Thread(
+            target=_stream_container_logs, args=(container, log_writer), daemon=True
+        )
+        streamer.start()
+
         response = {"StatusCode": TIMEOUT_ERROR_EXIT_CODE}
 
         try:
@@ -234,6 +307,9 @@ class JobRun:
 
         logs = container.logs()
         container.stop()
+        # the log stream ends once the container is stopped
+        streamer.join(timeout=10)
+        log_writer.close()
         container.remove()
         logger.info(
             f"Finished execution with code {response['StatusCode']}, logs:\n{logs}"
@@ -246,16 +322,51 @@ class PackageJobRun(JobRun):
     job_class = PackageJob
     command = ["package", "%(project__id)s", "%(project__project_filename)s"]
     data_last_packaged_at = None
+    package_storage_usage = None
 
     def before_docker_run(self) -> None:
         # at the start of docker we assume we make the snapshot of the data
         self.data_last_packaged_at = timezone.now()
 
+        # the worker replaces the package files directly on the storage, see `after_docker_run`
+        self.package_storage_usage = (
+            qfieldcloud.core.utils2.storage.get_package_storage_usage(self.job.project)
+        )
+
     def after_docker_run(self) -> None:
         # only successfully finished packaging jobs should update the Project.data_last_packaged_at
         if self.job.status == Job.Status.FINISHED:
             self.job.project.data_last_packaged_at = self.data_last_packaged_at
-            self.job.project.save()
+            # NOTE do not overwrite the storage usage counters, which are updated concurrently with `F()`
+            self.job.project.save(update_fields=["data_last_packaged_at"])
+
+        self._update_package_storage_usage()
+
+    def after_docker_exception(self) -> None:
+        # the package might have been partly replaced
+        self._update_package_storage_usage()
+
+    def _update_package_storage_usage(self) -> None:
+        # the job failed before the package storage usage was known
+        if self.package_storage_usage is None:
+            return
+
+        project = self.job.project
+        bytes_before, objects_before, _count = self.package_storage_usage
+        (
+            storage_bytes,
+            storage_objects,
+            package_files_count,
+        ) = qfieldcloud.core.utils2.storage.get_package_storage_usage(project)
+
+        # NOTE only one package job runs at a time, so nothing else changed the package meanwhile
+        qfieldcloud.core.utils2.storage.update_storage_usage(
+            project, storage_bytes - bytes_before, storage_objects - objects_before
+        )
+        Project.objects.filter(pk=project.pk).update(
+            package_files_count=package_files_count
+        )
+        project.package_files_count = package_files_count
 
 
 class DeltaApplyJobRun(JobRun):
@@ -363,6 +474,9 @@ class DeltaApplyJobRun(JobRun):
                 self.job.project.data_last_updated_at = timezone.now()
                 self.job.project.save()
 
+        # the modified files have been uploaded by the QGIS container
+        qfieldcloud.core.utils2.storage.sync_file_versions(self.job.project)
+
     def after_docker_exception(self) -> None:
         Delta.objects.filter(
             id__in=self.delta_ids,
@@ -375,6 +489,9 @@ class DeltaApplyJobRun(JobRun):
             status=Delta.Status.ERROR,
         )
 
+        # some of the modified files might have been uploaded before the failure
+        qfieldcloud.core.utils2.storage.sync_file_versions(self.job.project)
+
 
 class ProcessProjectfileJobRun(JobRun):
     job_class = ProcessProjectfileJob
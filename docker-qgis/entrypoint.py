@@ -2,20 +2,35 @@
 
 import argparse
 import hashlib
+import json
 import logging
+import mmap
 import os
+import shutil
+import socket
+import sys
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePath
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple, Union
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import qfieldcloud.qgis.apply_deltas
 import qfieldcloud.qgis.process_projectfile
+from boto3.s3.transfer import TransferConfig
 from libqfieldsync.offline_converter import ExportType, OfflineConverter
 from libqfieldsync.project import ProjectConfiguration
-from qfieldcloud.qgis.utils import Step
+from qfieldcloud.qgis.utils import Step, start_app
+from qfieldcloud.qgis.working_copy import (
+    WorkingCopy,
+    get_fingerprint,
+    open_working_copy,
+)
 from qgis.core import (
-    QgsApplication,
     QgsCoordinateTransform,
     QgsOfflineEditing,
     QgsProject,
@@ -29,10 +44,28 @@ STORAGE_SECRET_ACCESS_KEY = os.environ.get("STORAGE_SECRET_ACCESS_KEY")
 STORAGE_BUCKET_NAME = os.environ.get("STORAGE_BUCKET_NAME")
 STORAGE_REGION_NAME = os.environ.get("STORAGE_REGION_NAME")
 STORAGE_ENDPOINT_URL = os.environ.get("STORAGE_ENDPOINT_URL")
+# number of files transferred concurrently
+STORAGE_TRANSFER_FILES_CONCURRENCY = int(
+    os.environ.get("STORAGE_TRANSFER_FILES_CONCURRENCY") or 8
+)
+# files bigger than the chunk size are transferred in chunks of that size, in bytes
+STORAGE_TRANSFER_MULTIPART_CHUNKSIZE = int(
+    os.environ.get("STORAGE_TRANSFER_MULTIPART_CHUNKSIZE") or 16 * 1024 * 1024
+)
+# number of chunks of a single file transferred concurrently
+STORAGE_TRANSFER_MULTIPART_CONCURRENCY = int(
+    os.environ.get("STORAGE_TRANSFER_MULTIPART_CONCURRENCY") or 4
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# directory shared with the worker wrapper, different for each job when the container is pooled
+IO_DIR = Path(os.environ.get("QFIELDCLOUD_IO_DIR") or "/io")
+
+# written by the worker wrapper when some project files are not stored under the project prefix, e.g. deduplicated blobs
+FILES_MANIFEST_FILENAME = IO_DIR.joinpath("files.json")
+
 
 def _get_s3_resource():
     """Get S3 Service Resource object"""
@@ -43,7 +76,13 @@ def _get_s3_resource():
         region_name=STORAGE_REGION_NAME,
     )
 
-    return session.resource("s3", endpoint_url=STORAGE_ENDPOINT_URL)
+    # all the concurrent transfers share the connection pool of the resource's client
+    config = botocore.config.Config(
+        max_pool_connections=STORAGE_TRANSFER_FILES_CONCURRENCY
+        * STORAGE_TRANSFER_MULTIPART_CONCURRENCY
+    )
+
+    return session.resource("s3", endpoint_url=STORAGE_ENDPOINT_URL, config=config)
 
 
 def _get_s3_bucket():
@@ -55,65 +94,236 @@ def _get_s3_bucket():
     return bucket
 
 
-def _get_sha256sum(filepath):
-    """Calculate sha256sum of a file"""
-    BLOCKSIZE = 65536
+def _get_transfer_config() -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=STORAGE_TRANSFER_MULTIPART_CHUNKSIZE,
+        multipart_chunksize=STORAGE_TRANSFER_MULTIPART_CHUNKSIZE,
+        max_concurrency=STORAGE_TRANSFER_MULTIPART_CONCURRENCY,
+    )
+
+
+class TransferStats:
+    """Thread safe counter of the transferred files and bytes."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, size: int) -> None:
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def to_dict(self) -> Dict[str, Union[int, float]]:
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(time.monotonic() - self._started_at, 3),
+        }
+
+
+def _get_sha256sum(filepath: Path) -> str:
+    """Calculate sha256sum of a file
+
+    The file is memory mapped and hashed with a single `update()` call, which releases the GIL,
+    so the upload threads hash their files in parallel without copying them to Python objects.
+    """
     hasher = hashlib.sha256()
-    with filepath as f:
-        buf = f.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = f.read(BLOCKSIZE)
+
+    with open(filepath, "rb") as f:
+        # NOTE empty files cannot be memory mapped
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+
     return hasher.hexdigest()
 
 
-def _download_project_directory(project_id: str, tmpdir: Path = None) -> Path:
+def _read_files_manifest() -> Optional[List[Dict]]:
+    """Returns the storage location of each project file, if provided by the worker wrapper"""
+    if not FILES_MANIFEST_FILENAME.exists():
+        return None
+
+    with open(FILES_MANIFEST_FILENAME) as f:
+        return json.load(f)
+
+
+def _download_project_directory(
+    project_id: str, working_copy: WorkingCopy
+) -> Tuple[Path, Dict]:
     """Download the files in the project "working" directory from the S3
-    Storage into a temporary directory. Returns the directory path"""
+    Storage into the working copy, skipping the files already up to date.
+    Returns the working copy directory path and the transfer stats"""
 
     bucket = _get_s3_bucket()
+    client = bucket.meta.client
+    transfer_config = _get_transfer_config()
+    stats = TransferStats()
 
     # Prefix of the working directory on the Storages
     working_prefix = "/".join(["projects", project_id, "files"])
 
-    if not tmpdir:
-        # Create a temporary directory
-        tmpdir = Path(tempfile.mkdtemp())
+    working_dir = working_copy.files_dir
 
-    # Create a local working directory
-    working_dir = tmpdir.joinpath("files")
-    working_dir.mkdir(parents=True)
+    def download(file: Dict) -> None:
+        fingerprint = get_fingerprint(file)
 
-    # Download the files
-    for obj in bucket.objects.filter(Prefix=working_prefix):
-        key_filename = PurePath(obj.key)
+        if fingerprint and working_copy.is_up_to_date(file["name"], fingerprint):
+            return
 
-        # Get the path of the file relative to the project directory
-        relative_filename = key_filename.relative_to(*key_filename.parts[:2])
-        absolute_filename = tmpdir.joinpath(relative_filename)
+        working_copy.set_outdated(file["name"])
+
+        absolute_filename = working_dir.joinpath(file["name"])
         absolute_filename.parent.mkdir(parents=True, exist_ok=True)
 
-        bucket.download_file(obj.key, str(absolute_filename))
+        extra_args = None
+        if file["version_id"]:
+            extra_args = {"VersionId": file["version_id"]}
+
+        client.download_file(
+            bucket.name,
+            file["key"],
+            str(absolute_filename),
+            ExtraArgs=extra_args,
+            Config=transfer_config,
+        )
+        stats.add(file["size"])
+
+        if fingerprint:
+            working_copy.set_up_to_date(file["name"], fingerprint)
+
+    files = _read_files_manifest()
+
+    if files is None:
+        files = [
+            {
+                # Get the path of the file relative to the project directory
+                "name": str(PurePath(obj.key).relative_to(working_prefix)),
+                "key": obj.key,
+                "version_id": None,
+                "size": obj.size,
+                "etag": obj.e_tag,
+            }
+            for obj in bucket.objects.filter(Prefix=working_prefix)
+        ]
+
+    working_copy.remove_other_files(file["name"] for file in files)
+
+    # Download the files
+    with ThreadPoolExecutor(max_workers=STORAGE_TRANSFER_FILES_CONCURRENCY) as executor:
+        # consume the results to raise the first download error, if any
+        list(executor.map(download, files))
+
+    return working_copy.dir, stats.to_dict()
+
 
-    return tmpdir
+def _list_storage_files(bucket, prefix: str) -> Dict[str, Dict]:
+    """Returns the latest version of each file under the prefix, by name, with a single listing"""
+    return {
+        str(PurePath(obj.key).relative_to(prefix)): {
+            "key": obj.key,
+            "size": obj.size,
+            "etag": obj.e_tag,
+        }
+        for obj in bucket.objects.filter(Prefix=prefix + "/")
+    }
 
 
 def _upload_project_directory(
-    project_id: str, local_dir: Path, should_delete: bool = False
-) -> None:
-    """Upload the files in the local_dir to the storage"""
+    project_id: str,
+    local_dir: Path,
+    should_delete: bool = False,
+    working_copy: Optional[WorkingCopy] = None,
+) -> Dict:
+    """Upload the files in the local_dir to the storage. Returns the transfer stats
+
+    The files of the working copy that were not modified since they were downloaded are skipped without being hashed.
+    """
 
     bucket = _get_s3_bucket()
+    client = bucket.meta.client
+    transfer_config = _get_transfer_config()
+    stats = TransferStats()
     # either "files" or "package"
     subdir = local_dir.parts[-1]
     prefix = "/".join(["projects", project_id, subdir])
 
     if should_delete:
-        # Remove existing package directory on the storage
-        bucket.objects.filter(Prefix=prefix).delete()
+        # Permanently remove the existing package directory on the storage, including the older versions
+        bucket.object_versions.filter(Prefix=prefix).delete()
+
+    # the files not stored under the project prefix are only known from the manifest, with their hashcodes
+    files = _read_files_manifest()
+    if should_delete:
+        storage_files = {}
+    elif subdir == "files" and files is not None:
+        storage_files = {f["name"]: f for f in files}
+    else:
+        storage_files = _list_storage_files(bucket, prefix)
 
+    uploaded_names = []
+
+    def upload(elem: Path) -> None:
+        # Create the key
+        name = str(elem.relative_to(local_dir))
+        key = "/".join([prefix, name])
+        storage_file = storage_files.get(name)
+
+        if storage_file and working_copy:
+            fingerprint = get_fingerprint(storage_file)
+
+            if fingerprint and working_copy.is_up_to_date(name, fingerprint):
+                return
+
+        # Calculate sha256sum
+        sha256sum = _get_sha256sum(elem)
+        metadata = {"sha256sum": sha256sum}
+
+        if storage_file is None:
+            storage_sha256sum = None
+        elif "etag" not in storage_file:
+            storage_sha256sum = storage_file.get("sha256")
+        else:
+            # NOTE only the listed files modified locally get there, the listing does not return the metadata
+            try:
+                storage_metadata = client.head_object(Bucket=bucket.name, Key=key)[
+                    "Metadata"
+                ]
+                storage_sha256sum = storage_metadata.get(
+                    "sha256sum", storage_metadata.get("Sha256sum", None)
+                )
+            except botocore.exceptions.ClientError as err:
+                if (
+                    err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+                    != 404
+                ):
+                    raise err
+
+                storage_sha256sum = None
+
+        # Check if the file is different on the storage
+        if metadata["sha256sum"] != storage_sha256sum:
+            client.upload_file(
+                str(elem),
+                bucket.name,
+                key,
+                ExtraArgs={"Metadata": metadata},
+                Config=transfer_config,
+            )
+            stats.add(elem.stat().st_size)
+
+        if working_copy and files is not None:
+            working_copy.set_up_to_date(name, get_fingerprint({"sha256": sha256sum}))
+        elif working_copy:
+            uploaded_names.append(name)
+
+    elems = []
     # Loop recursively in the local package directory
     for elem in Path(local_dir).rglob("*.*"):
+        if not elem.is_file():
+            continue
         # Don't upload .qgs~ and .qgz~ files
         if str(elem).endswith("~"):
             continue
@@ -121,33 +331,27 @@ def _upload_project_directory(
         if str(elem).endswith(".qfieldcloudbackup"):
             continue
 
-        # Calculate sha256sum
-        with open(elem, "rb") as e:
-            sha256sum = _get_sha256sum(e)
+        elems.append(elem)
 
-        # Create the key
-        key = "/".join([prefix, str(elem.relative_to(*elem.parts[:4]))])
-        metadata = {"sha256sum": sha256sum}
+    with ThreadPoolExecutor(max_workers=STORAGE_TRANSFER_FILES_CONCURRENCY) as executor:
+        # consume the results to raise the first upload error, if any
+        list(executor.map(upload, elems))
 
-        if should_delete:
-            storage_metadata = {"sha256sum": None}
-        else:
-            storage_metadata = bucket.Object(key).metadata
-            storage_metadata["sha256sum"] = storage_metadata.get(
-                "sha256sum", storage_metadata.get("Sha256sum", None)
-            )
+    # the next jobs compare the listed ETags to the working copy, which are only known once uploaded
+    if uploaded_names:
+        storage_files = _list_storage_files(bucket, prefix)
 
-        # Check if the file is different on the storage
-        if metadata["sha256sum"] != storage_metadata["sha256sum"]:
-            bucket.upload_file(str(elem), key, ExtraArgs={"Metadata": metadata})
+        for name in uploaded_names:
+            if name in storage_files:
+                working_copy.set_up_to_date(name, get_fingerprint(storage_files[name]))
+
+    return stats.to_dict()
 
 
 def _call_qfieldsync_packager(project_filepath: Path, package_dir: Path) -> Dict:
     """Call the function of QFieldSync to package a project for QField"""
 
-    argvb = list(map(os.fsencode, [""]))
-    qgis_app = QgsApplication(argvb, True)
-    qgis_app.initQgis()
+    start_app()
 
     project = QgsProject.instance()
     if not project_filepath.exists():
@@ -250,187 +454,293 @@ def _call_qfieldsync_packager(project_filepath: Path, package_dir: Path) -> Dict
     offline_converter.project_configuration.create_base_map = False
     offline_converter.convert()
 
-    qgis_app.exitQgis()
-
     return layer_checks
 
 
 def cmd_package_project(args):
-    tmpdir = Path(tempfile.mkdtemp())
-    packagedir = tmpdir.joinpath("export")
-    packagedir.mkdir()
-
-    steps: List[Step] = [
-        Step(
-            id="download_project_directory",
-            name="Download Project Directory",
-            arguments={
-                "tmpdir": tmpdir,
-                "project_id": args.projectid,
-            },
-            arg_names=["project_id", "tmpdir"],
-            method=_download_project_directory,
-            return_names=["tmp_project_dir"],
-            public_returns=["tmp_project_dir"],
-        ),
-        Step(
-            id="export_project",
-            name="Package Project",
-            arguments={
-                "project_filename": tmpdir.joinpath("files", args.project_file),
-                "exportdir": packagedir,
-            },
-            arg_names=["project_filename", "exportdir"],
-            return_names=["layer_checks"],
-            output_names=["layer_checks"],
-            method=_call_qfieldsync_packager,
-        ),
-        Step(
-            id="upload_exported_project",
-            name="Upload Packaged Project",
-            arguments={
-                "project_id": args.projectid,
-                "exportdir": packagedir,
-                "should_delete": True,
-            },
-            arg_names=["project_id", "exportdir", "should_delete"],
-            method=_upload_project_directory,
-        ),
-    ]
-
-    qfieldcloud.qgis.utils.run_task(
-        steps,
-        Path("/io/feedback.json"),
-    )
+    with open_working_copy(args.projectid) as working_copy:
+        tmpdir = working_copy.dir
+        # NOTE the package is not kept in the working copy
+        packagedir = Path(tempfile.mkdtemp()).joinpath("export")
+        packagedir.mkdir()
+
+        steps: List[Step] = [
+            Step(
+                id="download_project_directory",
+                name="Download Project Directory",
+                arguments={
+                    "project_id": args.projectid,
+                    "working_copy": working_copy,
+                },
+                arg_names=["project_id", "working_copy"],
+                method=_download_project_directory,
+                return_names=["tmp_project_dir", "transfer_stats"],
+                output_names=["transfer_stats"],
+                public_returns=["tmp_project_dir"],
+            ),
+            Step(
+                id="export_project",
+                name="Package Project",
+                arguments={
+                    "project_filename": tmpdir.joinpath("files", args.project_file),
+                    "exportdir": packagedir,
+                },
+                arg_names=["project_filename", "exportdir"],
+                return_names=["layer_checks"],
+                output_names=["layer_checks"],
+                method=_call_qfieldsync_packager,
+            ),
+            Step(
+                id="upload_exported_project",
+                name="Upload Packaged Project",
+                arguments={
+                    "project_id": args.projectid,
+                    "exportdir": packagedir,
+                    "should_delete": True,
+                },
+                arg_names=["project_id", "exportdir", "should_delete"],
+                method=_upload_project_directory,
+                return_names=["transfer_stats"],
+                output_names=["transfer_stats"],
+            ),
+        ]
+
+        qfieldcloud.qgis.utils.run_task(
+            steps,
+            IO_DIR.joinpath("feedback.json"),
+        )
 
 
 def _apply_delta(args):
-    tmpdir = Path(tempfile.mkdtemp())
-    files_dir = tmpdir.joinpath("files")
-    steps: List[Step] = [
-        Step(
-            id="download_project_directory",
-            name="Download Project Directory",
-            arguments={
-                "project_id": args.projectid,
-                "tmpdir": tmpdir,
-            },
-            arg_names=["project_id", "tmpdir"],
-            method=_download_project_directory,
-            return_names=["tmp_project_dir"],
-            public_returns=["tmp_project_dir"],
-        ),
-        Step(
-            id="apply_deltas",
-            name="Apply Deltas",
-            arguments={
-                "project_filename": tmpdir.joinpath("files", args.project_file),
-                "delta_filename": "/io/deltafile.json",
-                "inverse": args.inverse,
-                "overwrite_conflicts": args.overwrite_conflicts,
-            },
-            arg_names=[
-                "project_filename",
-                "delta_filename",
-                "inverse",
-                "overwrite_conflicts",
-            ],
-            method=qfieldcloud.qgis.apply_deltas.delta_apply,
-            return_names=["delta_feedback"],
-            output_names=["delta_feedback"],
-        ),
-        Step(
-            id="upload_exported_project",
-            name="Upload Project",
-            arguments={
-                "project_id": args.projectid,
-                "files_dir": files_dir,
-                "should_delete": False,
-            },
-            arg_names=["project_id", "files_dir", "should_delete"],
-            method=_upload_project_directory,
-        ),
-    ]
-
-    qfieldcloud.qgis.utils.run_task(
-        steps,
-        Path("/io/feedback.json"),
-    )
+    with open_working_copy(args.projectid) as working_copy:
+        tmpdir = working_copy.dir
+        files_dir = tmpdir.joinpath("files")
+        steps: List[Step] = [
+            Step(
+                id="download_project_directory",
+                name="Download Project Directory",
+                arguments={
+                    "project_id": args.projectid,
+                    "working_copy": working_copy,
+                },
+                arg_names=["project_id", "working_copy"],
+                method=_download_project_directory,
+                return_names=["tmp_project_dir", "transfer_stats"],
+                output_names=["transfer_stats"],
+                public_returns=["tmp_project_dir"],
+            ),
+            Step(
+                id="apply_deltas",
+                name="Apply Deltas",
+                arguments={
+                    "project_filename": tmpdir.joinpath("files", args.project_file),
+                    "delta_filename": str(IO_DIR.joinpath("deltafile.json")),
+                    "inverse": args.inverse,
+                    "overwrite_conflicts": args.overwrite_conflicts,
+                },
+                arg_names=[
+                    "project_filename",
+                    "delta_filename",
+                    "inverse",
+                    "overwrite_conflicts",
+                ],
+                method=qfieldcloud.qgis.apply_deltas.delta_apply,
+                return_names=["delta_feedback"],
+                output_names=["delta_feedback"],
+            ),
+            Step(
+                id="upload_exported_project",
+                name="Upload Project",
+                arguments={
+                    "project_id": args.projectid,
+                    "files_dir": files_dir,
+                    "should_delete": False,
+                    "working_copy": working_copy,
+                },
+                arg_names=["project_id", "files_dir", "should_delete", "working_copy"],
+                method=_upload_project_directory,
+                return_names=["transfer_stats"],
+                output_names=["transfer_stats"],
+            ),
+        ]
+
+        qfieldcloud.qgis.utils.run_task(
+            steps,
+            IO_DIR.joinpath("feedback.json"),
+        )
 
 
 def cmd_process_projectfile(args):
     project_id = args.projectid
     project_file = args.project_file
 
-    tmpdir = Path(tempfile.mkdtemp())
-    project_filename = tmpdir.joinpath("files", project_file)
-    steps: List[Step] = [
-        Step(
-            id="download_project_directory",
-            name="Download Project Directory",
-            arguments={
-                "project_id": project_id,
-                "tmpdir": tmpdir,
-            },
-            arg_names=["project_id", "tmpdir"],
-            method=_download_project_directory,
-            return_names=["tmp_project_dir"],
-            public_returns=["tmp_project_dir"],
-        ),
-        Step(
-            id="project_validity_check",
-            name="Project Validity Check",
-            arguments={
-                "project_filename": project_filename,
-            },
-            arg_names=["project_filename"],
-            method=qfieldcloud.qgis.process_projectfile.check_valid_project_file,
-        ),
-        Step(
-            id="opening_check",
-            name="Opening Check",
-            arguments={
-                "project_filename": project_filename,
-            },
-            arg_names=["project_filename"],
-            method=qfieldcloud.qgis.process_projectfile.load_project_file,
-            return_names=["project"],
-            public_returns=["project"],
-        ),
-        Step(
-            id="project_details",
-            name="Project Details",
-            arg_names=["project"],
-            method=qfieldcloud.qgis.process_projectfile.extract_project_details,
-            return_names=["project_details"],
-            output_names=["project_details"],
-        ),
-        Step(
-            id="generate_thumbnail_image",
-            name="Generate Thumbnail Image",
-            arguments={
-                "thumbnail_filename": Path("/io/thumbnail.png"),
-            },
-            arg_names=["project", "thumbnail_filename"],
-            method=qfieldcloud.qgis.process_projectfile.generate_thumbnail,
-        ),
-    ]
-
-    qfieldcloud.qgis.utils.run_task(
-        steps,
-        Path("/io/feedback.json"),
-    )
+    with open_working_copy(project_id) as working_copy:
+        tmpdir = working_copy.dir
+        project_filename = tmpdir.joinpath("files", project_file)
+        steps: List[Step] = [
+            Step(
+                id="download_project_directory",
+                name="Download Project Directory",
+                arguments={
+                    "project_id": project_id,
+                    "working_copy": working_copy,
+                },
+                arg_names=["project_id", "working_copy"],
+                method=_download_project_directory,
+                return_names=["tmp_project_dir", "transfer_stats"],
+                output_names=["transfer_stats"],
+                public_returns=["tmp_project_dir"],
+            ),
+            Step(
+                id="project_validity_check",
+                name="Project Validity Check",
+                arguments={
+                    "project_filename": project_filename,
+                },
+                arg_names=["project_filename"],
+                method=qfieldcloud.qgis.process_projectfile.check_valid_project_file,
+            ),
+            Step(
+                id="opening_check",
+                name="Opening Check",
+                arguments={
+                    "project_filename": project_filename,
+                },
+                arg_names=["project_filename"],
+                method=qfieldcloud.qgis.process_projectfile.load_project_file,
+                return_names=["project"],
+                public_returns=["project"],
+            ),
+            Step(
+                id="project_details",
+                name="Project Details",
+                arg_names=["project"],
+                method=qfieldcloud.qgis.process_projectfile.extract_project_details,
+                return_names=["project_details"],
+                output_names=["project_details"],
+            ),
+            Step(
+                id="generate_thumbnail_image",
+                name="Generate Thumbnail Image",
+                arguments={
+                    "thumbnail_filename": IO_DIR.joinpath("thumbnail.png"),
+                },
+                arg_names=["project", "thumbnail_filename"],
+                method=qfieldcloud.qgis.process_projectfile.generate_thumbnail,
+            ),
+        ]
+
+        qfieldcloud.qgis.utils.run_task(
+            steps,
+            IO_DIR.joinpath("feedback.json"),
+        )
+
+
+def _run_served_job(parser: argparse.ArgumentParser, request: Dict) -> int:
+    """Runs a job received by the server as if it was the only job of the container and returns its exit code.
+
+    The output is written to `output.log` in the job directory, the feedback to `feedback.json` as usual.
+    The job directory, the temporary directory and the standard output and error are restored afterwards,
+    whatever the job does.
+    """
+    global IO_DIR, FILES_MANIFEST_FILENAME
+
+    io_dir = Path(request["io_dir"])
+    saved_globals = IO_DIR, FILES_MANIFEST_FILENAME, tempfile.tempdir
+    job_tmpdir = tempfile.mkdtemp()
+    exit_code = 0
+
+    IO_DIR = io_dir
+    FILES_MANIFEST_FILENAME = io_dir.joinpath("files.json")
+    tempfile.tempdir = job_tmpdir
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+
+    try:
+        with open(io_dir.joinpath("output.log"), "wb") as output:
+            os.dup2(output.fileno(), 1)
+            os.dup2(output.fileno(), 2)
 
+            try:
+                args = parser.parse_args(request["args"])
 
-if __name__ == "__main__":
+                if args.func is cmd_serve:
+                    raise Exception("Cannot serve from a served job.")
 
-    # Set S3 logging levels
-    logging.getLogger("boto3").setLevel(logging.CRITICAL)
-    logging.getLogger("botocore").setLevel(logging.CRITICAL)
-    logging.getLogger("nose").setLevel(logging.CRITICAL)
-    logging.getLogger("s3transfer").setLevel(logging.CRITICAL)
-    logging.getLogger("urllib3").setLevel(logging.CRITICAL)
+                args.func(args)
+            except SystemExit as err:
+                # raised by argparse on invalid arguments
+                exit_code = err.code if isinstance(err.code, int) else 1
+            except Exception:
+                logger.exception("Failed to run a served job")
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+
+        QgsProject.instance().clear()
+
+        IO_DIR, FILES_MANIFEST_FILENAME, tempfile.tempdir = saved_globals
+        shutil.rmtree(job_tmpdir, ignore_errors=True)
+
+    return exit_code
+
+
+def cmd_serve(args):
+    """Runs the jobs sent on a Unix socket one after the other, keeping the QGIS application started between them.
+
+    Each connection sends a single JSON line with the job command line arguments in `args`
+    and the job directory in `io_dir`. Once the job is finished, the server replies with a JSON line
+    with the `exit_code` and closes the connection.
+    """
+    parser = _get_parser()
+    socket_path = Path(args.socket)
+
+    start_app()
+
+    if socket_path.exists():
+        socket_path.unlink()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_path))
+    server.listen(1)
 
+    logger.info(f"Serving jobs on {socket_path}")
+
+    while True:
+        conn, _address = server.accept()
+
+        with conn, conn.makefile("rwb") as f:
+            line = f.readline()
+
+            # the worker wrapper connects without sending anything to check the server is ready
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line)
+            except ValueError:
+                logger.exception("Invalid job request")
+                continue
+
+            exit_code = _run_served_job(parser, request)
+
+            try:
+                f.write(json.dumps({"exit_code": exit_code}).encode() + b"\n")
+                f.flush()
+            except OSError:
+                # the worker wrapper has given up on the job, e.g. after a timeout
+                logger.warning("Failed to reply to a job request")
+
+
+def _get_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog="COMMAND")
 
     subparsers = parser.add_subparsers(dest="cmd")
@@ -458,5 +768,25 @@ if __name__ == "__main__":
     )
     parser_process_projectfile.set_defaults(func=cmd_process_projectfile)
 
+    parser_serve = subparsers.add_parser(
+        "serve", help="Run the jobs sent on a Unix socket in a single QGIS application"
+    )
+    parser_serve.add_argument("--socket", type=str, required=True, help="socket path")
+    parser_serve.set_defaults(func=cmd_serve)
+
+    return parser
+
+
+if __name__ == "__main__":
+
+    # Set S3 logging levels
+    logging.getLogger("boto3").setLevel(logging.CRITICAL)
+    logging.getLogger("botocore").setLevel(logging.CRITICAL)
+    logging.getLogger("nose").setLevel(logging.CRITICAL)
+    logging.getLogger("s3transfer").setLevel(logging.CRITICAL)
+    logging.getLogger("urllib3").setLevel(logging.CRITICAL)
+
+    parser = _get_parser()
+
     args = parser.parse_args()
     args.func(args)
@@ -107,8 +107,12 @@ def extract_project_details(project: QgsProject) -> Dict[str, str]:
 
         details["extent"] = map_settings.extent().asWktPolygon()
 
+    # NOTE the project is a singleton, the handler must not be called again for the next projects read
     project.readProject.connect(on_project_read)
-    project.read(project.fileName())
+    try:
+        project.read(project.fileName())
+    finally:
+        project.readProject.disconnect(on_project_read)
 
     details["crs"] = project.crs().authid()
     details["project_name"] = project.title()
@@ -228,7 +232,10 @@ def generate_thumbnail(project: QgsProject, thumbnail_filename: Path) -> None:
         # print(f'layers: {[layer.name() for layer in map_settings.layers()]}')
 
     project.readProject.connect(on_project_read)
-    project.read(project.fileName())
+    try:
+        project.read(project.fileName())
+    finally:
+        project.readProject.disconnect(on_project_read)
 
     renderer = QgsMapRendererParallelJob(map_settings)
 
@@ -0,0 +1,110 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# NOTE run within the QGIS image, with the tests next to `entrypoint.py`
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import entrypoint  # noqa: E402 isort:skip
+except ImportError:
+    # QGIS and the `qfieldcloud.qgis` modules are only installed in the QGIS image
+    entrypoint = None
+
+
+@unittest.skipIf(entrypoint is None, "Requires the QGIS image")
+class RunServedJobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.io_dir = tempfile.TemporaryDirectory()
+        self.saved_state = (
+            entrypoint.IO_DIR,
+            entrypoint.FILES_MANIFEST_FILENAME,
+            tempfile.tempdir,
+        )
+        self.stdout_stat = os.fstat(1)
+        self.stderr_stat = os.fstat(2)
+
+    def tearDown(self):
+        self.io_dir.cleanup()
+
+    def run_served_job(self, args, func=None) -> int:
+        with mock.patch.object(
+            entrypoint, "cmd_package_project", func
+        ), mock.patch.object(entrypoint, "QgsProject"):
+            parser = entrypoint._get_parser()
+
+            return entrypoint._run_served_job(
+                parser, {"args": args, "io_dir": self.io_dir.name}
+            )
+
+    def assertRestored(self):
+        self.assertEqual(
+            (
+                entrypoint.IO_DIR,
+                entrypoint.FILES_MANIFEST_FILENAME,
+                tempfile.tempdir,
+            ),
+            self.saved_state,
+        )
+
+        for fd, saved_stat in ((1, self.stdout_stat), (2, self.stderr_stat)):
+            fd_stat = os.fstat(fd)
+            self.assertEqual(
+                (fd_stat.st_dev, fd_stat.st_ino), (saved_stat.st_dev, saved_stat.st_ino)
+            )
+
+    def test_restored_after_an_exception(self):
+        job_state = {}
+
+        def package(args):
+            job_state["io_dir"] = entrypoint.IO_DIR
+            job_state["tempdir"] = tempfile.gettempdir()
+
+            print("packaging", flush=True)
+            raise ValueError("failed")
+
+        exit_code = self.run_served_job(
+            ["package", "projectid", "project.qgs"], package
+        )
+
+        self.assertEqual(exit_code, 1)
+        self.assertRestored()
+
+        # the job ran with its own directories, the temporary one is removed afterwards
+        self.assertEqual(job_state["io_dir"], Path(self.io_dir.name))
+        self.assertNotEqual(job_state["tempdir"], tempfile.gettempdir())
+        self.assertFalse(Path(job_state["tempdir"]).exists())
+
+        output = Path(self.io_dir.name, "output.log").read_text()
+        self.assertIn("packaging", output)
+
+    def test_restored_after_invalid_arguments(self):
+        exit_code = self.run_served_job(["package"])
+
+        # the exit code of argparse
+        self.assertEqual(exit_code, 2)
+        self.assertRestored()
+        self.assertIn("usage", Path(self.io_dir.name, "output.log").read_text())
+
+    def test_restored_when_the_output_cannot_be_written(self):
+        self.io_dir.cleanup()
+
+        with self.assertRaises(FileNotFoundError):
+            self.run_served_job(["package", "projectid", "project.qgs"])
+
+        self.assertRestored()
+
+    def test_serving_from_a_served_job_is_refused(self):
+        with mock.patch.object(entrypoint, "cmd_serve") as serve:
+            exit_code = self.run_served_job(["serve", "--socket", "/tmp/socket"])
+
+        self.assertEqual(exit_code, 1)
+        serve.assert_not_called()
+        self.assertRestored()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# NOTE the module is installed as `qfieldcloud.qgis.working_copy` in the image, but only depends on the standard library
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import working_copy as working_copy_module  # noqa: E402 isort:skip
+from working_copy import (  # noqa: E402 isort:skip
+    STATE_FILENAME,
+    WorkingCopy,
+    _evict,
+    _flock,
+    _get_lock_filename,
+    open_working_copy,
+)
+
+
+class WorkingCopyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_file(self, working_copy: WorkingCopy, name: str, contents: bytes):
+        path = working_copy.files_dir.joinpath(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(contents)
+
+    def test_stale_fingerprint(self):
+        working_copy = WorkingCopy(self.dir)
+        self.write_file(working_copy, "file.txt", b"contents")
+        working_copy.set_up_to_date("file.txt", "etag:1")
+
+        self.assertTrue(working_copy.is_up_to_date("file.txt", "etag:1"))
+        # the file was changed on the storage
+        self.assertFalse(working_copy.is_up_to_date("file.txt", "etag:2"))
+        self.assertFalse(working_copy.is_up_to_date("other.txt", "etag:1"))
+
+        working_copy.set_outdated("file.txt")
+        self.assertFalse(working_copy.is_up_to_date("file.txt", "etag:1"))
+
+    def test_locally_modified_file(self):
+        working_copy = WorkingCopy(self.dir)
+        self.write_file(working_copy, "resized.txt", b"contents")
+        self.write_file(working_copy, "touched.txt", b"contents")
+        self.write_file(working_copy, "removed.txt", b"contents")
+
+        for name in ("resized.txt", "touched.txt", "removed.txt"):
+            working_copy.set_up_to_date(name, "etag:1")
+
+        self.write_file(working_copy, "resized.txt", b"new contents")
+        # same size, but modified later
+        stat = working_copy.files_dir.joinpath("touched.txt").stat()
+        os.utime(
+            working_copy.files_dir.joinpath("touched.txt"),
+            ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000),
+        )
+        working_copy.files_dir.joinpath("removed.txt").unlink()
+
+        for name in ("resized.txt", "touched.txt", "removed.txt"):
+            self.assertFalse(working_copy.is_up_to_date(name, "etag:1"), name)
+
+    def test_state_is_saved_and_loaded(self):
+        working_copy = WorkingCopy(self.dir)
+        self.write_file(working_copy, "file.txt", b"contents")
+        working_copy.set_up_to_date("file.txt", "sha256:abc")
+        working_copy.save()
+
+        loaded = WorkingCopy(self.dir)
+        loaded.load()
+
+        self.assertTrue(loaded.is_up_to_date("file.txt", "sha256:abc"))
+        self.assertEqual(loaded.size, 8)
+
+    def test_remove_other_files(self):
+        working_copy = WorkingCopy(self.dir)
+
+        for name in ("kept.txt", "dir/kept.txt", "removed.txt", "dir/removed.txt"):
+            self.write_file(working_copy, name, b"contents")
+            working_copy.set_up_to_date(name, "etag:1")
+
+        working_copy.remove_other_files(["kept.txt", "dir/kept.txt", "missing.txt"])
+
+        self.assertCountEqual(
+            [
+                str(p.relative_to(working_copy.files_dir))
+                for p in working_copy.files_dir.rglob("*")
+                if p.is_file()
+            ],
+            ["kept.txt", "dir/kept.txt"],
+        )
+        self.assertTrue(working_copy.is_up_to_date("kept.txt", "etag:1"))
+
+        # the state of the removed files is forgotten too, even if they come back
+        self.write_file(working_copy, "removed.txt", b"contents")
+        self.assertFalse(working_copy.is_up_to_date("removed.txt", "etag:1"))
+        self.assertEqual(working_copy.size, 16)
+
+
+class EvictTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_project(self, project_id: str, size: int, last_used: int) -> None:
+        working_copy = WorkingCopy(self.cache_dir.joinpath(project_id))
+        working_copy.files_dir.joinpath("file.bin").write_bytes(b"x" * size)
+        working_copy.set_up_to_date("file.bin", "etag:1")
+        working_copy.save()
+
+        os.utime(self.cache_dir.joinpath(project_id, STATE_FILENAME), (last_used,) * 2)
+
+    def test_least_recently_used_projects_are_evicted(self):
+        self.add_project("oldest", 10, 1000)
+        self.add_project("old", 10, 2000)
+        self.add_project("recent", 10, 3000)
+
+        _evict(self.cache_dir, 15)
+
+        self.assertFalse(self.cache_dir.joinpath("oldest").exists())
+        self.assertFalse(self.cache_dir.joinpath("old").exists())
+        self.assertTrue(self.cache_dir.joinpath("recent").exists())
+
+    def test_locked_projects_are_skipped(self):
+        self.add_project("locked", 10, 1000)
+        self.add_project("old", 10, 2000)
+        self.add_project("recent", 10, 3000)
+
+        # NOTE the locks are held by open file, so they conflict within the same process too
+        with _flock(_get_lock_filename(self.cache_dir, "locked")):
+            _evict(self.cache_dir, 15)
+
+        self.assertTrue(self.cache_dir.joinpath("locked").exists())
+        self.assertFalse(self.cache_dir.joinpath("old").exists())
+        self.assertFalse(self.cache_dir.joinpath("recent").exists())
+
+    def test_nothing_is_evicted_below_the_max_size(self):
+        self.add_project("old", 10, 1000)
+        self.add_project("recent", 10, 2000)
+
+        _evict(self.cache_dir, 20)
+
+        self.assertTrue(self.cache_dir.joinpath("old").exists())
+        self.assertTrue(self.cache_dir.joinpath("recent").exists())
+
+
+class OpenWorkingCopyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_not_cached(self):
+        # NOTE the served jobs set the temporary directory to their job directory
+        with mock.patch.object(working_copy_module, "PROJECTS_CACHE_DIR", None):
+            with mock.patch.object(tempfile, "tempdir", self.tmpdir.name):
+                with open_working_copy("project") as working_copy1:
+                    working_copy1.files_dir.joinpath("file.txt").write_bytes(b"1")
+                    working_copy1.set_up_to_date("file.txt", "etag:1")
+
+                with open_working_copy("project") as working_copy2:
+                    pass
+
+        # each job gets a new empty directory, nothing is kept for the next jobs
+        self.assertNotEqual(working_copy1.dir, working_copy2.dir)
+        self.assertEqual(working_copy1.dir.parent, self.dir)
+        self.assertEqual(list(working_copy2.files_dir.iterdir()), [])
+        self.assertFalse(working_copy1.dir.joinpath(STATE_FILENAME).exists())
+        self.assertFalse(working_copy2.is_up_to_date("file.txt", "etag:1"))
+
+    def test_cached(self):
+        cache_dir = self.dir.joinpath("cache")
+
+        with mock.patch.object(
+            working_copy_module, "PROJECTS_CACHE_DIR", str(cache_dir)
+        ):
+            with open_working_copy("project") as working_copy1:
+                working_copy1.files_dir.joinpath("file.txt").write_bytes(b"1")
+                working_copy1.set_up_to_date("file.txt", "etag:1")
+
+            with open_working_copy("project") as working_copy2:
+                self.assertTrue(working_copy2.is_up_to_date("file.txt", "etag:1"))
+
+        self.assertEqual(working_copy2.dir, cache_dir.joinpath("project"))
+        self.assertTrue(cache_dir.joinpath("project.lock").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
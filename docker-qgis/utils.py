@@ -268,8 +268,12 @@ def extract_project_details(project: QgsProject) -> Dict[str, str]:
 
         details["extent"] = map_settings.extent().asWktPolygon()
 
+    # NOTE disconnected right away, as the project singleton outlives the job in the server mode
     project.readProject.connect(on_project_read)
-    project.read(project.fileName())
+    try:
+        project.read(project.fileName())
+    finally:
+        project.readProject.disconnect(on_project_read)
 
     details["crs"] = project.crs().authid()
     details["project_name"] = project.title()
@@ -327,6 +331,7 @@ def run_task(
     finally:
         feedback["steps"] = [
             {
+                "id": step.id,
                 "name": step.name,
                 "stage": step.stage,
                 "outputs": step.outputs,
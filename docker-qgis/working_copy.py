@@ -0,0 +1,209 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# directory of the volume shared by the QGIS containers to keep the project files between jobs, not cached if not set
+PROJECTS_CACHE_DIR = os.environ.get("QFIELDCLOUD_PROJECTS_CACHE_DIR")
+# the least recently used projects are removed from the cache once it uses more disk than that, in bytes
+PROJECTS_CACHE_SIZE = int(
+    os.environ.get("QFIELDCLOUD_PROJECTS_CACHE_SIZE") or 10 * 1024 * 1024 * 1024
+)
+
+STATE_FILENAME = "state.json"
+
+
+class WorkingCopy:
+    """Local copy of the project files, with the state of each file as downloaded from the storage.
+
+    A file is up to date if it has the same fingerprint on the storage as when it was downloaded,
+    e.g. its ETag or sha256, and if it was not modified locally since, as far as its size and mtime tell.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.dir = directory
+        self.files_dir = directory.joinpath("files")
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        self._state: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return sum(entry["size"] for entry in self._state.values())
+
+    def is_up_to_date(self, name: str, fingerprint: str) -> bool:
+        with self._lock:
+            entry = self._state.get(name)
+
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return False
+
+        try:
+            stat = self.files_dir.joinpath(name).stat()
+        except FileNotFoundError:
+            return False
+
+        return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+
+    def set_outdated(self, name: str) -> None:
+        with self._lock:
+            self._state.pop(name, None)
+
+    def set_up_to_date(self, name: str, fingerprint: str) -> None:
+        """Records the current state of a file, which has just been transferred from or to the storage."""
+        stat = self.files_dir.joinpath(name).stat()
+
+        with self._lock:
+            self._state[name] = {
+                "fingerprint": fingerprint,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+
+    def remove_other_files(self, names: Iterable[str]) -> None:
+        """Removes the local files that are not in `names`, e.g. deleted from the storage or left by a previous job."""
+        names = set(names)
+
+        with self._lock:
+            for name in list(self._state):
+                if name not in names:
+                    del self._state[name]
+
+        for path in list(self.files_dir.rglob("*")):
+            if path.is_dir():
+                continue
+
+            if str(path.relative_to(self.files_dir)) not in names:
+                path.unlink()
+
+    def load(self) -> None:
+        try:
+            with open(self.dir.joinpath(STATE_FILENAME)) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+
+        with self._lock:
+            self._state = state
+
+    def save(self) -> None:
+        filename = self.dir.joinpath(STATE_FILENAME)
+        tmp_filename = filename.with_suffix(".tmp")
+
+        with self._lock:
+            with open(tmp_filename, "w") as f:
+                json.dump(self._state, f)
+
+        # NOTE the mtime of the state file tells when the project was last used
+        tmp_filename.replace(filename)
+
+
+@contextmanager
+def _flock(filename: Path, blocking: bool = True) -> Iterator[bool]:
+    """Locks a file for exclusive use between processes, yields whether the lock was acquired."""
+    with open(filename, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _get_lock_filename(cache_dir: Path, project_id: str) -> Path:
+    # NOTE the lock files are never removed, otherwise two processes might lock different files for the same project
+    return cache_dir.joinpath(f"{project_id}.lock")
+
+
+def _evict(cache_dir: Path, max_size: int) -> None:
+    """Removes the least recently used projects from the cache until it uses less than `max_size` bytes.
+
+    The projects used by another job are skipped.
+    """
+    projects = []
+    total_size = 0
+
+    for directory in cache_dir.iterdir():
+        if not directory.is_dir():
+            continue
+
+        working_copy = WorkingCopy(directory)
+        working_copy.load()
+
+        try:
+            last_used = directory.joinpath(STATE_FILENAME).stat().st_mtime
+        except FileNotFoundError:
+            last_used = 0
+
+        projects.append((last_used, directory.name, working_copy.size))
+        total_size += working_copy.size
+
+    for _last_used, project_id, size in sorted(projects):
+        if total_size <= max_size:
+            break
+
+        with _flock(_get_lock_filename(cache_dir, project_id), False) as is_locked:
+            if not is_locked:
+                continue
+
+            logger.info(f'Removing project "{project_id}" from the cache')
+            shutil.rmtree(cache_dir.joinpath(project_id), ignore_errors=True)
+            total_size -= size
+
+
+@contextmanager
+def open_working_copy(project_id: str) -> Iterator[WorkingCopy]:
+    """Yields the working copy of a project to run a job on.
+
+    If `QFIELDCLOUD_PROJECTS_CACHE_DIR` is set, the working copy is kept in the cache for the next jobs
+    of the project, and locked meanwhile, so the jobs of the same project wait for each other.
+    Otherwise it is a new temporary directory.
+    """
+    if not PROJECTS_CACHE_DIR:
+        yield WorkingCopy(Path(tempfile.mkdtemp()))
+        return
+
+    cache_dir = Path(PROJECTS_CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    started_at = time.monotonic()
+
+    with _flock(_get_lock_filename(cache_dir, project_id)):
+        logger.info(
+            f"Locked the cached working copy in {time.monotonic() - started_at:.3f} seconds"
+        )
+
+        working_copy = WorkingCopy(cache_dir.joinpath(project_id))
+        working_copy.load()
+
+        try:
+            yield working_copy
+        finally:
+            working_copy.save()
+
+    _evict(cache_dir, PROJECTS_CACHE_SIZE)
+
+
+def get_fingerprint(file: Dict) -> Optional[str]:
+    """Returns what identifies the contents of a storage file, as listed in the files manifest or by the storage."""
+    if file.get("sha256"):
+        return f"sha256:{file['sha256']}"
+
+    if file.get("etag"):
+        return f"etag:{file['etag']}"
+
+    return None
@@ -0,0 +1,186 @@
+"""Benchmark the storage round trips needed to list project files with their sha256 hashcodes.
+
+Compares the strategies used by the files listing endpoints, calling the application code:
+
+- `head-per-version`: `utils.get_project_files_with_versions` and a sequential HEAD of each version (the former `ListFilesView`)
+- `batched-head`: `utils.get_project_files_with_versions` and `utils.get_sha256sums` on a bounded thread pool
+- `files-index`: `Project.files`, the checksums stored in the `FileVersion` index
+- `files-index (verify)`: `storage.sync_file_versions` in dry run mode, as `manage.py filesindex verify`
+
+Needs the database and the storage of the application, so run it within the `app` container, e.g.:
+
+    docker compose run --rm -v "$(pwd)/scripts:/scripts" app python /scripts/benchmark_files_listing.py --files 50 --versions 3
+
+A temporary user and project are created and removed once done.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# NOTE the application is either next to the scripts directory or the current directory, as in the `app` container
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("docker-app")))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "qfieldcloud.settings")
+
+import django  # noqa: E402 isort:skip
+
+django.setup()
+
+from qfieldcloud.core import utils  # noqa: E402 isort:skip
+from qfieldcloud.core.models import Project, User  # noqa: E402 isort:skip
+from qfieldcloud.core.utils2 import storage  # noqa: E402 isort:skip
+from qfieldcloud.core.utils2.storage_backends import (  # noqa: E402 isort:skip
+    get_storage_backend,
+)
+
+
+class RequestCounter:
+    """Counts the HTTP requests sent by boto3 clients."""
+
+    def __init__(self, *clients):
+        self.count = 0
+        self._lock = threading.Lock()
+
+        for client in clients:
+            client.meta.events.register("request-created.s3", self._on_request)
+
+    def _on_request(self, **kwargs):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+def head_per_version(project):
+    return {
+        (version.name, version.id): utils.get_sha256sum_from_metadata(
+            version.head()["Metadata"]
+        )
+        for file in utils.get_project_files_with_versions(str(project.id))
+        for version in file.versions
+    }
+
+
+def batched_head(project):
+    versions = [
+        version
+        for file in utils.get_project_files_with_versions(str(project.id))
+        for version in file.versions
+    ]
+    sha256sums = utils.get_sha256sums((v.key, v.id) for v in versions)
+
+    return {(v.name, v.id): sha256sums[(v.key, v.id)] for v in versions}
+
+
+def files_index(project):
+    # the listing itself reads the index from the database, no storage request is needed
+    return {
+        (version.name, version.version_id): version.sha256
+        for file in project.files
+        for version in file.versions
+    }
+
+
+def files_index_verify(project):
+    # only the versions listing is needed to compare the storage with the index
+    missing, extra = storage.sync_file_versions(project, dry_run=True)
+    assert not missing and not extra, "the files index is not in sync"
+
+    return files_index(project)
+
+
+STRATEGIES = {
+    "head-per-version": head_per_version,
+    "batched-head": batched_head,
+    "files-index": files_index,
+    "files-index (verify)": files_index_verify,
+}
+
+
+def populate(project, files, versions, size):
+    backend = get_storage_backend()
+    expected = {}
+
+    for i in range(files):
+        filename = f"file_{i}.bin"
+        key = f"projects/{project.id}/files/{filename}"
+
+        for j in range(versions):
+            body = f"{i}-{j}".encode().ljust(size, b"\0")
+            sha256sum = hashlib.sha256(body).hexdigest()
+            version = backend.put_object(
+                io.BytesIO(body), key, {"Sha256sum": sha256sum}
+            )
+            file_version = storage.add_file_version(
+                project, filename, sha256sum, version
+            )
+            expected[(file_version.name, file_version.version_id)] = sha256sum
+
+    return expected
+
+
+def run(args):
+    suffix = uuid.uuid4().hex[:8]
+    user = User.objects.create_user(username=f"benchmark_{suffix}")
+    project = Project.objects.create(name=f"benchmark_{suffix}", owner=user)
+
+    try:
+        print(
+            f"Populating {args.files} files with {args.versions} versions each in project {project.id}..."
+        )
+        expected = populate(project, args.files, args.versions, args.size)
+
+        counter = RequestCounter(
+            utils.get_s3_client(), utils.get_s3_bucket().meta.client
+        )
+
+        print()
+        print(f"{'strategy':<24}{'round trips':>12}{'seconds':>12}")
+        for name, strategy in STRATEGIES.items():
+            counter.reset()
+            started_at = time.perf_counter()
+            sha256sums = strategy(project)
+            elapsed = time.perf_counter() - started_at
+
+            assert sha256sums == expected, f"{name} returned wrong hashcodes"
+
+            print(f"{name:<24}{counter.count:>12}{elapsed:>12.3f}")
+    finally:
+        if not args.keep:
+            get_storage_backend().delete_object_versions(
+                (v.key, v.id)
+                for v in get_storage_backend().list_versions(
+                    f"projects/{project.id}/", strip_prefix=False
+                )
+            )
+            project.delete()
+            user.delete()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=int, default=50, help="number of files")
+    parser.add_argument(
+        "--versions", type=int, default=3, help="number of versions per file"
+    )
+    parser.add_argument("--size", type=int, default=1024, help="file size in bytes")
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="keep the benchmark project and its uploaded files",
+    )
+
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()